@@ -0,0 +1,113 @@
+"""Concurrent file checksumming for fixity.
+
+Files are read in large fixed-size chunks and fed to all requested
+hash algorithms in a single pass. Many files are hashed at once
+using a thread pool (hashlib releases the GIL while hashing).
+Results are cached by path, size, mtime and inode, so files that
+have not changed are not read again."""
+import os
+import hashlib
+from threading import Lock
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+SHA1='sha1'
+MD5='md5'
+
+# read size; a multiple of typical filesystem block sizes
+CHUNK_SIZE=4*1024*1024
+# number of hashing threads
+THREADS=8
+# number of files whose checksums are remembered
+CACHE_SIZE=65536
+
+def file_key(path):
+    """cache key for a file's current state"""
+    s = os.stat(path)
+    return (path, s.st_size, s.st_mtime, s.st_ino)
+
+def checksum_file(path, algorithms=(SHA1,), chunk_size=CHUNK_SIZE):
+    """compute one or more checksums of a file in one pass.
+    returns a dict of algorithm name -> hex digest"""
+    hashes = [(a, hashlib.new(a)) for a in algorithms]
+    buf = bytearray(chunk_size)
+    view = memoryview(buf)
+    with open(path,'rb',0) as fin: # unbuffered, so reads are chunk-aligned
+        while True:
+            n = fin.readinto(buf)
+            if not n:
+                break
+            for _, h in hashes:
+                h.update(view[:n])
+    return dict((a, h.hexdigest()) for a, h in hashes)
+
+class Fixity(object):
+    def __init__(self, algorithms=(SHA1,), threads=THREADS, cache_size=CACHE_SIZE, chunk_size=CHUNK_SIZE):
+        """algorithms - hash algorithms to compute for every file"""
+        self.algorithms = tuple(algorithms)
+        self.threads = threads
+        self.cache_size = cache_size
+        self.chunk_size = chunk_size
+        self._cache = OrderedDict() # file key -> checksums
+        self._lock = Lock()
+        self._pool = None
+        self._pool_pid = None
+    def _get_pool(self):
+        with self._lock:
+            # a pool inherited through fork has no threads in this process
+            if self._pool is None or self._pool_pid != os.getpid():
+                self._pool = ThreadPool(self.threads)
+                self._pool_pid = os.getpid()
+            return self._pool
+    def _cached(self, key):
+        with self._lock:
+            checksums = self._cache.get(key)
+            if checksums is not None:
+                self._cache[key] = self._cache.pop(key) # now most recently used
+            return checksums
+    def _compute(self, path):
+        key = file_key(path)
+        checksums = self._cached(key)
+        if checksums is not None:
+            return checksums
+        checksums = checksum_file(path, self.algorithms, self.chunk_size)
+        with self._lock:
+            self._cache[key] = checksums
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return checksums
+    def checksums(self, path):
+        """return a dict of algorithm name -> hex digest for a file"""
+        return self._compute(path)
+    def sha1(self, path):
+        return self.checksums(path)[SHA1]
+    def md5(self, path):
+        return self.checksums(path)[MD5]
+    def checksum_all(self, paths):
+        """compute checksums for many files concurrently. returns a list
+        of checksum dicts, in the order of the paths"""
+        paths = list(paths)
+        if len(paths) < 2:
+            return [self._compute(p) for p in paths]
+        return self._get_pool().map(self._compute, paths)
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+    def close(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.close()
+                self._pool.join()
+                self._pool = None
+
+_fixity = None
+_fixity_lock = Lock()
+
+def get_fixity():
+    """return the process-wide Fixity instance, which computes
+    both sha1 and md5"""
+    global _fixity
+    with _fixity_lock:
+        if _fixity is None:
+            _fixity = Fixity(algorithms=(SHA1,MD5))
+        return _fixity
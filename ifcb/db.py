@@ -5,7 +5,7 @@ import time
 import os
 import re
 from oii.times import iso8601
-from oii.utils import sha1_file
+from oii.fixity import get_fixity
 from oii import resolver
 
 def utcdatetime(struct_time=time.time()):
@@ -113,7 +113,7 @@ def compute_fixity(local_path):
     filename = os.path.basename(local_path)
     length = os.stat(local_path).st_size
     fix_time = int(time.time())
-    sha1 = sha1_file(local_path)
+    sha1 = get_fixity().sha1(local_path)
     return filename, length, sha1, fix_time
 
 class IfcbFixity(Psql):
@@ -145,7 +145,7 @@ class IfcbFixity(Psql):
             if fix_length != file_length:
                 raise FixityError('file was %d bytes at fix time of %s, but is %d bytes as of %s' % (fix_length, fix_date, file_length, file_date))
             if local_path == fix_local_path and time_delta > self.time_threshold:
-                checksum = sha1_file(local_path)
+                checksum = get_fixity().sha1(local_path)
                 if checksum != sha1:
                     raise FixityError('file modified at %s, after fix date of %s' % (file_date, fix_date))
                 else:
@@ -154,6 +154,20 @@ class IfcbFixity(Psql):
             raise
         except FixityError as e:
             print 'FAILED on %s: %s' % (local_path,e)
+    def prefetch(self, rows):
+        """concurrently checksum the files in a batch of fixity rows
+        that compare will need to checksum"""
+        paths = []
+        for (filename, local_path, length, sha1, fix_time) in rows:
+            try:
+                if os.stat(local_path).st_mtime - fix_time > self.time_threshold:
+                    paths.append(local_path)
+            except OSError:
+                pass # compare will report it
+        try:
+            get_fixity().checksum_all(paths)
+        except (IOError, OSError):
+            pass # compare will report it
     def check_all(self):
         """Check all fixity records in the time series. This can be a very time consuming
         operation"""
@@ -163,6 +177,7 @@ class IfcbFixity(Psql):
                 batch = db.fetchmany()
                 if len(batch) == 0:
                     break
+                self.prefetch(batch)
                 for row in batch:
                     (filename, local_path, length, sha1, fix_time) = row
                     self.compare(filename, local_path, length, sha1, fix_time)
@@ -429,7 +429,7 @@ def get_sorted_tiles(bin_pid): # FIXME support multiple sort options
 def get_mosaic_layout(pid, scaled_size, page):
     tiles = get_sorted_tiles(pid)
     # perform layout operation
-    return mosaic.layout(tiles, scaled_size, page, threshold=0.05)
+    return mosaic.layout(tiles, scaled_size, page, open_pages=4)
 
 def layout2json(layout, scale):
     """Doesn't actually produce JSON but rather JSON-serializable representation of the tiles"""
@@ -40,4 +40,4 @@ def locate_resolver(name):
     
 @memoize(ttl=30)
 def get_resolver():
-    return ldr.get_resolver(locate_resolver('ifcb.xml'))
+    return ldr.get_resolver(locate_resolver('ifcb.xml'),compiled=True)
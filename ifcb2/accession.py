@@ -1,17 +1,20 @@
-import re
 import os
 from datetime import datetime
+from multiprocessing import Pool
 
 import logging
 
 from sqlalchemy import and_, or_, not_, desc, func, cast, Numeric
 
-from oii.utils import sha1_file
+from oii.fixity import get_fixity
 from oii.times import text2utcdatetime
 from oii.ifcb2 import get_resolver, HDR, ADC, ROI, HDR_PATH, ADC_PATH, ROI_PATH, LID, SCHEMA_VERSION
-from oii.ifcb2.formats.integrity import check_fileset
+from oii.ifcb2.formats.integrity import check_bin
+from oii.ifcb2.formats.adc import read_last_row
+from oii.ifcb2.files import index_fileset, index_data_directory
 from oii.ifcb2.identifiers import parse_pid, get_timestamp
 from oii.ifcb2.orm import Bin, File, TimeSeries
+from oii.ifcb2.rollups import add_to_rollups, has_rollups, rebuild_rollups, bin_row, lock_time_series
 
 from oii.ifcb2.formats.hdr import parse_hdr_file, TEMPERATURE, HUMIDITY
 
@@ -23,43 +26,85 @@ def compute_fixity(fs, fast=False):
     """fs - fileset"""
     paths = [fs[HDR_PATH], fs[ADC_PATH], fs[ROI_PATH]]
     filetypes = [HDR,ADC,ROI]
+    if not fast:
+        # checksum all files at once; File.compute_fixity hits the cache
+        get_fixity().checksum_all(paths)
     for path,filetype in zip(paths,filetypes):
         f = File(local_path=path, filetype=filetype)
         f.compute_fixity(fast=fast)
         logging.warn('FIXITY for %s: length=%d, checksum(sha1)=%s' % (path, f.length, f.sha1))
         yield f
 
-def compute_bin_metrics(b, fs):
-    """fs - fileset, b - bin"""
+def compute_bin_metrics(b, fs, summary=None):
+    """fs - fileset, b - bin
+    summary - result of check_bin on the fileset, if available;
+    otherwise the hdr is parsed and the adc is read from the end"""
     # hdr - temp / humidity
     try:
-        hdr_path = fs[HDR_PATH]
-        parsed_hdr = parse_hdr_file(hdr_path)
+        if summary is not None:
+            parsed_hdr = summary['hdr']
+        else:
+            parsed_hdr = parse_hdr_file(fs[HDR_PATH])
         b.humidity = parsed_hdr.get(HUMIDITY)
         b.temperature = parsed_hdr.get(TEMPERATURE)
     except:
         logging.warn('METRICS FAILED to parse temperature / humidity')
     # adc - triggers, duration
     try:
-        adc_path = fs[ADC_PATH]
-        line = None
-        with open(adc_path) as adc:
-            for line in adc:
-                pass
-        if line is not None:
-            triggers, seconds = re.split(r',',line)[:2]
-            b.triggers = int(triggers)
-            b.duration = float(seconds)
+        if summary is not None:
+            triggers, seconds = summary['triggers'], summary['duration']
+        else:
+            triggers, seconds = read_last_row(fs[ADC_PATH])[:2]
+        b.triggers = int(triggers)
+        b.duration = float(seconds)
     except:
         logging.warn('METRICS FAILED to compute trigger rate')
-    logging.warn('METRICS for %s: humidity=%.2f, temp=%.2fC, triggers=%d, duration=%.2fs' %\
-                 (b.lid, b.humidity, b.temperature, b.triggers, b.duration))
+    rois = '' if summary is None else ', rois=%d' % summary['rois']
+    logging.warn('METRICS for %s: humidity=%.2f, temp=%.2fC, triggers=%d, duration=%.2fs%s' %\
+                 (b.lid, b.humidity, b.temperature, b.triggers, b.duration, rois))
 
 def list_filesets(root):
     return get_resolver().ifcb.files.list_raw_filesets(root)
 
+# number of bins to insert per batch during batch accession
+BATCH_SIZE=500
+
+# File columns computed by fixity
+FIXITY_COLUMNS=['length','filename','filetype','sha1','fix_time','local_path']
+
+def accession_task(args):
+    """process pool entry point for batch accession. computes fixity,
+    integrity, and metrics for a fileset without using the database.
+    args is (ts_label, fileset, fast). returns the bin's column values
+    (bin) and its files' column values (files), or None if the fileset
+    fails"""
+    ts_label, fileset, fast = args
+    lid = fileset[LID]
+    try:
+        files = [dict((c, getattr(f,c)) for c in FIXITY_COLUMNS) for f in compute_fixity(fileset, fast=fast)]
+        parsed = parse_pid(lid)
+        fs = dict((f['filetype'], f['local_path']) for f in files)
+        summary = check_bin(fs, parsed[SCHEMA_VERSION])
+    except:
+        logging.warn('FAIL %s - failed fixity or integrity checks' % lid)
+        return None
+    b = Bin(ts_label=ts_label, lid=lid, sample_time=get_timestamp(parsed))
+    try:
+        compute_bin_metrics(b, fileset, summary)
+    except:
+        logging.warn('METRICS FAIL computing metrics')
+    bin_row = dict(ts_label=ts_label, lid=lid, sample_time=b.sample_time)
+    # bulk_insert needs every row to have every column, so fill in
+    # the defaults the ORM would have for metrics that failed
+    for c in ['triggers','duration','temperature','humidity']:
+        value = getattr(b,c)
+        if value is None:
+            value = Bin.__table__.c[c].default.arg
+        bin_row[c] = value
+    return dict(bin=bin_row, files=files, fileset=fileset)
+
 class Accession(object):
-    def __init__(self,session,ts_label,fast=True):
+    def __init__(self,session,ts_label,fast=False):
         """session = IFCB ORM session"""
         self.session = session
         self.ts_label = ts_label
@@ -73,16 +118,17 @@ class Accession(object):
         sample_time = get_timestamp(parsed)
         return Bin(ts_label=self.ts_label, lid=lid, sample_time=sample_time)
     def test_integrity(self,b):
+        """returns the fileset summary (see check_bin) if the
+        bin's files pass integrity checks, otherwise None"""
         parsed = parse_pid(b.lid)
         schema_version = parsed[SCHEMA_VERSION]
         fs = {}
         for f in b.files:
             fs[f.filetype] = f.local_path
         try:
-            check_fileset(fs, schema_version)
-            return True
+            return check_bin(fs, schema_version)
         except:
-            return False
+            return None
     def compute_fixity(self,b,fileset):
         """b = Bin instance,
         fileset = fileset structure"""
@@ -106,6 +152,14 @@ class Accession(object):
             if dd.product_type == product_type:
                 return True
         return False
+    def index_data_dirs(self, progress_callback=None):
+        """scan each raw data directory and bring the fileset index up to
+        date. accession keeps the index up to date incrementally, so this
+        is only needed for data directories populated some other way"""
+        n = 0
+        for root in list(self.get_raw_roots()):
+            n += index_data_directory(self.session, root, progress_callback=progress_callback)
+        return n
     def list_filesets(self,root=None):
         if root is not None:
             ddpaths = [root]
@@ -124,24 +178,103 @@ class Accession(object):
         if self.bin_exists(lid): # make sure it doesn't exist
             logging.warn('SKIP %s - exists' % lid)
             return EXISTS
+        self.ensure_rollups()
         b = self.new_bin(lid) # create new bin
         # now compute fixity
         logging.warn('FIXITY computing fixity for %s' % lid)
         self.compute_fixity(b,fileset)
         # now test integrity
-        if not self.test_integrity(b):
+        summary = self.test_integrity(b)
+        if summary is None:
             logging.warn('FAIL %s - failed integrity checks' % lid)
             return FAILED
         logging.warn('PASS %s - integrity checks passed' % lid)
         # now compute bin metrics
         logging.warn('METRICS computing metrics for %s' % lid)
         try:
-            compute_bin_metrics(b,fileset)
+            compute_bin_metrics(b,fileset,summary)
         except:
             logging.warn('METRICS FAIL computing metrics')
         logging.warn('ADDED %s to %s' % (lid, self.ts_label))
         self.session.add(b)
+        self.session.flush() # so rollups see the stored metrics, with defaults
+        add_to_rollups(self.session, [bin_row(b)])
+        if 'root' in fileset: # fileset came from list_filesets
+            index_fileset(self.session, fileset['root'], fileset)
         return ADDED
+    def existing_lids(self):
+        """return the set of LIDs of all bins in the time series"""
+        q = self.session.query(Bin.lid).filter(Bin.ts_label==self.ts_label)
+        return set(lid for lid, in q)
+    def ensure_rollups(self):
+        """build metric rollups for a time series accessioned before
+        rollups were kept"""
+        if has_rollups(self.session, self.ts_label):
+            return
+        # another worker may be rebuilding them; wait for it, then check again
+        lock_time_series(self.session, self.ts_label)
+        if not has_rollups(self.session, self.ts_label) and \
+           self.session.query(Bin.id).filter(Bin.ts_label==self.ts_label).first() is not None:
+            rebuild_rollups(self.session, self.ts_label) # commits
+        else:
+            self.session.commit() # release the lock
+    def bulk_insert(self,results):
+        """insert bins and their files, as returned by accession_task,
+        and commit"""
+        if not results:
+            return
+        self.session.execute(Bin.__table__.insert(), [r['bin'] for r in results])
+        lids = [r['bin']['lid'] for r in results]
+        ids = dict(self.session.query(Bin.lid, Bin.id).\
+                   filter(and_(Bin.ts_label==self.ts_label, Bin.lid.in_(lids))))
+        files = [dict(f, bin_id=ids[r['bin']['lid']]) for r in results for f in r['files']]
+        self.session.execute(File.__table__.insert(), files)
+        add_to_rollups(self.session, [dict(r['bin'], data_volume=sum(f['length'] for f in r['files'])) for r in results])
+        for r in results:
+            if 'root' in r['fileset']: # fileset came from list_filesets
+                index_fileset(self.session, r['fileset']['root'], r['fileset'])
+        self.session.commit()
+    def bulk_add_filesets(self,filesets=None,processes=None,batch_size=BATCH_SIZE,progress_callback=None):
+        """batch accession. runs all filesets not already accessioned
+        (by default, all filesets in the time series' raw data directories)
+        through fixity, integrity, and metrics in a process pool, inserting
+        and committing bins in batches of batch_size. progress_callback,
+        if given, is called with the number of filesets done and the
+        total after each one. returns the LIDs of the bins added"""
+        self.ensure_rollups()
+        existing = self.existing_lids()
+        if filesets is None:
+            filesets = self.list_filesets()
+        todo = []
+        for fileset in filesets:
+            if fileset[LID] not in existing:
+                existing.add(fileset[LID])
+                todo.append(fileset)
+        logging.warn('BATCH %s: %d new filesets' % (self.ts_label, len(todo)))
+        added, batch = [], []
+        n_done = 0
+        pool = Pool(processes)
+        try:
+            tasks = [(self.ts_label, fileset, self.fast) for fileset in todo]
+            for result in pool.imap_unordered(accession_task, tasks):
+                n_done += 1
+                if result is not None:
+                    batch.append(result)
+                if len(batch) >= batch_size:
+                    self.bulk_insert(batch)
+                    added += [r['bin']['lid'] for r in batch]
+                    batch = []
+                    logging.warn('BATCH %s: %d of %d filesets processed, %d added' % \
+                                 (self.ts_label, n_done, len(todo), len(added)))
+                if progress_callback is not None:
+                    progress_callback(n_done, len(todo))
+            self.bulk_insert(batch)
+            added += [r['bin']['lid'] for r in batch]
+        finally:
+            pool.terminate()
+            pool.join()
+        logging.warn('BATCH %s: %d of %d filesets added' % (self.ts_label, len(added), len(todo)))
+        return added
     def add_all_filesets(self):
         n_total, n_new = 0, 0
         for fileset in self.list_filesets():
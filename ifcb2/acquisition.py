@@ -1,5 +1,7 @@
 import os
 
+from sqlalchemy.orm import object_session
+
 from collections import Counter
 
 from oii.utils import safe_copy, compare_files, safe_copy_fileset
@@ -8,7 +10,7 @@ from oii.ifcb2 import RAW
 from oii.ifcb2.orm import Base, Instrument, TimeSeries, DataDirectory
 from oii.ifcb2 import get_resolver, ResolverError, HDR, ADC, ROI, PID
 from oii.ifcb2.identifiers import as_product
-from oii.ifcb2.files import NotFound, pid2fileset
+from oii.ifcb2.files import NotFound, pid2fileset, update_index
 
 def list_filesets(instrument):
     """list all filesets currently present in the data directory,
@@ -40,7 +42,8 @@ def list_filesets(instrument):
 def get_copy_from(instrument):
     """Return copy operations for all filesets on the instrument as
     - src: source path in instrument data directory
-    - dest: destination path according to time series data dir configuration."""
+    - dest: destination path according to time series data dir configuration.
+    - root: destination data directory"""
     # for each complete fileset in the instrument data directory,
     for lid,src_fs in list_filesets(instrument):
         # see if the fileset already exists in the time series data dirs
@@ -60,7 +63,7 @@ def get_copy_from(instrument):
                 for s in get_resolver().ifcb.files.raw_destination(pid=pid,root=dest_dir_path):
                     src_path = src_fs[ext]
                     dest_path = s['file_path']
-                    yield (lid, src_path, dest_path)
+                    yield (lid, src_path, dest_path, dest_dir_path)
                     break # only need one destination
 
 def do_copy(instrument):
@@ -68,15 +71,22 @@ def do_copy(instrument):
     its destination directory.
     returns set of LIDs copied"""
     fs = {}
-    for lid,src,dest in get_copy_from(instrument):
+    dests = {} # destination paths by lid, root, and filetype
+    for lid,src,dest,root in get_copy_from(instrument):
         if not lid in fs:
             fs[lid] = []
         fs[lid] += [(src, dest)]
+        filetype = os.path.splitext(dest)[1][1:]
+        dests.setdefault(lid,{}).setdefault(root,{})[filetype] = dest
+    session = object_session(instrument)
     for lid,sds in fs.items():
         try:
             print 'initiating safe copy of %s' % sds # FIXME debug
             safe_copy_fileset(sds)
             print 'safe copying succeeded for %s' % sds # FIXME debug
+            if session is not None:
+                for root, paths in dests[lid].items():
+                    update_index(session, root, lid, paths)
             yield lid
         except IOError:
             # FIXME should not silently fail
@@ -0,0 +1,188 @@
+"""cache of decoded bins. the parsed header, ADC columns, and target
+lists of a bin are kept in a least-recently-used cache bounded by
+approximate memory use, and optionally in a directory shared by
+several processes (e.g., gunicorn workers). entries are keyed by the
+paths and modification times of the bin's raw files, so a changed
+file is decoded again; stale files in the shared directory are never
+read and can be deleted at any time"""
+import os
+import logging
+import hashlib
+import cPickle as pickle
+from threading import Lock
+from collections import OrderedDict
+
+from oii.ifcb2.formats.adc import Adc
+from oii.ifcb2.formats.hdr import parse_hdr_file
+from oii.ifcb2.identifiers import add_pid
+from oii.ifcb2.stitching import STITCHED, PAIR, stitch_columns, apply_stitching
+from oii.ifcb2.mosaics import MosaicLayout, compute_layout, LAYOUT_OPEN_PAGES
+
+# default bound on memory used by cached bins
+CACHE_BYTES=256*1024*1024
+# approximate memory used by one target dict
+TARGET_BYTES=2048
+# change when the pickled form of a decoded bin or layout changes
+DISK_FORMAT=2
+
+class DecodedBin(object):
+    def __init__(self, hdr, arrays):
+        """hdr - parsed header
+        arrays - ADC columns (see Adc.as_arrays)"""
+        self.hdr = hdr
+        self.arrays = arrays
+        names = arrays.dtype.names
+        self._unstitched = [dict(zip(names, row)) for row in arrays.tolist()]
+        for target in self._unstitched:
+            target[STITCHED] = False
+        self._stitched = None
+        self.layouts = {} # (stitched, size, open_pages) -> MosaicLayout
+    def __len__(self):
+        return len(self.arrays)
+    @property
+    def nbytes(self):
+        """approximate memory used, allowing for both target lists"""
+        return self.arrays.nbytes + 2 * len(self.arrays) * TARGET_BYTES
+    def stitched_targets(self):
+        """targets with stitched pairs merged, without pids. shared;
+        do not modify"""
+        if self._stitched is None:
+            keep, firsts, boxes = stitch_columns(self.arrays)
+            self._stitched = apply_stitching(self._unstitched, keep, firsts, boxes)
+        return self._stitched
+    def targets(self, stitched=True):
+        """the bin's targets, without pids. shared; do not modify"""
+        if stitched:
+            return self.stitched_targets()
+        return self._unstitched
+    def get_targets(self, bin_pid, stitched=True, indexes=None):
+        """return copies of the bin's targets with pids added.
+        indexes - if not None, return only the targets at these
+        indexes in the target list"""
+        source = self.targets(stitched)
+        if indexes is not None:
+            source = [source[i] for i in indexes]
+        targets = []
+        for target in source:
+            target = add_pid(target.copy(), bin_pid)
+            if PAIR in target:
+                target[PAIR] = tuple(add_pid(t.copy(), bin_pid) for t in target[PAIR])
+            targets.append(target)
+        return targets
+
+def decode_bin(fileset, schema_version):
+    """read and parse the header and ADC file of a raw fileset"""
+    hdr = parse_hdr_file(fileset['hdr_path'])
+    arrays = Adc(fileset['adc_path'], schema_version).as_arrays()
+    return DecodedBin(hdr, arrays)
+
+def bin_key(fileset, schema_version):
+    hdr_path, adc_path = fileset['hdr_path'], fileset['adc_path']
+    hdr_stat, adc_stat = os.stat(hdr_path), os.stat(adc_path)
+    return (hdr_path, hdr_stat.st_mtime, adc_path, adc_stat.st_size,
+            adc_stat.st_mtime, schema_version)
+
+class BinCache(object):
+    def __init__(self, max_bytes=CACHE_BYTES, cache_dir=None):
+        """max_bytes - approximate bound on memory used
+        cache_dir - if not None, directory in which decoded bins
+        are shared between processes"""
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self._entries = OrderedDict() # key -> DecodedBin
+        self._bytes = 0
+        self._lock = Lock()
+        self._stats = dict(hits=0, misses=0, disk_hits=0, evictions=0)
+    def _disk_path(self, key, suffix='.pickle'):
+        digest = hashlib.sha1(repr((DISK_FORMAT,) + key)).hexdigest()
+        return os.path.join(self.cache_dir, digest[:2], digest + suffix)
+    def _load(self, key):
+        if self.cache_dir is None:
+            return None
+        try:
+            with open(self._disk_path(key),'rb') as fin:
+                hdr, arrays = pickle.load(fin)
+            return DecodedBin(hdr, arrays)
+        except IOError:
+            return None
+        except Exception, e: # e.g., truncated or corrupt
+            logging.warn('BINCACHE cannot read %s: %s' % (self._disk_path(key), e))
+            return None
+    def _write(self, key, write_fn, suffix='.pickle'):
+        if self.cache_dir is None:
+            return
+        path = self._disk_path(key, suffix)
+        part = '%s.%d.part' % (path, os.getpid())
+        try:
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError: # usually because directory exists
+                pass
+            with open(part,'wb') as fout:
+                write_fn(fout)
+            os.rename(part, path)
+        except (IOError, OSError), e:
+            logging.warn('BINCACHE cannot write %s: %s' % (path, e))
+            try:
+                os.remove(part)
+            except OSError:
+                pass
+    def _put(self, key, b):
+        with self._lock:
+            if key in self._entries:
+                return self._entries[key]
+            self._entries[key] = b
+            self._bytes += b.nbytes
+            # evict least recently used, but always keep the newest
+            while self._bytes > self.max_bytes and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.nbytes
+                self._stats['evictions'] += 1
+            return b
+    def get(self, fileset, schema_version):
+        """return the DecodedBin for a raw fileset (a dict with
+        hdr_path and adc_path), decoding it if necessary"""
+        key = bin_key(fileset, schema_version)
+        with self._lock:
+            b = self._entries.pop(key, None)
+            if b is not None:
+                self._entries[key] = b # now most recently used
+                self._stats['hits'] += 1
+                return b
+            self._stats['misses'] += 1
+        b = self._load(key)
+        if b is not None:
+            with self._lock:
+                self._stats['disk_hits'] += 1
+        else:
+            b = decode_bin(fileset, schema_version)
+            self._write(key, lambda fout: pickle.dump((b.hdr, b.arrays), fout, pickle.HIGHEST_PROTOCOL))
+        return self._put(key, b)
+    def get_layout(self, fileset, schema_version, stitched, size, open_pages=LAYOUT_OPEN_PAGES):
+        """return the MosaicLayout of a bin's targets for a page size,
+        computing it if it is not in memory or the cache directory"""
+        b = self.get(fileset, schema_version)
+        layout_key = (stitched, tuple(size), open_pages)
+        layout = b.layouts.get(layout_key)
+        if layout is not None:
+            return layout
+        key = bin_key(fileset, schema_version) + layout_key
+        if self.cache_dir is not None:
+            try:
+                layout = MosaicLayout.load(self._disk_path(key, '.npz'))
+            except (IOError, KeyError, ValueError):
+                pass
+        if layout is None:
+            layout = compute_layout(b.targets(stitched), size, open_pages)
+            self._write(key, layout.save, '.npz')
+        b.layouts[layout_key] = layout
+        return layout
+    def cache_info(self):
+        """hit, miss, and eviction counts and current size"""
+        with self._lock:
+            return dict(self._stats, size=len(self._entries), bytes=self._bytes,
+                        max_bytes=self.max_bytes, cache_dir=self.cache_dir)
+    def cache_clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
@@ -3,7 +3,6 @@ import mimetypes
 import json
 import _strptime
 from time import strptime
-from io import BytesIO
 import re
 import PIL
 import shutil
@@ -29,14 +28,12 @@ from skimage.segmentation import find_boundaries
 from oii.utils import coalesce, memoize, gen_id, order_keys
 from oii.times import iso8601, parse_date_param, struct_time2utcdatetime, utcdtnow
 from oii.image.io import as_bytes, as_pil
-from oii.image import mosaic
-from oii.image.mosaic import Tile
 
 from oii.ifcb2.workflow import BINZIP_PRODUCT
 from oii.workflow.client import WorkflowClient
 
 # FIXME this is used for old PIL-based mosaic compositing API
-from oii.image.pilutils import filename2format, thumbnail
+from oii.image.pilutils import filename2format
 
 from oii.ifcb2 import get_resolver
 from oii.ifcb2 import files
@@ -50,31 +47,32 @@ from oii.rbac.security import current_user, effective_user
 from oii.rbac.security import login_required, api_required, api_login_required, roles_required, api_roles_required, api_login_roles_required
 
 from oii.ifcb2.feed import Feed
+from oii.ifcb2 import rollups
 from oii.ifcb2.comments import Comments
 from oii.ifcb2.tagging import Tagging, parse_ts_label_tag, parse_ts_label_tags, normalize_tag
 from oii.ifcb2.formats.adc import Adc, SCHEMA_VERSION_1
+from oii.ifcb2.bincache import BinCache, CACHE_BYTES
+from oii.ifcb2.mosaics import page_tiles, render_page, pyramid_path, PYRAMID_SIZE, PYRAMID_SCALES
 
 from oii.ifcb2.files import parsed_pid2fileset, NotFound
 from oii.ifcb2.accession import Accession
-from oii.ifcb2.identifiers import add_pids, add_pid, canonicalize, BIN_KEY
-from oii.ifcb2.represent import split_hdr, targets2csv, bin2xml, bin2json, bin2rdf, bin2zip, target2xml, target2rdf, bin2json_short, bin2json_medium, class_scoresmat2csv
+from oii.ifcb2.identifiers import add_pid, canonicalize, BIN_KEY
+from oii.ifcb2.represent import split_hdr, targets2csv, bin2xml, bin2json, bin2rdf, bin2zip_stream, target2xml, target2rdf, bin2json_short, bin2json_medium, class_scoresmat2csv
 from oii.ifcb2.image import read_target_image
-from oii.ifcb2.formats.hdr import parse_hdr_file
 # keys
 from oii.ifcb2.identifiers import PID, LID, ADC_COLS, SCHEMA_VERSION, TIMESTAMP, TIMESTAMP_FORMAT, PRODUCT
-from oii.ifcb2.formats.adc import HEIGHT, WIDTH, TARGET_NUMBER
-from oii.ifcb2.stitching import STITCHED, PAIR, list_stitched_targets, stitch_raw
+from oii.ifcb2.formats.adc import TARGET_NUMBER
+from oii.ifcb2.stitching import PAIR, list_stitched_targets, stitch_raw
 from oii.ifcb2 import v1_stitching
 
 from oii.ifcb2.flow import get_flow
 
 from .get_roi_features import get_roi_features_json
+from oii.ifcb2.formats.features import get_features
 
 from oii.ifcb2.dashboard.flasksetup import app
 from oii.ifcb2.dashboard.flasksetup import session, dbengine, user_manager
 
-from oii.csvio import read_csv, NO_LIMIT
-from oii.iopipes import LocalFileSource
 
 # constants
 MIME_JSON='application/json'
@@ -86,6 +84,8 @@ ADMIN_APP_DIR = os.path.join(os.path.dirname(os.path.abspath(inspect.getfile(
 DASHBOARD_BASE_URL='DASHBOARD_BASE_URL'
 DATABASE_URL='DATABASE_URL'
 WORKFLOW_URL='WORKFLOW_URL'
+BIN_CACHE_BYTES='BIN_CACHE_BYTES'
+BIN_CACHE_DIR='BIN_CACHE_DIR'
 # configured object keys
 DBENGINE='DBENGINE'
 SCOPED_SESSION='SCOPED_SESSION'
@@ -94,6 +94,7 @@ SESSION='SESSION'
 # configuration
 workflow_client = None
 session = None
+bin_cache = BinCache()
 
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker, scoped_session
@@ -127,6 +128,10 @@ def dashboard_config():
     global workflow_client
     workflow_url = current_app.config.get(WORKFLOW_URL)
     workflow_client = WorkflowClient(workflow_url)
+    # configure decoded bin cache
+    global bin_cache
+    bin_cache = BinCache(current_app.config.get(BIN_CACHE_BYTES, CACHE_BYTES),
+                         current_app.config.get(BIN_CACHE_DIR))
     # configure database session
     db_url = current_app.config.get(DATABASE_URL)
     dbengine = create_engine(db_url, pool_size=50, max_overflow=70, pool_recycle=3600)
@@ -197,7 +202,8 @@ def jsonr(obj):
 def ifcb():
     return get_resolver().ifcb
 
-@memoize(ttl=30)
+# target pids are parsed too, so allow for many entries
+@memoize(ttl=30,maxsize=8192)
 def parse_pid(pid):
     try:
         return next(ifcb().pid(pid))
@@ -214,39 +220,25 @@ def get_data_roots(ts_label, product_type='raw'):
 def get_timestamp(parsed_pid):
     return iso8601(strptime(parsed_pid[TIMESTAMP], parsed_pid[TIMESTAMP_FORMAT]))
 
-def get_unstitched_targets(adc, bin_pid):
-    us_targets = add_pids(adc.get_targets(),bin_pid)
-    for us_target in us_targets:
-        # claim all are unstitched
-        us_target[STITCHED] = False
-        yield us_target
-
-def get_targets(adc, bin_pid, stitched=True):
-    us_targets = list(get_unstitched_targets(adc, bin_pid))
-    if stitched:
-        return list_stitched_targets(us_targets)
-    else:
-        return us_targets
+def get_decoded_bin(paths, schema_version):
+    return bin_cache.get(paths, schema_version)
+
+def get_targets(decoded_bin, bin_pid, stitched=True, indexes=None):
+    return decoded_bin.get_targets(bin_pid, stitched, indexes)
 
 @memoize(ttl=30,key=lambda args: frozenset(args[0].items()))
 def get_fileset(parsed):
     time_series = parsed['ts_label']
     data_roots = list(get_data_roots(time_series))
-    return parsed_pid2fileset(parsed,data_roots)
+    with safe_session() as session:
+        return parsed_pid2fileset(parsed,data_roots,session)
 
 @memoize(ttl=30,key=lambda args: frozenset(args[0].items() + [args[1]]))
 def get_product_file(parsed, product_type):
-    parsed = dict(parsed.items())
     time_series = parsed['ts_label']
     data_roots = list(get_data_roots(time_series,product_type))
-    parsed['product'] = product_type
-    for root in data_roots:
-        try:
-            hit = next(get_resolver().ifcb.files.find_product(root=root,**parsed))
-            return hit['product_path']
-        except StopIteration:
-            pass
-    raise NotFound
+    with safe_session() as session:
+        return files.parsed_pid2product_file(parsed,product_type,data_roots,session)
 
 def serve_blob_bin(parsed):
     blob_zip = get_product_file(parsed, 'blobs')
@@ -456,7 +448,7 @@ def elapsed(ts_label,timestamp=None):
             except IndexError:
                 abort(404)
 
-def ts_metric(ts_label, callback, start=None, end=None, s=None):
+def ts_metric(ts_label, metric, start=None, end=None, s=None):
     if s is None:
         s = 86400
     if end is None:
@@ -465,10 +457,16 @@ def ts_metric(ts_label, callback, start=None, end=None, s=None):
         start = end - timedelta(seconds=s)
     with safe_session() as session:
         with Feed(session, ts_label) as feed:
+            resolution, rows = feed.metric_series(metric, start, end)
             result = []
-            for b in feed.time_range(start, end):
-                r = canonicalize_bin(b)
-                r.update(callback(b))
+            url_root = get_url_root()
+            for t, value, lid_or_count in rows:
+                r = { 'date': iso8601(t.timetuple()), metric: value }
+                if resolution is None:
+                    r['pid'] = canonicalize(url_root, feed.ts_label, lid_or_count)
+                else: # averaged over an hour or day
+                    r['bin_count'] = lid_or_count
+                    r['resolution'] = resolution
                 result.append(r)
             return Response(json.dumps(result), mimetype=MIME_JSON)
 
@@ -478,10 +476,8 @@ def ts_metric(ts_label, callback, start=None, end=None, s=None):
 @app.route('/<ts_label>/api/feed/<any(trigger_rate,temperature,humidity):metric>/end/<datetime:end>/last/<int:s>')
 @app.route('/<ts_label>/api/feed/<any(trigger_rate,temperature,humidity):metric>/start/<datetime:start>/end/<datetime:end>')
 def serve_metric_series(ts_label,metric,start=None,end=None,s=None):
-    # take advantage of the fact that bin attributes are named the same as our metric names here,
-    # and that they're all floating point
-    callback = lambda b: { metric: float(getattr(b,metric)) }
-    return ts_metric(ts_label,callback,start,end,s)
+    # long time ranges are served from hourly or daily rollups
+    return ts_metric(ts_label,metric,start,end,s)
 
 ## metric views ##
 
@@ -1017,9 +1013,9 @@ def serve_bad_stitch(pid):
         paths = get_fileset(req.parsed)
     except NotFound:
         abort(404)
-    adc = Adc(paths['adc_path'], req.schema_version)
-    targets = list(adc.get_targets())
-    stitched_targets = list_stitched_targets(targets)
+    decoded_bin = get_decoded_bin(paths, req.schema_version)
+    targets = decoded_bin.arrays
+    stitched_targets = decoded_bin.stitched_targets()
     if len(stitched_targets) == len(targets):
         # there never would have been a reason to stitch
         return r(False)
@@ -1090,7 +1086,10 @@ def serve_pid(pid):
         target_no = int(req.parsed['target'])
         if req.product=='features': # single roi features
             feature_csv = get_product_file(req.parsed, 'features')
-            j = get_roi_features_json(feature_csv, target_no)
+            try:
+                j = get_roi_features_json(feature_csv, target_no)
+            except KeyError:
+                abort(404)
             return Response(j,mimetype='application/json')
         # pull three targets, then find any stitched pair
         offset=target_no-1
@@ -1123,14 +1122,15 @@ def serve_pid(pid):
                 img = get_target_image(req.parsed, target, roi_path)
                 return serve_blob_image(req.parsed, mimetype, outline=True, target_img=img)
         # not an image, so get more metadata
-        targets = get_targets(adc, canonical_bin_pid, req.stitch)
+        decoded_bin = get_decoded_bin(paths, req.schema_version)
+        targets = get_targets(decoded_bin, canonical_bin_pid, req.stitch)
         # not an image, check for JSON
         if extension == 'json':
             return Response(json.dumps(target),mimetype=MIME_JSON)
         target = get_target_metadata(target,targets)
         target_ordered = [(k,target[k]) for k in order_keys(target, req.adc_cols)]
         # more metadata representations. we'll need the header
-        hdr = parse_hdr_file(hdr_path)
+        hdr = get_decoded_bin(paths, req.schema_version).hdr
         if extension == 'xml':
             return Response(target2xml(req.canonical_pid, target_ordered, req.timestamp, canonical_bin_pid), mimetype='text/xml')
         if extension == 'rdf':
@@ -1161,7 +1161,8 @@ def serve_pid(pid):
             abort(404)
         # gonna need targets unless heft is medium or below
         def get_req_targets():
-            return get_targets(adc, req.canonical_pid, req.stitch)
+            decoded_bin = get_decoded_bin(paths, req.schema_version)
+            return get_targets(decoded_bin, req.canonical_pid, req.stitch)
         # end of views
         # computed position metrics
         if req.product=='position':
@@ -1185,7 +1186,7 @@ def serve_pid(pid):
             lines = targets2csv(targets,req.adc_cols)
             return Response('\n'.join(lines)+'\n',mimetype='text/csv')
         # we'll need the header for the other representations
-        hdr = parse_hdr_file(hdr_path)
+        hdr = get_decoded_bin(paths, req.schema_version).hdr
         if req.extension in ['html', 'htm']:
             targets = list(get_req_targets())
             context, props = split_hdr(hdr)
@@ -1230,9 +1231,7 @@ def serve_pid(pid):
             except:
                 raise
             targets = get_req_targets()
-            buffer = BytesIO()
-            bin2zip(req.parsed,req.canonical_pid,targets,hdr,req.timestamp,roi_path,buffer)
-            data = buffer.getvalue()
+            data = bin2zip_stream(req.parsed,req.canonical_pid,targets,hdr,req.timestamp,roi_path)
             binzip_pid = next(ifcb().as_product(req.canonical_pid, 'binzip'))['pid']
             with safe_session() as session:
                 try:
@@ -1240,12 +1239,8 @@ def serve_pid(pid):
                 except NotFound:
                     binzip_path = None
             if binzip_path is not None:
-                try:
-                    os.makedirs(os.path.dirname(binzip_path))
-                except OSError: # usually because directory exists
-                    pass
-                with open(binzip_path,'wb') as fout:
-                    fout.write(data)
+                # write the zip to the product cache as it is served
+                data = save_product_stream(binzip_path, data)
             return Response(data, mimetype='application/zip')
     abort(404)
 
@@ -1275,7 +1270,29 @@ def save_product(destpath, data):
     with open(destpath_part,'w') as out:
         shutil.copyfileobj(StringIO(data), out)
     shutil.move(destpath_part, destpath)
-    
+
+def save_product_stream(destpath, chunks):
+    """pass through an iterable of chunks of data while saving them.
+    the file is only moved into place if all chunks are written"""
+    destpath_part = '%s_%s.part' % (destpath, gen_id())
+    try:
+        os.makedirs(os.path.dirname(destpath))
+    except:
+        pass
+    out = open(destpath_part,'wb')
+    def generate():
+        try:
+            for chunk in chunks:
+                out.write(chunk)
+                yield chunk
+            out.close()
+            shutil.move(destpath_part, destpath)
+        finally:
+            if not out.closed: # incomplete, e.g., client went away
+                out.close()
+                os.remove(destpath_part)
+    return generate()
+
 @app.route('/<url:pid>',methods=['PUT'])
 @api_roles_required('Admin')
 def deposit(pid):
@@ -1299,6 +1316,12 @@ def deposit(pid):
 
 #### scatterplots ####
 
+def json_number(v):
+    # NaN (e.g., an unparseable feature value) is not valid JSON
+    if isinstance(v, float) and np.isnan(v):
+        return None
+    return v
+
 def scatter_json(targets,bin_pid,x_axis,y_axis,features={}):
     # FIXME need a way to map between generic cols and schema-dependent cols
     points = []
@@ -1317,8 +1340,8 @@ def scatter_json(targets,bin_pid,x_axis,y_axis,features={}):
 
         point = {
             'roi_num': roi_num,
-            'x': x,
-            'y': y
+            'x': json_number(x),
+            'y': json_number(y)
         }
         points.append(point)
         
@@ -1336,9 +1359,7 @@ def get_features_schema(req, features_path=None):
         # will raise NotFound if not features file is found,
         # caller must catch to provide default value in this case
         features_path = get_product_file(req.parsed,'features')
-    features_source = LocalFileSource(features_path)
-    for row in read_csv(features_source, None, 0, 1):
-        return row
+    return dict(enumerate(get_features(features_path).names))
 
 @app.route('/<time_series>/api/plot/schema/pid/<url:pid>')
 def plot_schema(time_series, pid):
@@ -1356,11 +1377,6 @@ def plot_schema(time_series, pid):
     fc_tail = [c for c in feature_cols if is_tail_col(c)]
     return Response(json.dumps(adc_cols + fc_head + fc_tail), mimetype=MIME_JSON)
 
-def read_features(features_path):
-    features_source = LocalFileSource(features_path)
-    for row in read_csv(features_source, None, 1, NO_LIMIT):
-        yield row
-
 @app.route('/<time_series>/api/plot/<path:params>/pid/<url:pid>')
 @app.route('/<time_series>/api/plot/<path:params>/pid/<url:pid>')
 def scatter(time_series,params,pid):
@@ -1370,9 +1386,8 @@ def scatter(time_series,params,pid):
         paths = get_fileset(req.parsed)
     except NotFound:
         abort(404)
-    adc_path = paths['adc_path']
-    adc = Adc(adc_path, req.schema_version)
-    targets = get_targets(adc, req.canonical_pid, req.stitch)
+    decoded_bin = get_decoded_bin(paths, req.schema_version)
+    targets = get_targets(decoded_bin, req.canonical_pid, req.stitch)
     
     # check if we need to use features file
     features_targets = {}
@@ -1381,13 +1396,12 @@ def scatter(time_series,params,pid):
             features_path = get_product_file(req.parsed,'features')
         except NotFound:
             abort(404)
-        columns = get_features_schema(req, features_path)
-        for target in read_features(features_path):
-            new_target = {}
-            for i,v in columns.items():
-                new_target[v] = target[i]
-            # dict indexed by roi_number
-            features_targets[int(new_target['roi_number'])] = new_target
+        features = get_features(features_path)
+        axes = [a for a in [params['x'], params['y']] if a in features.names]
+        columns = [features.column(a).tolist() for a in axes]
+        # dict indexed by roi_number
+        for i, roi_number in enumerate(features.roi_numbers.tolist()):
+            features_targets[roi_number] = dict((a, c[i]) for a, c in zip(axes, columns))
         
     # handle some target views other than the standard ones
     if req.extension=='json':
@@ -1402,6 +1416,16 @@ def serve_wf_recent(n=None):
     r = workflow_client.most_recent(n)
     return Response(json.dumps(r), mimetype=MIME_JSON)
 
+#### caches ####
+
+MEMOIZED = [parse_pid, get_data_roots, get_fileset, get_product_file, get_features_schema]
+
+@app.route('/api/cache_stats')
+def serve_cache_stats():
+    r = dict((fn.__name__, fn.cache_info()) for fn in MEMOIZED)
+    r['bin_cache'] = bin_cache.cache_info()
+    return Response(json.dumps(r), mimetype=MIME_JSON)
+
 #### skipping and tagging ####
 
 def get_orm_bin(req):
@@ -1424,7 +1448,7 @@ def get_skip_flag(pid):
 
 def set_skip_flag(b,value):
     with safe_session() as session:
-        b.skip = value
+        rollups.set_skip(session, [b], value)
         session.commit()
         result = {
             'operation': 'set skip flag',
@@ -1453,12 +1477,11 @@ def _skip_or_unskip_day(ts_label, dt, skip=True):
     with safe_session() as session:
         with Feed(session, ts_label) as feed:
             bins = feed.day(dt,include_skip=True)
-            for b in bins:
-                b.skip = skip
-                session.commit()
-                r = {
-                    'day': iso8601(dt.timetuple())
-                }
+            rollups.set_skip(session, bins, skip)
+            session.commit()
+            r = {
+                'day': iso8601(dt.timetuple())
+            }
             return Response(json.dumps(r), mimetype=MIME_JSON)
 
 @app.route('/<ts_label>/api/skip_day/<datetime:dt>')
@@ -1473,22 +1496,23 @@ def unskip_day(ts_label,dt):
 
 #### mosaics #####
 
-def get_sorted_tiles(adc_path, schema_version, bin_pid):
-    # read ADC and convert to Tiles in size-descending order
-    def descending_size(t):
-        (w,h) = t.size
-        return 0 - (w * h)
-    adc = Adc(adc_path, schema_version)
+def get_mosaic_layout(paths, schema_version, bin_pid, scaled_size, page):
+    # all pages are laid out once per bin and size, largest targets first
+    # FIXME allow for non-geometric sort options
+    decoded_bin = get_decoded_bin(paths, schema_version)
     stitch = schema_version == SCHEMA_VERSION_1
-    tiles = [Tile(t, (t[HEIGHT], t[WIDTH])) for t in get_targets(adc, bin_pid, stitch)]
-    # FIXME instead of sorting tiles, sort targets to allow for non-geometric sort options
-    tiles.sort(key=descending_size)
-    return tiles
+    layout = bin_cache.get_layout(paths, schema_version, stitch, scaled_size)
+    return page_tiles(layout, lambda ix: get_targets(decoded_bin, bin_pid, stitch, ix), page)
 
-def get_mosaic_layout(adc_path, schema_version, bin_pid, scaled_size, page):
-    tiles = get_sorted_tiles(adc_path, schema_version, bin_pid)
-    # perform layout operation
-    return list(mosaic.layout(tiles, scaled_size, page, threshold=0.05))
+def get_mosaic_pyramid_dir(pid):
+    """directory of pre-rendered mosaic pages for a bin, or None"""
+    try:
+        product_pid = next(ifcb().as_product(pid,'mosaic'))['pid']
+        with safe_session() as session:
+            mosaic_path = files.get_product_destination(session, product_pid)
+        return os.path.splitext(mosaic_path)[0]
+    except (NotFound, StopIteration):
+        return None
 
 def layout2json(layout, scale):
     """Doesn't actually produce JSON but rather JSON-serializable representation of the tiles"""
@@ -1519,52 +1543,39 @@ def serve_mosaic_image(time_series=None, pid=None, params='/'):
     (w,h) = size
     parsed = parse_pid(pid)
     extension = parsed['extension']
-    # caching
-    default_mosaic = False
-    if w==800 and h==600 and scale==0.33 and page==1:
-        default_mosaic = True
-    cached_path = None
-    if default_mosaic and extension=='jpg':
-        try:
-            product_pid = next(ifcb().as_product(pid,'mosaic'))['pid']
-            with safe_session() as session:
-                cached_path = files.get_product_destination(session, product_pid)
-                if os.path.exists(cached_path):
-                    return Response(file(cached_path),direct_passthrough=True,mimetype='image/jpeg')
-        except NotFound:
-            pass
-        except StopIteration:
-            pass
+    # look for a pre-rendered page. the default mosaic (800x600, scale
+    # 0.33, page 1) is one of these; legacy cached mosaic images are not
+    # served, since their layout doesn't match the JSON layout
+    pyramid_dir, pyramid_page = None, False
+    if extension=='jpg':
+        pyramid_dir = get_mosaic_pyramid_dir(pid)
+        pyramid_page = size==PYRAMID_SIZE and scale in PYRAMID_SCALES
+    if pyramid_dir is not None:
+        page_path = pyramid_path(pyramid_dir, size, scale, page)
+        if os.path.exists(page_path):
+            return Response(file(page_path),direct_passthrough=True,mimetype='image/jpeg')
     # didn't find a cached version, need to make one
     schema_version = parsed['schema_version']
     try:
         paths = get_fileset(parsed)
     except NotFound:
         abort(404)
-    adc_path = paths['adc_path']
     roi_path = paths['roi_path']
     bin_pid = parsed['namespace'] + parsed['bin_lid']
     # perform layout operation
     scaled_size = (int(w/scale), int(h/scale))
-    layout = list(get_mosaic_layout(adc_path, schema_version, bin_pid, scaled_size, page))
+    layout = list(get_mosaic_layout(paths, schema_version, bin_pid, scaled_size, page))
     # serve JSON on request
     if extension == 'json':
         return Response(json.dumps(list(layout2json(layout, scale))), mimetype=MIME_JSON)
     mimetype = mimetypes.types_map['.' + extension]
-    # read all images needed for compositing and inject into Tiles
-    image_layout = []
-    with open(roi_path,'rb') as roi_file:
-        for tile in layout:
-            target = tile.image # in mosaic API, the record is called 'image'
-            # FIXME 1. replace PIL
-            image = get_target_image(parsed, target, file=roi_file, raw_stitch=True)
-            image_layout.append(Tile(PIL.Image.fromarray(image), tile.size, tile.position))
     # produce and serve composite image
-    mosaic_image = thumbnail(mosaic.composite(image_layout, scaled_size, mode='L', bgcolor=160), (w,h))
-    if cached_path is not None and mimetype=='image/jpeg':
-        save_product(cached_path, as_bytes(mosaic_image))
+    mosaic_image = render_page(layout, roi_path, size, scale)
+    image_bytes = as_bytes(mosaic_image, mimetype)
+    if pyramid_dir is not None and pyramid_page:
+        save_product(pyramid_path(pyramid_dir, size, scale, page), image_bytes)
     #pil_format = filename2format('foo.%s' % extension)
-    return Response(as_bytes(mosaic_image), mimetype=mimetype)
+    return Response(image_bytes, mimetype=mimetype)
 
 if __name__ == '__main__':
     from oii.ifcb2.session import dbengine
@@ -255,13 +255,20 @@ class Blob(object):
         return hausdorff_symmetry(self.rotated_image)
         
 class Roi(object):
-    def __init__(self,roi_image):
+    def __init__(self,roi_image,blobs_image=None):
+        """blobs_image, if given, is a previously computed
+        segmentation of roi_image (e.g., from a blob zip)"""
         self.image = np.array(roi_image).astype(np.uint8)
+        if blobs_image is not None:
+            blobs_image = np.array(blobs_image).astype(np.bool)
+        self._blobs_image = blobs_image
     @property
     @imemoize
     def blobs_image(self):
         """return the mask resulting from segmenting the image using
         the algorithm in oii.ifcb2.features.segmentation.segment_roi"""
+        if self._blobs_image is not None:
+            return self._blobs_image
         return segment_roi(self.image)
     @property
     @imemoize
@@ -280,11 +287,25 @@ class Roi(object):
         return image_hog(self.image)
     @property
     @imemoize
+    def ring_wedge_stats(self):
+        """power integral, ratio of central to total power, and
+        wedge and ring vectors. see oii.ifcb2.features.ringwedge"""
+        return ring_wedge(self.image)
+    @property
+    @imemoize
     def ring_wedge(self):
-        pwr_integral, pwr_ratio, wedges, rings = ring_wedge(self.image)
+        pwr_integral, pwr_ratio, wedges, rings = self.ring_wedge_stats
         return wedges, rings
     @property
     @imemoize
+    def rw_power_integral(self):
+        return self.ring_wedge_stats[0]
+    @property
+    @imemoize
+    def rw_power_ratio(self):
+        return self.ring_wedge_stats[1]
+    @property
+    @imemoize
     def wedge(self):
         return self.ring_wedge[0]
     @property
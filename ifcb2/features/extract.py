@@ -0,0 +1,275 @@
+"""Bin-level blob and feature extraction, replacing the MATLAB
+bin_blobs / bin_features pipeline. ROIs are read from local raw
+filesets and processed in a process pool; results are streamed into
+a blob zip and/or a features CSV (with its multiblob sidecar CSV) in
+target order."""
+import os
+from itertools import islice, izip
+from multiprocessing import Pool, cpu_count
+from StringIO import StringIO
+from zipfile import ZipFile, ZIP_STORED
+
+import numpy as np
+from PIL import Image
+
+from oii.image.io import as_bytes
+
+from oii.ifcb2 import SCHEMA_VERSION
+from oii.ifcb2.identifiers import add_pids, PID
+from oii.ifcb2.formats.adc import Adc, TARGET_NUMBER, SCHEMA_VERSION_1
+from oii.ifcb2.formats.roi import open_roi_file
+from oii.ifcb2.stitching import list_stitched_targets, STITCHED
+from oii.ifcb2.v1_stitching import stitch_targets
+from oii.ifcb2.features import Roi
+
+# how many ROIs to hand to the pool at a time, per process.
+# bounds the number of decoded images held in memory
+CHUNK_PER_PROCESS=16
+
+# feature names follow the v2 MATLAB features CSV. single-blob
+# features describe the largest blob; summed features are over all blobs
+BLOB_COLUMNS = [
+    'Area',
+    'Biovolume',
+    'BoundingBox_xwidth',
+    'BoundingBox_ywidth',
+    'ConvexArea',
+    'ConvexPerimeter',
+    'Eccentricity',
+    'EquivDiameter',
+    'Extent',
+    'H180',
+    'H90',
+    'Hflip',
+    'MajorAxisLength',
+    'MinorAxisLength',
+    'Orientation',
+    'Perimeter',
+    'RepresentativeWidth',
+    'Solidity',
+    'moment_invariant1',
+    'moment_invariant2',
+    'moment_invariant3',
+    'moment_invariant4',
+    'moment_invariant5',
+    'moment_invariant6',
+    'moment_invariant7',
+    'shapehist_mean_normEqD',
+    'shapehist_median_normEqD',
+    'shapehist_skewness_normEqD',
+    'shapehist_kurtosis_normEqD',
+    'texture_average_gray_level',
+    'texture_average_contrast',
+    'texture_smoothness',
+    'texture_third_moment',
+    'texture_uniformity',
+    'texture_entropy'
+]
+SUMMED_COLUMNS = [
+    'numBlobs',
+    'summedArea',
+    'summedBiovolume',
+    'summedConvexArea',
+    'summedConvexPerimeter',
+    'summedMajorAxisLength',
+    'summedMinorAxisLength',
+    'summedPerimeter'
+]
+ROI_COLUMNS = [
+    'RWhalfpowerintegral',
+    'RWcenter2total_powerratio'
+] + ['Wedge%02d' % (i+1) for i in range(48)] \
+  + ['Ring%02d' % (i+1) for i in range(50)] \
+  + ['HOG%02d' % (i+1) for i in range(81)]
+
+FEATURE_COLUMNS = ['roi_number'] + BLOB_COLUMNS + SUMMED_COLUMNS + ROI_COLUMNS
+
+# the multiblob CSV has a row for each blob of ROIs with more than one
+MULTIBLOB_COLUMNS = ['roi_number', 'blob_number'] + BLOB_COLUMNS
+
+def blob_zip_name(bin_lid):
+    return '%s_blobs_v2.zip' % bin_lid
+
+def features_csv_name(bin_lid):
+    return '%s_fea_v2.csv' % bin_lid
+
+def multiblob_csv_name(bin_lid):
+    return '%s_multiblob_v2.csv' % bin_lid
+
+def blob_features(B):
+    """features of a single Blob, in BLOB_COLUMNS order"""
+    h, w = B.shape
+    return [
+        B.area,
+        B.biovolume,
+        w,
+        h,
+        B.convex_area,
+        B.convex_perimeter,
+        B.eccentricity,
+        B.equiv_diameter,
+        B.extent
+    ] + list(B.hausdorff_symmetry) + [
+        B.major_axis_length,
+        B.minor_axis_length,
+        B.orientation,
+        np.sum(B.perimeter_image),
+        B.rep_transect,
+        B.solidity
+    ] + list(B.invmoments) \
+      + list(B.perimeter_stats) \
+      + list(B.texture_stats)
+
+def summed_features(blobs):
+    """features summed over all Blobs, in SUMMED_COLUMNS order"""
+    def total(fn):
+        return sum(fn(B) for B in blobs)
+    return [
+        len(blobs),
+        total(lambda B: B.area),
+        total(lambda B: B.biovolume),
+        total(lambda B: B.convex_area),
+        total(lambda B: B.convex_perimeter),
+        total(lambda B: B.major_axis_length),
+        total(lambda B: B.minor_axis_length),
+        total(lambda B: np.sum(B.perimeter_image))
+    ]
+
+def roi_features(R):
+    """all features of a Roi, in FEATURE_COLUMNS order (less roi_number)"""
+    blobs = R.blobs
+    if blobs:
+        row = blob_features(blobs[0])
+    else:
+        row = [0] * len(BLOB_COLUMNS)
+    row += summed_features(blobs)
+    wedges, rings = R.ring_wedge
+    row += [R.rw_power_integral, R.rw_power_ratio]
+    row += list(wedges) + list(rings) + list(R.hog.flatten())
+    return row
+
+def format_row(row):
+    return ','.join('%.10g' % v if isinstance(v,float) else str(v) for v in row)
+
+def multiblob_rows(roi_number, blobs):
+    """multiblob CSV rows (see MULTIBLOB_COLUMNS) for a ROI's blobs"""
+    if len(blobs) < 2:
+        return []
+    return [[roi_number, i+1] + blob_features(B) for i, B in enumerate(blobs)]
+
+def _extract_roi(args):
+    """worker process entry point. args is (roi_number, roi image,
+    blobs image or None, whether to encode blobs, whether to compute
+    features, whether to compute multiblob features); returns
+    (roi_number, blob PNG or None, CSV line or None, multiblob CSV lines)"""
+    roi_number, image, blobs_image, want_blobs, want_features, want_multiblob = args
+    R = Roi(image, blobs_image)
+    blob_png, line, multiblob_lines = None, None, []
+    if want_blobs:
+        blob_png = as_bytes(R.blobs_image.astype(np.uint8) * 255)
+    if want_features:
+        line = format_row([roi_number] + roi_features(R))
+    if want_multiblob:
+        multiblob_lines = [format_row(row) for row in multiblob_rows(roi_number, R.blobs)]
+    return roi_number, blob_png, line, multiblob_lines
+
+def list_targets(adc_path, schema_version, bin_pid):
+    """list targets in a bin, stitching them if the schema requires it"""
+    adc = Adc(adc_path, schema_version)
+    targets = add_pids(adc.get_targets(), bin_pid)
+    if schema_version == SCHEMA_VERSION_1:
+        return list_stitched_targets(targets)
+    targets = list(targets)
+    for target in targets:
+        target[STITCHED] = 0
+    return targets
+
+def target_images(targets, roi_path):
+    """generate (target, image) for each target,
+    stitching where necessary"""
+    roi_file = open_roi_file(roi_path)
+    for target, im in izip(targets, stitch_targets(targets, roi_file)):
+        # copy out of the memory map so the image can be pickled
+        yield target, np.array(im)
+
+def read_blob_zip(blob_zip_path):
+    """return a dict of target LID -> blob mask from a blob zip"""
+    blobs = {}
+    with ZipFile(blob_zip_path) as z:
+        for name in z.namelist():
+            lid, ext = os.path.splitext(name)
+            if ext != '.png':
+                continue
+            blobs[lid] = np.asarray(Image.open(StringIO(z.read(name)))) > 0
+    return blobs
+
+def extract_bin(parsed_pid, bin_pid, fileset, blob_zip=None, features_csv=None,
+                blob_zip_path=None, processes=None, log_callback=None, multiblob_csv=None):
+    """compute blobs and/or features for a bin from its raw fileset.
+    parsed_pid - result of parsing the bin pid
+    bin_pid - the canonical bin pid
+    fileset - dict with adc_path, roi_path
+    blob_zip - if not None, path of blob zip to write
+    features_csv - if not None, path of features CSV to write
+    multiblob_csv - if not None, path of multiblob CSV to write
+    blob_zip_path - if not None, path of an existing blob zip whose
+    masks will be used instead of segmenting the ROIs
+    processes - size of process pool (default: number of CPUs)"""
+    def log(msg):
+        if log_callback is not None:
+            log_callback(msg)
+    want_blobs = blob_zip is not None
+    want_features = features_csv is not None
+    want_multiblob = multiblob_csv is not None
+    if processes is None:
+        processes = cpu_count()
+    chunk_size = processes * CHUNK_PER_PROCESS
+    targets = list_targets(fileset['adc_path'], parsed_pid[SCHEMA_VERSION], bin_pid)
+    existing_blobs = {}
+    if blob_zip_path is not None:
+        log('reading blobs from %s' % blob_zip_path)
+        existing_blobs = read_blob_zip(blob_zip_path)
+    def job_args():
+        for target, image in target_images(targets, fileset['roi_path']):
+            target_lid = os.path.basename(target[PID])
+            yield (target[TARGET_NUMBER], image, existing_blobs.get(target_lid),
+                   want_blobs, want_features, want_multiblob)
+    lids = dict((t[TARGET_NUMBER], os.path.basename(t[PID])) for t in targets)
+    z, csv_out, multiblob_out = None, None, None
+    pool = Pool(processes)
+    try:
+        if want_blobs:
+            # PNGs are already compressed
+            z = ZipFile(blob_zip, 'w', ZIP_STORED, allowZip64=True)
+        if want_features:
+            csv_out = open(features_csv, 'w')
+            print >> csv_out, ','.join(FEATURE_COLUMNS)
+        if want_multiblob:
+            multiblob_out = open(multiblob_csv, 'w')
+            print >> multiblob_out, ','.join(MULTIBLOB_COLUMNS)
+        log('processing %d ROIs with %d processes' % (len(targets), processes))
+        args = job_args()
+        n = 0
+        while True:
+            chunk = list(islice(args, chunk_size))
+            if not chunk:
+                break
+            for roi_number, blob_png, line, multiblob_lines in pool.imap(_extract_roi, chunk):
+                if blob_png is not None:
+                    z.writestr(lids[roi_number] + '.png', blob_png)
+                if line is not None:
+                    print >> csv_out, line
+                for multiblob_line in multiblob_lines:
+                    print >> multiblob_out, multiblob_line
+            n += len(chunk)
+            log('processed %d of %d ROIs' % (n, len(targets)))
+    finally:
+        pool.terminate()
+        pool.join()
+        if z is not None:
+            z.close()
+        if csv_out is not None:
+            csv_out.close()
+        if multiblob_out is not None:
+            multiblob_out.close()
+    return len(targets)
@@ -3,6 +3,7 @@ import numpy as np
 from numpy.fft import fft2, fftshift
 
 from scipy.ndimage.interpolation import zoom
+from scipy.sparse import csr_matrix
 
 from skimage.draw import circle, polygon
 
@@ -24,8 +25,8 @@ def ring_mask(i,dim=_DIM):
     rmax = (i+1) * s
     c = (dim//2)+1
     mask = np.zeros((dim,dim),dtype=np.bool)
-    mask[circle(c,c,rmax)]=True
-    mask[circle(c,c,rmin)]=False
+    mask[circle(c,c,rmax,shape=mask.shape)]=True
+    mask[circle(c,c,rmin,shape=mask.shape)]=False
     return mask
     
 @memoize
@@ -54,7 +55,7 @@ def filter_masks(dim=_DIM):
     # the mask and filter generated here are the center of the fft
     # where most of the energy is found
     df = 1./((dim-1.)*6.45)
-    f = np.arange(-0.5/6.45, 0.5*1/6.45, df)
+    f = np.arange(dim) * df - 0.5/6.45
     I,J = np.meshgrid(f,f)
     d = I**2 + J**2
     mask = np.zeros((dim,dim),dtype=np.bool)
@@ -62,34 +63,61 @@ def filter_masks(dim=_DIM):
     filt=np.invert(mask)
     return mask, filt
     
-def ring_wedge(image,dim=_DIM):
-    # perform fft and scale its intensities to dim x dim
-    amp_trans = fftshift(fft2(image))
-    int_trans = np.real(amp_trans * np.conj(amp_trans))
-    z = (1.*dim/image.shape[0], 1.*dim/image.shape[1])
-    int_trans = zoom(int_trans,z,order=1) # bilinear
-    # now compute stats of filtered intensities
+@memoize
+def half_mask(dim=_DIM):
+    # only the bottom half of the power spectrum is used
+    return np.vstack((np.zeros(((dim//2)+1,dim)), np.ones((dim//2,dim)))).astype(np.bool)
+
+@memoize
+def ring_wedge_weights(dim=_DIM):
+    """sparse matrix with one row per wedge, one per ring, and a
+    final row for the central area, each selecting the pixels of a
+    flattened dim x dim power spectrum that contribute to it. wedges
+    exclude the central area, and wedges and rings use only the
+    bottom half. adjacent wedges can share boundary pixels, so this
+    is not a label image"""
     mask, filt = filter_masks(dim)
-    filter_img = mask * int_trans
-    # intensities inside central area
-    inner_int = np.sum(filter_img)
+    half = half_mask(dim)
+    rows = [wedge_mask(i,dim) & filt & half for i in range(48)]
+    rows += [ring_mask(i,dim) & half for i in range(50)]
+    rows.append(mask)
+    return csr_matrix(np.vstack([r.reshape((1,-1)) for r in rows]).astype(np.float))
+
+def power_spectra(images,dim=_DIM):
+    """power spectra of a stack of same-size images, scaled to
+    dim x dim. the FFT is computed for the whole stack at once"""
+    images = np.asarray(images)
+    amp_trans = fftshift(fft2(images),axes=(-2,-1))
+    int_trans = np.real(amp_trans * np.conj(amp_trans))
+    # scale each spectrum; a zoom factor of 1 along the stack
+    # axis leaves the images independent of each other
+    z = (1., 1.*dim/images.shape[1], 1.*dim/images.shape[2])
+    return zoom(int_trans,z,order=1) # bilinear
+
+def ring_wedge_batch(images,dim=_DIM):
+    """compute ring-wedge features for a stack of same-size images,
+    given as a 3d array or a list of 2d arrays.
+    returns arrays of the power integrals, power ratios, wedge
+    vectors (n x 48) and ring vectors (n x 50)"""
+    int_trans = power_spectra(images,dim)
+    n = int_trans.shape[0]
+    flat = int_trans.reshape((n,-1))
+    # one sparse product yields all wedges, rings and the central
+    # intensity for every image
+    sums = ring_wedge_weights(dim).dot(flat.T).T
+    wedge_vectors, ring_vectors, inner_int = sums[:,:48], sums[:,48:98], sums[:,98]
     # total intensity
-    total_int = np.sum(int_trans)
+    total_int = np.sum(flat,axis=1)
     # ratio between central intensity and total intensity
     pwr_ratio = inner_int / total_int
-    # now mask the intensities for wedge and ring calculations
-    wedge_int_trans = int_trans * filt # wedges exclude center
-    # only use the bottom half
-    half = np.vstack((np.zeros(((dim//2)+1,dim)), np.ones((dim//2,dim)))).astype(np.bool)
-    wedge_half = wedge_int_trans * half
-    ring_half = int_trans * half
-    # now compute unscaled wedge and ring vectors for all wedges and rings
-    # these represent the total power found in each ring / wedge
-    wedge_vector = np.array([np.sum(wedge_mask(i) * wedge_half) for i in range(48)])
-    ring_vector = np.array([np.sum(ring_mask(i) * ring_half) for i in range(50)])
     # compute power integral over wedge vectors and scale vectors by it
-    pwr_integral = np.sum(wedge_vector)
-    wedges = wedge_vector / pwr_integral
-    rings = ring_vector / pwr_integral
-    # return all features
+    pwr_integral = np.sum(wedge_vectors,axis=1)
+    wedges = wedge_vectors / pwr_integral[:,np.newaxis]
+    rings = ring_vectors / pwr_integral[:,np.newaxis]
     return pwr_integral, pwr_ratio, wedges, rings
+
+def ring_wedge(image,dim=_DIM):
+    """compute ring-wedge features for an image.
+    returns the power integral, power ratio, wedge vector and ring vector"""
+    pwr_integral, pwr_ratio, wedges, rings = ring_wedge_batch([image],dim)
+    return pwr_integral[0], pwr_ratio[0], wedges[0], rings[0]
@@ -4,7 +4,8 @@ from datetime import datetime, timedelta
 from sqlalchemy import and_, or_, not_, desc, func, cast, Numeric
 
 from oii.times import utcdtnow, datetime2utcdatetime
-from oii.ifcb2.orm import Bin, File
+from oii.ifcb2.orm import Bin, File, MetricRollup
+from oii.ifcb2.rollups import DAY, has_rollups, bucket_start, choose_resolution, metric_rollups, trigger_rate
 
 from oii.ifcb2.tagging import parse_ts_label_tags, normalize_tag
 
@@ -51,9 +52,19 @@ class Feed(object):
         day = dt.date()
         return self._ts_query(day, day + timedelta(days=1), include_skip).\
             order_by(Bin.sample_time)
+    def _use_rollups(self):
+        """rollups are per time series, so can't be used with tags"""
+        return not self.tags and has_rollups(self.session, self.ts_label)
     def daily_data_volume(self, start_time=None, end_time=None):
-        """data volume in GB per day over the given time range"""
+        """data volume in GB, bin count, and date per day over the given
+        time range"""
         start_time, end_time = _time_range_params(start_time, end_time)
+        if self._use_rollups():
+            return self.session.query(cast(MetricRollup.data_volume / 1073741824.0, Numeric(6,2)), MetricRollup.bin_count, func.DATE(MetricRollup.bucket)).\
+                filter(and_(MetricRollup.ts_label==self.ts_label, MetricRollup.resolution==DAY,
+                            MetricRollup.bucket >= bucket_start(start_time, DAY), MetricRollup.bucket <= end_time,
+                            MetricRollup.bin_count > 0)).\
+                order_by(MetricRollup.bucket)
         q = self.session.query(cast(func.sum(File.length) / 1073741824.0, Numeric(6,2)), func.count(File.id) / 3, func.DATE(Bin.sample_time)).\
             filter(and_(Bin.ts_label==self.ts_label, Bin.sample_time >= start_time, Bin.sample_time <= end_time, ~Bin.skip)).\
             filter(Bin.id==File.bin_id)
@@ -61,6 +72,28 @@ class Feed(object):
         q = q.group_by(func.DATE(Bin.sample_time)).\
             order_by(func.DATE(Bin.sample_time))
         return q
+    def metric_series(self, metric, start_time, end_time):
+        """values of a metric (trigger_rate, temperature, or humidity)
+        over a time range, per bin for short ranges and averaged per hour
+        or day for long ones. returns the resolution (None, 'hour', or
+        'day') and (time, value, bin lid or bin count) rows in time
+        order"""
+        resolution = choose_resolution(start_time, end_time)
+        if resolution is not None and self._use_rollups():
+            rows = metric_rollups(self.session, self.ts_label, metric, resolution, start_time, end_time)
+            return resolution, [(t, float(v), n) for t, v, n in rows]
+        # column-only query, without loading Bins
+        q = self._ts_query(start_time, end_time).\
+            with_entities(Bin.sample_time, Bin.lid, Bin.triggers, Bin.duration, Bin.temperature, Bin.humidity).\
+            order_by(Bin.sample_time)
+        rows = []
+        for t, lid, triggers, duration, temperature, humidity in q:
+            if metric == 'trigger_rate':
+                value = trigger_rate(triggers, duration)
+            else:
+                value = dict(temperature=temperature, humidity=humidity)[metric]
+            rows.append((t, float(value or 0), lid))
+        return None, rows
     def total_data_volume(self):
         q = self.session.query(func.sum(File.length)).join(Bin).\
             filter(Bin.ts_label==self.ts_label)
@@ -1,30 +1,188 @@
+import os
+import logging
+
+from sqlalchemy import and_
 from sqlalchemy.exc import InvalidRequestError
 
-from oii.ifcb2 import get_resolver, FILE_PATH, TS_LABEL
+from oii.ifcb2 import get_resolver, FILE_PATH, TS_LABEL, LID, BIN_LID
+from oii.ifcb2 import HDR, ADC, ROI, HDR_PATH, ADC_PATH, ROI_PATH
 from oii.ifcb2.identifiers import parse_pid, PRODUCT
-from oii.ifcb2.orm import DataDirectory, TimeSeries
+from oii.ifcb2.orm import DataDirectory, TimeSeries, IndexedFile
 
 from oii.ldr import pprint
 
+# fileset keys for each raw filetype
+FILESET_KEYS = {
+    HDR: HDR_PATH,
+    ADC: ADC_PATH,
+    ROI: ROI_PATH
+}
+
 class NotFound(Exception):
     pass
 
-def pid2fileset(pid,roots):
+### fileset index ###
+
+def index_files(session, root, lid, paths):
+    """record the locations of a bin's files in the fileset index.
+    paths maps filetypes (hdr, adc, roi, or a product type) to paths.
+    does not commit"""
+    existing = session.query(IndexedFile).\
+               filter(and_(IndexedFile.root==root, IndexedFile.lid==lid))
+    existing = dict((f.filetype, f) for f in existing)
+    for filetype, path in paths.items():
+        st = os.stat(path)
+        f = existing.get(filetype)
+        if f is None:
+            f = IndexedFile(root=root, lid=lid, filetype=filetype)
+            session.add(f)
+        f.path = path
+        f.length = st.st_size
+        f.mtime = st.st_mtime
+
+def index_fileset(session, root, fileset):
+    """record the location of a raw fileset (e.g., a solution of
+    ifcb.files.list_raw_filesets) in the fileset index. does not commit"""
+    paths = dict((ft, fileset[key]) for ft, key in FILESET_KEYS.items())
+    index_files(session, root, fileset[LID], paths)
+
+def index_data_directory(session, root, commit_every=1000, progress_callback=None):
+    """scan a raw data directory once and bring the fileset index up to date
+    with it, removing entries for filesets that are no longer present.
+    commits periodically. progress_callback, if given, is called with the
+    number of filesets indexed so far after each commit. returns the
+    number of filesets indexed"""
+    existing = {}
+    q = session.query(IndexedFile).\
+        filter(and_(IndexedFile.root==root, IndexedFile.filetype.in_(FILESET_KEYS.keys())))
+    for f in q:
+        existing[(f.lid, f.filetype)] = f
+    seen = set()
+    n = 0
+    for fileset in get_resolver().ifcb.files.list_raw_filesets(root):
+        lid = fileset[LID]
+        for filetype, key in FILESET_KEYS.items():
+            path = fileset[key]
+            st = os.stat(path)
+            f = existing.get((lid, filetype))
+            if f is None:
+                f = IndexedFile(root=root, lid=lid, filetype=filetype)
+                existing[(lid, filetype)] = f
+                session.add(f)
+            f.path = path
+            f.length = st.st_size
+            f.mtime = st.st_mtime
+            seen.add((lid, filetype))
+        n += 1
+        if n % commit_every == 0:
+            session.commit()
+            if progress_callback is not None:
+                progress_callback(n)
+    for key, f in existing.items():
+        if key not in seen:
+            session.delete(f)
+    session.commit()
+    return n
+
+def is_current(path, length, mtime):
+    """whether an indexed file is still at its path with the indexed
+    size and modification time"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return False
+    if length is None or mtime is None:
+        return False
+    return st.st_size == length and abs(st.st_mtime - float(mtime)) < 0.001
+
+def lookup_files(session, lid, roots, filetypes):
+    """look up the indexed locations of a bin's files in the given data roots.
+    returns paths by filetype from the first root (in the order given)
+    in which all the filetypes are indexed and unchanged, or None, in
+    which case the caller should fall back to the resolver"""
+    roots = list(roots)
+    if not roots:
+        return None
+    q = session.query(IndexedFile.root, IndexedFile.filetype, IndexedFile.path,
+                      IndexedFile.length, IndexedFile.mtime).\
+        filter(and_(IndexedFile.lid==lid,
+                    IndexedFile.root.in_(roots),
+                    IndexedFile.filetype.in_(filetypes)))
+    by_root = {}
+    for root, filetype, path, length, mtime in q:
+        by_root.setdefault(root, {})[filetype] = (path, length, mtime)
+    for root in roots:
+        entries = by_root.get(root, {})
+        if len(entries) < len(filetypes):
+            continue
+        if all(is_current(*e) for e in entries.values()):
+            return dict((ft, path) for ft, (path, _, _) in entries.items())
+        logging.warn('INDEX stale entry for %s in %s' % (lid, root))
+    return None
+
+def update_index(session, root, lid, paths):
+    """index_files, then commit. the index is only a cache,
+    so failing to update it is logged rather than raised"""
+    try:
+        index_files(session, root, lid, paths)
+        session.commit()
+    except Exception, e:
+        logging.warn('INDEX failed to index %s: %s' % (lid, e))
+        session.rollback()
+
+### resolution ###
+
+def pid2fileset(pid,roots,session=None):
     parsed_pid = parse_pid(pid)
-    return parsed_pid2fileset(parsed_pid,roots)
+    return parsed_pid2fileset(parsed_pid,roots,session)
 
-def parsed_pid2fileset(parsed_pid,roots):
+def parsed_pid2fileset(parsed_pid,roots,session=None):
+    """find a raw fileset in the given data roots. if an ORM session
+    is provided, consult the fileset index first and index what the
+    resolver finds on a miss"""
+    roots = list(roots)
+    lid = parsed_pid[BIN_LID]
+    if session is not None:
+        paths = lookup_files(session, lid, roots, FILESET_KEYS.keys())
+        if paths is not None:
+            return dict((FILESET_KEYS[ft], path) for ft, path in paths.items())
     paths = {}
     for root in roots:
         try:
             p = next(get_resolver().ifcb.files.find_raw_fileset(root=root,**parsed_pid))
             paths.update(p)
             if paths:
+                if session is not None:
+                    update_index(session, root, lid,
+                        dict((ft, paths[key]) for ft, key in FILESET_KEYS.items()))
                 return paths
         except StopIteration:
             pass # try the next one
     # we tried all roots and it's not there
-    raise NotFound('No raw data found for %s' % parsed_pid['bin_lid'])
+    raise NotFound('No raw data found for %s' % lid)
+
+def parsed_pid2product_file(parsed_pid,product_type,roots,session=None):
+    """find a product file in the given data roots. if an ORM session
+    is provided, consult the fileset index first and index what the
+    resolver finds on a miss"""
+    roots = list(roots)
+    lid = parsed_pid[BIN_LID]
+    if session is not None:
+        paths = lookup_files(session, lid, roots, [product_type])
+        if paths is not None:
+            return paths[product_type]
+    parsed = dict(parsed_pid.items())
+    parsed[PRODUCT] = product_type
+    for root in roots:
+        try:
+            hit = next(get_resolver().ifcb.files.find_product(root=root,**parsed))
+            path = hit['product_path']
+            if session is not None:
+                update_index(session, root, lid, {product_type: path})
+            return path
+        except StopIteration:
+            pass # try the next one
+    raise NotFound('No %s product found for %s' % (product_type, lid))
 
 def get_data_roots(session, ts_label, product_type='raw'):
     """get the data roots for a given time series label. requires an ORM session"""
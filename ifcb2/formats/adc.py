@@ -1,4 +1,9 @@
+import os
 import re
+import csv
+
+import numpy as np
+
 from oii.ifcb2 import get_resolver
 from oii.utils import memoize
 from oii.csvio import read_csv, NO_LIMIT
@@ -24,6 +29,15 @@ _TYPE_CONV = {
     'str': str
 }
 
+# numpy column types for schema types
+_NP_TYPES = {
+    int: np.int64,
+    float: np.float64
+}
+
+# how many ADC line indexes to keep in memory
+LINE_INDEX_CACHE_SIZE=256
+
 @memoize
 def get_schema(schema_version):
     hit = next(get_resolver().ifcb.adc.schema(schema_version),None)
@@ -48,9 +62,114 @@ def read_adc(adc_path, target_no=1, limit=-1, schema=None):
             row[TARGET_NUMBER] = target_number
             yield row
 
+def _split_adc_rows(adc_path):
+    """read all rows of an ADC file as a 2d array of field strings"""
+    with open(adc_path,'rb') as fin:
+        lines = [line for line in fin.read().splitlines() if line]
+    if not lines:
+        return np.zeros((0,0),dtype='S1')
+    n_fields = lines[0].count(',') + 1
+    if not '"' in lines[0]:
+        # fast path: all rows have the same number of unquoted fields
+        fields = ','.join(lines).split(',')
+        if len(fields) == len(lines) * n_fields:
+            return np.array(fields).reshape((len(lines), n_fields))
+    # general case, e.g., ragged or quoted rows
+    rows = list(csv.reader(lines))
+    n_fields = min(len(row) for row in rows)
+    return np.array([row[:n_fields] for row in rows])
+
+def read_adc_columns(adc_path, schema):
+    """Parse an ADC file in one pass into a numpy structured array
+    with one field per schema column, plus targetNumber. 0x0 targets
+    are excluded; targetNumber retains the row number of each target
+    in the ADC file (starting at 1)"""
+    cells = _split_adc_rows(adc_path)
+    schema = schema[:cells.shape[1]] # ignore trailing fields
+    columns = []
+    for i,(col,cast) in enumerate(schema):
+        if cast in _NP_TYPES:
+            columns.append((col, cells[:,i].astype(_NP_TYPES[cast])))
+        else:
+            columns.append((col, cells[:,i]))
+    columns.append((TARGET_NUMBER, np.arange(1, cells.shape[0]+1, dtype=np.int64)))
+    arrays = np.zeros(cells.shape[0], dtype=[(col,c.dtype) for col,c in columns])
+    for col,c in columns:
+        arrays[col] = c
+    # skip 0x0 targets
+    if WIDTH in arrays.dtype.names and HEIGHT in arrays.dtype.names:
+        arrays = arrays[arrays[WIDTH] * arrays[HEIGHT] > 0]
+    return arrays
+
+def read_last_row(adc_path, block_size=4096):
+    """return the fields of the last non-blank line of an ADC file,
+    reading backward from the end of the file, or None if there
+    are no lines"""
+    with open(adc_path,'rb') as fin:
+        fin.seek(0, os.SEEK_END)
+        end = fin.tell()
+        tail = ''
+        while end > 0:
+            start = max(0, end - block_size)
+            fin.seek(start)
+            tail = fin.read(end - start) + tail
+            end = start
+            lines = tail.rstrip().splitlines()
+            # the first line in the buffer may be partial
+            if len(lines) > 1 or (lines and end == 0):
+                return next(csv.reader([lines[-1]]))
+    return None
+
+def index_lines(adc_path):
+    """return the byte offsets and lengths (less line terminators)
+    of the non-blank lines of an ADC file, as numpy arrays. the nth
+    of these lines is target number n+1"""
+    with open(adc_path,'rb') as fin:
+        buf = np.frombuffer(fin.read(), dtype=np.uint8)
+    newlines = np.flatnonzero(buf == ord('\n'))
+    starts = np.concatenate(([0], newlines + 1))
+    ends = np.concatenate((newlines, [len(buf)]))
+    lengths = ends - starts
+    # don't count carriage returns of CRLF line endings
+    nonempty = lengths > 0
+    lengths[nonempty] -= buf[ends[nonempty] - 1] == ord('\r')
+    nonblank = lengths > 0
+    return starts[nonblank], lengths[nonblank]
+
+@memoize(maxsize=LINE_INDEX_CACHE_SIZE)
+def _get_line_index(adc_path, size, mtime):
+    return index_lines(adc_path)
+
+def get_line_index(adc_path):
+    """return the line index of an ADC file (see index_lines), using
+    the cached one unless the file has changed"""
+    stat = os.stat(adc_path)
+    return _get_line_index(adc_path, stat.st_size, stat.st_mtime)
+
+def read_targets(adc_path, target_no=1, limit=1, schema=None):
+    """read a range of targets from an ADC file, seeking directly to
+    the first of them using the file's line index. 0x0 targets are
+    skipped"""
+    if schema is None:
+        schema = get_schema(SCHEMA_VERSION_2)
+    starts, lengths = get_line_index(adc_path)
+    first = max(target_no, 1)
+    last = min(target_no + limit, len(starts) + 1) # exclusive
+    if first >= last:
+        return
+    with open(adc_path,'rb') as fin:
+        fin.seek(starts[first-1])
+        data = fin.read(starts[last-2] + lengths[last-2] - starts[first-1])
+    lines = [data[s:s+l] for s,l in zip(starts[first-1:last-1] - starts[first-1], lengths[first-1:last-1])]
+    for number, fields in zip(range(first, last), csv.reader(lines)):
+        target = dict((col, cast(value)) for (col,cast), value in zip(schema, fields))
+        # skip 0x0 targets
+        if target.get(WIDTH,1) * target.get(HEIGHT,1) > 0:
+            target[TARGET_NUMBER] = number
+            yield target
+
 def read_target(adc_path, target_no, schema=None):
-    adc_source = LocalFileSource(adc_path)
-    for target in read_adc(source, target_no, limit=1, schema_version=schema_version):
+    for target in read_targets(adc_path, target_no, 1, schema):
         return target
     raise KeyError('ADC data not found')
 
@@ -59,6 +178,7 @@ class Adc(object):
         self.adc_file = adc_file
         self.schema_version = schema_version
         self.schema = get_schema(schema_version)
+        self._arrays = None
     def _cast_target(self, target):
         # cast target metadata field to schema-appropriate types
         for k,v in target.items():
@@ -67,17 +187,33 @@ class Adc(object):
                 if t in _TYPE_CONV:
                     target[k] = _TYPE_CONV[t](v)
         return target
+    def as_arrays(self):
+        """return all targets as a numpy structured array
+        (see read_adc_columns). parsed once per Adc instance"""
+        if self._arrays is None:
+            self._arrays = read_adc_columns(self.adc_file, self.schema)
+        return self._arrays
     def get_targets(self, target=1, limit=NO_LIMIT):
         #gts_fn = get_resolver().ifcb.adc.get_targets
         #gts_fn(adc_file=self.adc_file, schema_version=self.schema_version)
-        for target in read_adc(self.adc_file, target, limit, self.schema):
-            yield self._cast_target(target)
+        arrays = self.as_arrays()
+        if target > 1 or limit != NO_LIMIT:
+            n = arrays[TARGET_NUMBER]
+            mask = n >= target
+            if limit != NO_LIMIT:
+                mask &= n < target + limit
+            arrays = arrays[mask]
+        names = arrays.dtype.names
+        for row in arrays.tolist():
+            yield dict(zip(names, row))
     def get_target(self, targetNumber=1):
         #gt_fn = get_resolver().ifcb.adc.get_target
         #target = next(gt_fn(adc_file=self.adc_file, schema_version=self.schema_version, target=targetNumber),None)
-        target = read_target(self.adc_file, target, self.schema)
+        target = read_target(self.adc_file, targetNumber, self.schema)
         return self._cast_target(target)
     def get_some_targets(self, offset=1, limit=1):
-        for target in self.get_targets(target=offset, limit=limit):
+        """targets numbered offset through offset+limit-1, read
+        without parsing the rest of the ADC file"""
+        for target in read_targets(self.adc_file, offset, limit, self.schema):
             yield self._cast_target(target)
 
@@ -0,0 +1,144 @@
+"""columnar access to features CSV files.
+the first time a features CSV is read, its values are parsed into a
+column-major matrix stored in a sidecar .npy file next to it, with an
+index of roi number to row and byte offset in another sidecar file.
+both are rebuilt if the CSV changes. the matrix is memory-mapped, so
+only the index of each cached features file is held in memory, and
+reading a column reads only that column from disk"""
+import os
+import csv
+import logging
+
+import numpy as np
+
+from oii.utils import memoize
+
+ROI_NUMBER='roi_number'
+
+# sidecar files are named by appending these to the features CSV path
+SIDECAR_SUFFIX='.idx.npz'
+MATRIX_SUFFIX='.matrix.npy'
+
+# how many features file indexes to keep in memory
+FEATURES_CACHE_SIZE=32
+
+def _to_float(value):
+    try:
+        return float(value)
+    except ValueError:
+        return np.nan
+
+class Features(object):
+    def __init__(self, csv_path, names, offsets, matrix):
+        """names - column names
+        offsets - byte offset of each row's line in the CSV file
+        matrix - values, one row per line, usually memory-mapped"""
+        self.csv_path = csv_path
+        self.names = list(names)
+        self.offsets = offsets
+        self.matrix = matrix
+        self.roi_numbers = matrix[:,self.names.index(ROI_NUMBER)].astype(np.int64)
+        self._rows = dict((n,i) for i,n in enumerate(self.roi_numbers.tolist()))
+    def __len__(self):
+        return len(self.roi_numbers)
+    def row(self, roi_number):
+        """the row index for a roi number. raises KeyError if absent"""
+        return self._rows[roi_number]
+    def column(self, name):
+        """all values of the named column. raises KeyError if absent"""
+        try:
+            return np.array(self.matrix[:,self.names.index(name)])
+        except ValueError:
+            raise KeyError(name)
+    def line(self, roi_number):
+        """the unparsed CSV line for a roi number"""
+        with open(self.csv_path,'rb') as fin:
+            fin.seek(self.offsets[self.row(roi_number)])
+            return fin.readline().rstrip('\r\n')
+
+def parse_features(csv_path):
+    """parse a features CSV file into a Features object"""
+    with open(csv_path,'rb') as fin:
+        data = fin.read()
+    lines = data.splitlines(True)
+    offsets = np.cumsum([0] + [len(l) for l in lines])[:-1]
+    names = next(csv.reader(lines[:1]))
+    rows, row_offsets = [], []
+    for line, offset in zip(lines[1:], offsets[1:]):
+        if not line.strip():
+            continue
+        rows.append([_to_float(v) for v in next(csv.reader([line]))][:len(names)])
+        row_offsets.append(offset)
+    # column-major, so that each column is contiguous in the sidecar
+    matrix = np.asfortranarray(np.array(rows, dtype=np.float64).reshape((len(rows), len(names))))
+    return Features(csv_path, names, np.array(row_offsets, dtype=np.int64), matrix)
+
+def sidecar_path(csv_path):
+    return csv_path + SIDECAR_SUFFIX
+
+def matrix_path(csv_path):
+    return csv_path + MATRIX_SUFFIX
+
+def _write(path, write_fn):
+    part = '%s.%d.part' % (path, os.getpid())
+    try:
+        with open(part,'wb') as fout:
+            write_fn(fout)
+        os.rename(part, path)
+        return True
+    except (IOError, OSError), e:
+        logging.warn('FEATURES cannot write %s: %s' % (path, e))
+        try:
+            os.remove(part)
+        except OSError:
+            pass
+        return False
+
+def save_sidecar(features, stat):
+    """write the sidecars for a Features object, given the os.stat
+    of its CSV file. the index is written last, so that a current
+    index implies a current matrix. returns False if they can't be
+    written"""
+    csv_path = features.csv_path
+    if not _write(matrix_path(csv_path), lambda fout: np.save(fout, features.matrix)):
+        return False
+    return _write(sidecar_path(csv_path), lambda fout:
+        np.savez(fout, names=np.array(features.names), offsets=features.offsets,
+                 source=np.array([stat.st_size, stat.st_mtime])))
+
+def load_sidecar(csv_path, stat):
+    """read the sidecars for a features CSV file, given its os.stat,
+    memory-mapping the matrix. returns None if there are none or
+    they are stale"""
+    try:
+        with np.load(sidecar_path(csv_path)) as npz:
+            size, mtime = npz['source']
+            if size != stat.st_size or mtime != stat.st_mtime:
+                return None
+            names, offsets = npz['names'].tolist(), npz['offsets']
+        matrix = np.load(matrix_path(csv_path), mmap_mode='r')
+        if matrix.shape != (len(offsets), len(names)):
+            return None
+        return Features(csv_path, names, offsets, matrix)
+    except (IOError, OSError, KeyError, ValueError):
+        return None
+
+@memoize(maxsize=FEATURES_CACHE_SIZE)
+def _get_features(csv_path, size, mtime):
+    stat = os.stat(csv_path)
+    features = load_sidecar(csv_path, stat)
+    if features is None and save_sidecar(parse_features(csv_path), stat):
+        features = load_sidecar(csv_path, stat)
+    return features
+
+def get_features(csv_path):
+    """return the Features for a features CSV file, using the
+    in-memory cache or sidecars if they are current"""
+    stat = os.stat(csv_path)
+    features = _get_features(csv_path, stat.st_size, stat.st_mtime)
+    if features is None:
+        # sidecars can't be written here, so parse without caching,
+        # rather than keeping whole matrices in memory
+        features = parse_features(csv_path)
+    return features
+
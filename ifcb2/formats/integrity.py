@@ -2,72 +2,103 @@ import sys
 import os
 import logging
 
+import numpy as np
+
 from oii.utils import remove_extension
 from oii.ifcb2 import HDR, ADC, ROI
 from oii.ifcb2.formats.hdr import parse_hdr_file
 from oii.ifcb2.formats.adc import Adc, TRIGGER, BOTTOM, LEFT, SCHEMA_VERSION_2, BYTE_OFFSET, WIDTH, HEIGHT
+from oii.ifcb2.formats.adc import read_last_row
 
 class IntegrityException(Exception):
     pass
 
 def check_hdr(hdr_path):
+    """returns the parsed header"""
     try:
-        parse_hdr_file(hdr_path)
+        return parse_hdr_file(hdr_path)
     except Exception, e:
         raise IntegrityException('.hdr failed: ' + str(e)), None, sys.exc_info()[2]
 
-def check_adc(adc_path, schema_version=SCHEMA_VERSION_2):
-    adc = Adc(adc_path, schema_version)
-    def gen_targets():
-        (prev_bottom, prev_left, prev_trigger) = (None, None, None)
-        (pairs, colocated_pairs) = (0, 0)
-        for target in adc.get_targets():
-            (bottom, left, trigger) = (target[BOTTOM], target[LEFT], target[TRIGGER])
-            if trigger == prev_trigger:
-                pairs += 1
-            if (bottom, left, trigger) == (prev_bottom, prev_left, prev_trigger):
-                colocated_pairs += 1
-            (prev_bottom, prev_left, prev_trigger) = (bottom, left, trigger)
-            yield target
-        if pairs > 0 and pairs == colocated_pairs:
-            raise IntegrityException('.adc stitching problem')
+def check_stitching(targets):
+    """given the targets of an ADC file as a structured array (see
+    oii.ifcb2.formats.adc.read_adc_columns), check that if any
+    targets share a trigger, not all such pairs are co-located"""
+    trigger, bottom, left = targets[TRIGGER], targets[BOTTOM], targets[LEFT]
+    same_trigger = trigger[1:] == trigger[:-1]
+    pairs = np.sum(same_trigger)
+    colocated_pairs = np.sum(same_trigger & (bottom[1:] == bottom[:-1]) & (left[1:] == left[:-1]))
+    if pairs > 0 and pairs == colocated_pairs:
+        raise IntegrityException('.adc stitching problem')
+
+def check_adc_arrays(adc_path, schema_version=SCHEMA_VERSION_2):
+    """parse and check an ADC file, returning its targets as a
+    structured array"""
     try:
-        # call list(gen_targets()) so that it can raise an exception
-        # before any target is yielded
-        return list(gen_targets())
+        targets = Adc(adc_path, schema_version).as_arrays()
+        check_stitching(targets)
+        return targets
     except Exception, e:
         raise IntegrityException('.adc failed: ' + str(e)), None, sys.exc_info()[2]
 
+def check_adc(adc_path, schema_version=SCHEMA_VERSION_2):
+    targets = check_adc_arrays(adc_path, schema_version)
+    names = targets.dtype.names
+    return [dict(zip(names, row)) for row in targets.tolist()]
+
 def check_roi(roi_path, targets):
+    """targets can be a list of target dicts or a structured array"""
     roi_length = os.path.getsize(roi_path)
-    pos = -1
-    for target in targets:
-        if pos == -1:
-            pos = target[BYTE_OFFSET]
-        # skip to next target
-        skip = target[BYTE_OFFSET] - pos
-        if skip < 0:
-            raise IntegrityException('.roi byte offsets non-monotonic: %d < %d' % (target[BYTE_OFFSET], pos))
-        pos += skip
-        target_size = target[HEIGHT] * target[WIDTH]
-        pos += target_size
-        if pos > roi_length:
-            raise IntegrityException('.roi byte offset longer than ROI file: %d > %d' % (pos, roi_length))
+    if len(targets) == 0:
+        return
+    if isinstance(targets, np.ndarray):
+        offsets = targets[BYTE_OFFSET].astype(np.int64)
+        sizes = targets[HEIGHT].astype(np.int64) * targets[WIDTH]
+    else:
+        offsets = np.array([t[BYTE_OFFSET] for t in targets], dtype=np.int64)
+        sizes = np.array([t[HEIGHT] * t[WIDTH] for t in targets], dtype=np.int64)
+    ends = offsets + sizes
+    # each target must start at or after the end of the previous one
+    # and end within the ROI file. report whichever problem a
+    # sequential scan would have found first
+    bad_offset = np.flatnonzero(offsets[1:] < ends[:-1]) + 1
+    bad_end = np.flatnonzero(ends > roi_length)
+    if len(bad_offset) and (not len(bad_end) or bad_offset[0] <= bad_end[0]):
+        i = bad_offset[0]
+        raise IntegrityException('.roi byte offsets non-monotonic: %d < %d' % (offsets[i], ends[i-1]))
+    if len(bad_end):
+        i = bad_end[0]
+        raise IntegrityException('.roi byte offset longer than ROI file: %d > %d' % (ends[i], roi_length))
 
-def check_fileset(fileset, schema_version=SCHEMA_VERSION_2):
+def check_bin(fileset, schema_version=SCHEMA_VERSION_2):
+    """check the integrity of a fileset in one pass over each file,
+    and summarize it. returns a dict with the parsed header (hdr),
+    number of ROIs (rois), and, from the last line of the ADC file,
+    the trigger count (triggers) and duration in seconds (duration)"""
     hdr_path = fileset[HDR]
     adc_path = fileset[ADC]
     roi_path = fileset[ROI]
     lid = remove_extension(os.path.basename(hdr_path))
     try:
-        check_hdr(hdr_path)
+        hdr = check_hdr(hdr_path)
         logging.info('PASS %s hdr %s' % (lid, hdr_path))
-        targets = check_adc(adc_path, schema_version=schema_version)
+        targets = check_adc_arrays(adc_path, schema_version=schema_version)
         logging.info('PASS %s adc %s' % (lid, adc_path))
         check_roi(roi_path, targets)
         logging.info('PASS %s roi %s' % (lid, roi_path))
     except IntegrityException, e:
         logging.info('%s FAIL %s' % (lid, e))
         raise
+    summary = dict(hdr=hdr, rois=len(targets), triggers=None, duration=None)
+    # 0x0 targets are not in the structured array, so read the last line
+    last_row = read_last_row(adc_path)
+    if last_row is not None:
+        try:
+            summary['triggers'] = int(last_row[0])
+            summary['duration'] = float(last_row[1])
+        except (IndexError, ValueError):
+            logging.info('%s cannot parse trigger/duration from last line' % lid)
+    return summary
 
-
+def check_fileset(fileset, schema_version=SCHEMA_VERSION_2):
+    check_bin(fileset, schema_version)
@@ -1,3 +1,7 @@
+import os
+from threading import Lock
+from collections import OrderedDict
+
 import numpy as np
 
 from PIL import Image
@@ -8,6 +12,9 @@ from StringIO import StringIO
 
 ROI='roi'
 
+# how many memory-mapped ROI files to keep open for reuse
+ROI_FILE_CACHE_SIZE=16
+
 def as_pil(array_or_image):
     try:
         return Image.fromarray(array_or_image)
@@ -31,12 +38,16 @@ def read_roi(source, target):
 
 def read_rois(targets,roi_path=None,roi_file=None):
     """roi_path = pathname of ROI file,
-    roi_file = already open ROI file"""
-    if roi_file is None:
-        fp = open(roi_path,'rb')
-    else:
-        fp = roi_file
-    for target in sorted(targets, key=lambda t: t[BYTE_OFFSET]):
+    roi_file = already open ROI file, or RoiFile"""
+    targets = sorted(targets, key=lambda t: t[BYTE_OFFSET])
+    if roi_file is None and roi_path is not None:
+        roi_file = open_roi_file(roi_path)
+    if isinstance(roi_file, RoiFile):
+        for image in roi_file.get_images(targets):
+            yield image
+        return
+    fp = roi_file
+    for target in targets:
         w = target[WIDTH]
         h = target[HEIGHT]
         size = w * h
@@ -46,5 +57,74 @@ def read_rois(targets,roi_path=None,roi_file=None):
             fp.seek(target[BYTE_OFFSET])
             pixel_data = StringIO(fp.read(size)).getvalue()
             yield np.fromstring(pixel_data,np.uint8).reshape((w,h)) # rotate 90 deg
-    if roi_path is not None:
-        fp.close()
+
+class RoiFile(object):
+    """Memory-mapped ROI file. ROI images are returned as read-only uint8
+    views into the mapped file, so no per-image read or copy is done.
+    Views remain valid as long as they are referenced, even after close()"""
+    def __init__(self, roi_path):
+        self.roi_path = roi_path
+        if os.path.getsize(roi_path) == 0:
+            self._data = np.zeros(0, dtype=np.uint8) # cannot map an empty file
+        else:
+            self._data = np.memmap(roi_path, dtype=np.uint8, mode='r')
+    def __len__(self):
+        return self._data.size
+    def get_image(self, byte_offset, width, height):
+        """return the image at the given byte offset and size as a
+        (width, height) uint8 view"""
+        size = width * height
+        if size == 0:
+            raise KeyError('no ROI data for target')
+        if byte_offset < 0 or byte_offset + size > self._data.size:
+            raise KeyError('ROI data out of range of ROI file')
+        # rotate 90 deg
+        return np.asarray(self._data[byte_offset:byte_offset+size]).reshape((width,height))
+    def __getitem__(self, target):
+        """target should be a dictionary (or structured array row)
+        containing BYTE_OFFSET, WIDTH, and HEIGHT"""
+        return self.get_image(int(target[BYTE_OFFSET]), int(target[WIDTH]), int(target[HEIGHT]))
+    def get_images(self, targets):
+        """return images for many targets at once, in the order given.
+        targets can be a sequence of target dicts or a structured array
+        with BYTE_OFFSET, WIDTH, and HEIGHT columns (see Adc.as_arrays).
+        0x0 targets yield None"""
+        try:
+            offsets, widths, heights = targets[BYTE_OFFSET], targets[WIDTH], targets[HEIGHT]
+        except (TypeError, ValueError, IndexError):
+            offsets = [t[BYTE_OFFSET] for t in targets]
+            widths = [t[WIDTH] for t in targets]
+            heights = [t[HEIGHT] for t in targets]
+        images = []
+        for o,w,h in zip(np.asarray(offsets).tolist(), np.asarray(widths).tolist(), np.asarray(heights).tolist()):
+            if w * h == 0:
+                images.append(None)
+            else:
+                images.append(self.get_image(o,w,h))
+        return images
+    def close(self):
+        # release our reference to the mapping; outstanding views keep it alive
+        self._data = np.zeros(0, dtype=np.uint8)
+    def __enter__(self):
+        return self
+    def __exit__(self, type, value, traceback):
+        pass # leave open, it may be shared (see open_roi_file)
+
+_roi_files = OrderedDict()
+_roi_files_lock = Lock()
+
+def open_roi_file(roi_path):
+    """return a RoiFile for the given path, reusing a previously
+    opened one if the file has not changed since it was mapped.
+    the most recently used ROI_FILE_CACHE_SIZE files are kept open"""
+    st = os.stat(roi_path)
+    key = (roi_path, st.st_size, st.st_mtime)
+    with _roi_files_lock:
+        try:
+            roi_file = _roi_files.pop(key)
+        except KeyError:
+            roi_file = RoiFile(roi_path)
+        _roi_files[key] = roi_file # most recently used goes last
+        while len(_roi_files) > ROI_FILE_CACHE_SIZE:
+            _roi_files.popitem(last=False)
+        return roi_file
@@ -3,8 +3,13 @@ import struct
 from array import array
 
 from oii.ifcb2.formats.adc import BYTE_OFFSET, HEIGHT, WIDTH
+from oii.ifcb2.formats.roi import RoiFile, open_roi_file
 
 def read_roi_image(byte_offset, width, height, open_roi_file):
+    """open_roi_file can be an open file or a RoiFile;
+    in the latter case a read-only view is returned"""
+    if isinstance(open_roi_file, RoiFile):
+        return open_roi_file.get_image(byte_offset, width, height)
     length = width * height
     image_data = array('B')
     open_roi_file.seek(byte_offset)
@@ -13,8 +18,7 @@ def read_roi_image(byte_offset, width, height, open_roi_file):
 
 def read_target_image(parsed_target, path=None, file=None):
     if path is not None:
-        with open(path,'rb') as open_roi_file:
-            return read_roi_image(parsed_target[BYTE_OFFSET], parsed_target[WIDTH], parsed_target[HEIGHT], open_roi_file)
+        roi_file = open_roi_file(path)
+        return read_roi_image(parsed_target[BYTE_OFFSET], parsed_target[WIDTH], parsed_target[HEIGHT], roi_file)
     else:
         return read_roi_image(parsed_target[BYTE_OFFSET], parsed_target[WIDTH], parsed_target[HEIGHT], file)
-
@@ -0,0 +1,167 @@
+"""precomputed mosaic layouts for bins. all pages of a bin's mosaic
+at a given page size are packed at once, and the result is kept as a
+compact index (target index, page, and position arrays) from which
+any page can be rendered at any scale without packing again. pages
+can also be pre-rendered into a "pyramid" of images at several scales
+that can be served as static files"""
+import os
+
+import numpy as np
+from PIL import Image
+
+from oii.image.mosaic import Tile, X, Y
+from oii.image.mosaic.binpacking import pack_pages
+
+from oii.ifcb2.formats.adc import HEIGHT, WIDTH
+from oii.ifcb2.formats.roi import open_roi_file
+from oii.ifcb2.stitching import PAIR, stitch_raw
+
+# how many pages to try fitting each target on before starting another.
+# see oii.image.mosaic.binpacking.pack_pages
+LAYOUT_OPEN_PAGES=4
+
+# mosaic background and stitching gap fill
+BACKGROUND=160
+GAP_FILL=180
+
+# page size and scales of pre-rendered mosaic pages
+PYRAMID_SIZE=(800,600)
+PYRAMID_SCALES=(0.33, 0.5, 1.0)
+
+# change when the packing algorithm changes, so that pages rendered
+# with another layout (whose JSON layouts would not match) are not served
+LAYOUT_VERSION=2
+
+class MosaicLayout(object):
+    def __init__(self, size, indexes, pages, xs, ys):
+        """size - (w,h) of each page, in unscaled pixels
+        indexes - index in the bin's target list of each placed target
+        pages - page of each placed target, starting at 1
+        xs, ys - position of each placed target on its page
+        placed targets are in page order, and packing order within
+        each page"""
+        self.size = tuple(size)
+        self.indexes = np.asarray(indexes, dtype=np.int32)
+        self.pages = np.asarray(pages, dtype=np.int32)
+        self.xs = np.asarray(xs, dtype=np.int32)
+        self.ys = np.asarray(ys, dtype=np.int32)
+    @property
+    def page_count(self):
+        if len(self.pages) == 0:
+            return 0
+        return int(self.pages[-1])
+    def page(self, page):
+        """return (indexes, xs, ys) of the targets on a page"""
+        start, end = np.searchsorted(self.pages, [page, page + 1])
+        return self.indexes[start:end], self.xs[start:end], self.ys[start:end]
+    def save(self, fout):
+        np.savez(fout, size=np.array(self.size), indexes=self.indexes,
+                 pages=self.pages, xs=self.xs, ys=self.ys)
+    @classmethod
+    def load(cls, fin):
+        with np.load(fin) as npz:
+            return cls(npz['size'].tolist(), npz['indexes'], npz['pages'], npz['xs'], npz['ys'])
+
+def compute_layout(targets, size, open_pages=LAYOUT_OPEN_PAGES):
+    """pack all of a list of targets into pages of the given (w,h)
+    size, largest first, and return a MosaicLayout"""
+    # tiles are rotated 90 degrees, like the ROI images
+    tile_widths = np.array([t[HEIGHT] for t in targets], dtype=np.int64)
+    tile_heights = np.array([t[WIDTH] for t in targets], dtype=np.int64)
+    # stable, so equal sized targets stay in target order
+    order = np.argsort(-(tile_widths * tile_heights), kind='mergesort')
+    pages, xs, ys = pack_pages(tile_widths[order], tile_heights[order], size, open_pages)
+    # group by page, keeping packing order within each page
+    placed = np.flatnonzero(pages > 0)
+    placed = placed[np.argsort(pages[placed], kind='mergesort')]
+    return MosaicLayout(size, order[placed], pages[placed], xs[placed], ys[placed])
+
+def page_tiles(layout, targets, page):
+    """return positioned Tiles for one page of a layout, given the
+    bin's targets as a list or a function from indexes to targets"""
+    indexes, xs, ys = layout.page(page)
+    if callable(targets):
+        page_targets = targets(indexes.tolist())
+    else:
+        page_targets = [targets[i] for i in indexes.tolist()]
+    return [Tile(t, (t[HEIGHT], t[WIDTH]), (x, y))
+            for t, x, y in zip(page_targets, xs.tolist(), ys.tolist())]
+
+def tile_image(target, roi_file):
+    """image of a target for mosaics; stitched pairs are not gap filled"""
+    if PAIR in target:
+        pair = target[PAIR]
+        return stitch_raw(pair, roi_file.get_images(pair), background=GAP_FILL)
+    return roi_file[target]
+
+def area_weights(n_in, n_out):
+    """an n_out x n_in matrix that resamples a line of n_in pixels to
+    n_out pixels, averaging the input pixels each output pixel covers"""
+    edges = np.arange(n_out + 1) * (float(n_in) / n_out)
+    lo, hi = edges[:-1,np.newaxis], edges[1:,np.newaxis]
+    j = np.arange(n_in)
+    weights = np.clip(np.minimum(j + 1, hi) - np.maximum(j, lo), 0, None)
+    return weights / weights.sum(axis=1)[:,np.newaxis]
+
+def resample(image, (w,h)):
+    """resample a 2d uint8 array to w columns and h rows by area
+    averaging"""
+    (rows, cols) = image.shape
+    if (cols, rows) == (w, h):
+        return image
+    out = np.dot(np.dot(area_weights(rows, h), image), area_weights(cols, w).T)
+    return np.clip(np.round(out), 0, 255).astype(np.uint8)
+
+def composite_page(tiles, roi_file, scaled_size, size):
+    """composite positioned tiles laid out on a page of scaled_size onto
+    a uint8 array of the given (w,h) size. each tile is resampled once
+    to its place in the output, so no full-size page is ever made"""
+    (w,h) = size
+    fx, fy = float(w) / scaled_size[X], float(h) / scaled_size[Y]
+    canvas = np.empty((h,w), dtype=np.uint8)
+    canvas.fill(BACKGROUND)
+    for tile in tiles:
+        (x,y), (tw,th) = tile.position, tile.size
+        # round both edges, so adjacent tiles stay adjacent
+        x0, y0 = min(int(round(x * fx)), w - 1), min(int(round(y * fy)), h - 1)
+        x1 = min(max(int(round((x + tw) * fx)), x0 + 1), w)
+        y1 = min(max(int(round((y + th) * fy)), y0 + 1), h)
+        canvas[y0:y1,x0:x1] = resample(tile_image(tile.image, roi_file), (x1 - x0, y1 - y0))
+    return canvas
+
+def render_page(tiles, roi_path, size, scale):
+    """composite the tiles of one page, laid out at 1/scale of size,
+    into an image of the given size. returns a PIL image"""
+    scaled_size = (int(size[X]/scale), int(size[Y]/scale))
+    canvas = composite_page(tiles, open_roi_file(roi_path), scaled_size, size)
+    return Image.fromarray(canvas)
+
+def pyramid_path(pyramid_dir, size, scale, page, extension='jpg'):
+    """path of a pre-rendered mosaic page"""
+    (w,h) = size
+    return os.path.join(pyramid_dir, '%dx%d_%s_%d_v%d.%s' % (w, h, scale, page, LAYOUT_VERSION, extension))
+
+def render_pyramid(layout_fn, targets_fn, roi_path, pyramid_dir, size=PYRAMID_SIZE, scales=PYRAMID_SCALES, progress_callback=None):
+    """pre-render every page of a bin's mosaic at each scale as JPEGs.
+    layout_fn - function from unscaled page size to MosaicLayout
+    targets_fn - function from target indexes to targets
+    progress_callback - if not None, called with the number of pages
+    rendered so far after each page
+    returns the number of pages rendered"""
+    try:
+        os.makedirs(pyramid_dir)
+    except OSError: # usually because directory exists
+        pass
+    n = 0
+    for scale in scales:
+        layout = layout_fn((int(size[0]/scale), int(size[1]/scale)))
+        for page in range(1, layout.page_count + 1):
+            image = render_page(page_tiles(layout, targets_fn, page), roi_path, size, scale)
+            path = pyramid_path(pyramid_dir, size, scale, page)
+            part = '%s.%d.part' % (path, os.getpid())
+            image.save(part, 'JPEG')
+            os.rename(part, path)
+            n += 1
+            if progress_callback is not None:
+                progress_callback(n)
+    return n
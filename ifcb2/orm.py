@@ -1,6 +1,6 @@
 import os
 from datetime import timedelta, datetime
-from oii.utils import sha1_file
+from oii.fixity import get_fixity
 import calendar
 import time
 
@@ -181,7 +181,7 @@ class File(Base):
         if fast:
             self.sha1 = CHECKSUM_PLACEHOLDER
         else:
-            self.sha1 = sha1_file(self.local_path)
+            self.sha1 = get_fixity().sha1(self.local_path)
 
     def check_fixity(self,fast=False):
         status = {
@@ -194,11 +194,57 @@ class File(Base):
             if fast:
                 sha1 = CHECKSUM_PLACEHOLDER
             else:
-                sha1 = sha1_file(self.local_path)
+                sha1 = get_fixity().sha1(self.local_path)
             status[FILE_CHECKSUM] = self.sha1==sha1
             status[FILE_LENGTH] = self.length==os.stat(self.local_path).st_size
         return status
 
+class IndexedFile(Base):
+    """location of a raw or product file in a data directory, indexed by
+    bin LID so that it can be found without probing candidate paths"""
+    __tablename__ = 'file_index'
+
+    id = Column(Integer, primary_key=True)
+    root = Column(String)
+    lid = Column(String, index=True)
+    filetype = Column(String)
+    path = Column(String)
+    length = Column(BigInteger)
+    mtime = Column(Numeric)
+
+    __table_args__ = (
+        UniqueConstraint('root', 'lid', 'filetype'),
+    )
+
+    def __repr__(self):
+        return '<IndexedFile %s:%s %s>' % (self.lid, self.filetype, self.path)
+
+class MetricRollup(Base):
+    """sums of bin metrics and data volume over the non-skipped bins
+    of a time series in one hour or day (see oii.ifcb2.rollups)"""
+    __tablename__ = 'metric_rollups'
+
+    id = Column(Integer, primary_key=True)
+    ts_label = Column(String)
+    resolution = Column(String) # 'hour' or 'day'
+    bucket = Column(DateTime(timezone=True)) # start of hour or day
+    bin_count = Column(Integer, default=0)
+    data_volume = Column(BigInteger, default=0)
+    trigger_rate_sum = Column(Numeric, default=0)
+    temperature_sum = Column(Numeric, default=0)
+    humidity_sum = Column(Numeric, default=0)
+    # bins with a value for each metric, which averages are over
+    trigger_rate_count = Column(Integer, default=0)
+    temperature_count = Column(Integer, default=0)
+    humidity_count = Column(Integer, default=0)
+
+    __table_args__ = (
+        UniqueConstraint('ts_label', 'resolution', 'bucket'),
+    )
+
+    def __repr__(self):
+        return '<MetricRollup %s %s %s>' % (self.ts_label, self.resolution, self.bucket)
+
 class Instrument(Base):
     __tablename__ = 'instruments'
 
@@ -1,11 +1,14 @@
 import os
 import re
 import json
-from zipfile import ZipFile, ZIP_DEFLATED
-import shutil
+from zipfile import ZipFile, ZIP_DEFLATED, ZIP_STORED
 from io import BytesIO
 import tempfile
 from time import strptime
+from collections import deque
+from itertools import izip
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 
 from scipy.io import loadmat
 from StringIO import StringIO
@@ -23,7 +26,7 @@ from oii.ifcb2.identifiers import parse_pid, as_product, get_timestamp, add_pids
 from oii.ifcb2.identifiers import TIMESTAMP, TIMESTAMP_FORMAT
 from oii.ifcb2.formats.adc import Adc, TARGET_NUMBER, SCHEMA_VERSION_1
 from oii.ifcb2.formats.hdr import parse_hdr_file
-from oii.ifcb2.image import read_target_image
+from oii.ifcb2.formats.roi import open_roi_file
 
 from oii.ifcb2.stitching import list_stitched_targets, STITCHED, PAIR
 from oii.ifcb2.v1_stitching import stitch
@@ -123,6 +126,92 @@ def bin2json_medium(pid,hdr,targets,timestamp):
 def bin2json(pid,hdr,targets,timestamp):
     return json.dumps(bin2dict(pid,hdr,targets,timestamp))
 
+# how many target PNGs to have in progress at once, per thread
+PNG_WINDOW_PER_THREAD=4
+# bin zips are streamed in pieces of about this many bytes
+ZIP_CHUNK_SIZE=256*1024
+
+class _ZipOutput(object):
+    """minimal write-only file for ZipFile that holds what has been
+    written until it is drained, so a zip can be generated as a stream"""
+    def __init__(self):
+        self._chunks = []
+        self._pending = 0
+        self._pos = 0
+    def write(self, data):
+        self._chunks.append(data)
+        self._pending += len(data)
+        self._pos += len(data)
+    def tell(self):
+        return self._pos
+    def flush(self):
+        pass
+    def pending(self):
+        return self._pending
+    def drain(self):
+        data = ''.join(self._chunks)
+        self._chunks = []
+        self._pending = 0
+        return data
+
+def _target_png(args):
+    """pool entry point. args is (stitched pair or None, images)"""
+    pair, images = args
+    if pair is not None:
+        im,_ = stitch(pair, images)
+    else:
+        im = images[0]
+    return as_bytes(im, mimetype='image/png')
+
+def target_pngs(targets, roi_path, threads=None):
+    """generate (target, PNG bytes) for each target in order,
+    stitching and encoding in a thread pool"""
+    if threads is None:
+        threads = cpu_count()
+    roi_file = open_roi_file(roi_path)
+    def job_args():
+        for target in targets:
+            if STITCHED in target and target[STITCHED] != 0:
+                yield (target[PAIR], roi_file.get_images(target[PAIR]))
+            else:
+                yield (None, [roi_file[target]])
+    window = deque() # (target, async result) in target order
+    pool = ThreadPool(threads)
+    try:
+        for target, args in izip(targets, job_args()):
+            window.append((target, pool.apply_async(_target_png, (args,))))
+            if len(window) >= threads * PNG_WINDOW_PER_THREAD:
+                target, result = window.popleft()
+                yield target, result.get()
+        while window:
+            target, result = window.popleft()
+            yield target, result.get()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def bin2zip_stream(parsed_pid,canonical_pid,targets,hdr,timestamp,roi_path,threads=None):
+    """generate the bytes of a bin zip file in pieces, holding at
+    most a few target images in memory. arguments are as for bin2zip"""
+    bin_lid = parsed_pid['bin_lid']
+    adc_cols = parsed_pid['adc_cols'].split(' ')
+    targets = list(targets)
+    out = _ZipOutput()
+    z = ZipFile(out,'w',ZIP_DEFLATED,allowZip64=True)
+    csv_out = '\n'.join(targets2csv(targets, adc_cols))+'\n'
+    z.writestr(bin_lid + '.csv', csv_out)
+    xml_out = bin2xml(canonical_pid,hdr,targets,timestamp)
+    z.writestr(bin_lid + '.xml', xml_out)
+    yield out.drain()
+    for target, png in target_pngs(targets, roi_path, threads):
+        target_lid = os.path.basename(target['pid'])
+        # PNGs are already compressed
+        z.writestr(target_lid + '.png', png, ZIP_STORED)
+        if out.pending() >= ZIP_CHUNK_SIZE:
+            yield out.drain()
+    z.close()
+    yield out.drain()
+
 def bin2zip(parsed_pid,canonical_pid,targets,hdr,timestamp,roi_path,outfile):
     """parsed_pid - result of parsing pid
     canonical_pid - canonicalized with URL prefix
@@ -131,27 +220,8 @@ def bin2zip(parsed_pid,canonical_pid,targets,hdr,timestamp,roi_path,outfile):
     timestamp - timestamp (FIXME in what format?)
     roi_path - path to ROI file
     outfile - where to write resulting zip file"""
-    bin_lid = parsed_pid['bin_lid']
-    adc_cols = parsed_pid['adc_cols'].split(' ')
-    targets = list(targets)
-    with tempfile.SpooledTemporaryFile() as temp:
-        z = ZipFile(temp,'w',ZIP_DEFLATED)
-        csv_out = '\n'.join(targets2csv(targets, adc_cols))+'\n'
-        z.writestr(bin_lid + '.csv', csv_out)
-        xml_out = bin2xml(canonical_pid,hdr,targets,timestamp)
-        z.writestr(bin_lid + '.xml', xml_out)
-        with open(roi_path,'rb') as roi_file:
-            for target in targets:
-                if STITCHED in target and target[STITCHED] != 0:
-                    subRois = [read_target_image(t,file=roi_file) for t in target[PAIR]]
-                    im,_ = stitch(target[PAIR], subRois)
-                else:
-                    im = read_target_image(target, file=roi_file)
-                target_lid = os.path.basename(target['pid'])
-                z.writestr(target_lid + '.png', as_bytes(im, mimetype='image/png'))
-        z.close()
-        temp.seek(0)
-        shutil.copyfileobj(temp, outfile)
+    for data in bin2zip_stream(parsed_pid,canonical_pid,targets,hdr,timestamp,roi_path):
+        outfile.write(data)
 
 def binpid2zip(pid, outfile, log_callback=None):
     def log(msg):
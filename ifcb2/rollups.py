@@ -0,0 +1,167 @@
+"""hourly and daily rollups of bin metrics and data volume per time
+series. rollups are updated as bins are accessioned or skipped, so
+that metric plots and data volume over long time ranges don't have to
+read every bin"""
+import logging
+from datetime import timedelta
+
+from sqlalchemy import and_, func, cast, Float
+
+from oii.times import dt2utcdt
+from oii.ifcb2.orm import Bin, File, MetricRollup, TimeSeries
+
+HOUR='hour'
+DAY='day'
+
+# longest time ranges served per bin and per hour. longer ranges are
+# served per day
+MAX_BIN_RANGE=timedelta(days=7)
+MAX_HOURLY_RANGE=timedelta(days=120)
+
+# metrics that can be served from rollups, and the summed column and
+# count of bins with a value that each one is averaged from
+METRIC_SUMS = {
+    'trigger_rate': ('trigger_rate_sum', 'trigger_rate_count'),
+    'temperature': ('temperature_sum', 'temperature_count'),
+    'humidity': ('humidity_sum', 'humidity_count')
+}
+
+# bins to read at a time when rebuilding rollups
+REBUILD_BATCH_SIZE=5000
+
+def trigger_rate(triggers, duration):
+    """same as Bin.trigger_rate"""
+    if duration is None or duration < 0.1:
+        return 0
+    return float(triggers) / float(duration)
+
+def bucket_start(dt, resolution):
+    """start of the hour or day containing a UTC datetime"""
+    dt = dt2utcdt(dt).replace(minute=0, second=0, microsecond=0)
+    if resolution == DAY:
+        dt = dt.replace(hour=0)
+    return dt
+
+def choose_resolution(start, end):
+    """the resolution to serve a time range at: None (per bin), HOUR,
+    or DAY"""
+    if end - start <= MAX_BIN_RANGE:
+        return None
+    if end - start <= MAX_HOURLY_RANGE:
+        return HOUR
+    return DAY
+
+def bin_row(b):
+    """the values rollups need from a Bin and its files"""
+    return dict(ts_label=b.ts_label, sample_time=b.sample_time, triggers=b.triggers,
+                duration=b.duration, temperature=b.temperature, humidity=b.humidity,
+                data_volume=sum(f.length or 0 for f in b.files))
+
+def rollup_deltas(rows, sign=1):
+    """sum rows (see bin_row) into per-bucket increments. returns a dict
+    from (ts_label, resolution, bucket) to column increments"""
+    def present(*values):
+        return int(all(v is not None for v in values))
+    deltas = {}
+    for row in rows:
+        triggers, duration = row.get('triggers'), row.get('duration')
+        temperature, humidity = row.get('temperature'), row.get('humidity')
+        d = {
+            'bin_count': 1,
+            'data_volume': int(row.get('data_volume') or 0),
+            'trigger_rate_sum': trigger_rate(triggers or 0, duration),
+            'temperature_sum': float(temperature or 0),
+            'humidity_sum': float(humidity or 0),
+            'trigger_rate_count': present(triggers, duration),
+            'temperature_count': present(temperature),
+            'humidity_count': present(humidity)
+        }
+        for resolution in [HOUR, DAY]:
+            key = (row['ts_label'], resolution, bucket_start(row['sample_time'], resolution))
+            total = deltas.setdefault(key, dict((k,0) for k in d))
+            for k,v in d.items():
+                total[k] += sign * v
+    return deltas
+
+def _upsert_rollup(session, ts_label, resolution, bucket, d):
+    table = MetricRollup.__table__
+    if session.bind.dialect.name == 'postgresql':
+        # atomic, so concurrent accessions can create the same bucket.
+        # imported here so that other databases don't need the dialect
+        from sqlalchemy.dialects.postgresql import insert
+        stmt = insert(table).values(ts_label=ts_label, resolution=resolution, bucket=bucket, **d)
+        stmt = stmt.on_conflict_do_update(index_elements=['ts_label','resolution','bucket'],
+            set_=dict((k, table.c[k] + stmt.excluded[k]) for k in d))
+        session.execute(stmt)
+        return
+    # elsewhere (i.e., SQLite) the update takes the database write lock,
+    # so no other accession can insert the bucket before this does
+    where = and_(table.c.ts_label==ts_label, table.c.resolution==resolution, table.c.bucket==bucket)
+    values = dict((k, table.c[k] + v) for k,v in d.items())
+    if session.execute(table.update().where(where).values(**values)).rowcount == 0:
+        session.execute(table.insert().values(ts_label=ts_label, resolution=resolution, bucket=bucket, **d))
+
+def add_to_rollups(session, rows, sign=1):
+    """add rows (see bin_row) to the rollups, or with sign=-1 remove
+    them. does not commit"""
+    for (ts_label, resolution, bucket), d in rollup_deltas(rows, sign).items():
+        _upsert_rollup(session, ts_label, resolution, bucket, d)
+
+def has_rollups(session, ts_label):
+    q = session.query(MetricRollup.id).filter(MetricRollup.ts_label==ts_label)
+    return q.first() is not None
+
+def set_skip(session, bins, skip):
+    """set the skip flag of some Bins, keeping rollups of them up to
+    date. does not commit"""
+    changed = [b for b in bins if bool(b.skip) != skip]
+    for b in changed:
+        b.skip = skip
+    sign = -1 if skip else 1
+    for ts_label in set(b.ts_label for b in changed):
+        if has_rollups(session, ts_label):
+            add_to_rollups(session, [bin_row(b) for b in changed if b.ts_label==ts_label], sign)
+
+def lock_time_series(session, ts_label):
+    """lock a time series' row until the end of the transaction, to
+    serialize rollup rebuilds"""
+    session.query(TimeSeries.id).filter(TimeSeries.label==ts_label).\
+        with_for_update().first()
+
+def rebuild_rollups(session, ts_label, batch_size=REBUILD_BATCH_SIZE):
+    """recompute all rollups for a time series from its bins, reading
+    only the needed columns. commits. returns the number of bins"""
+    lock_time_series(session, ts_label)
+    session.query(MetricRollup).filter(MetricRollup.ts_label==ts_label).delete(synchronize_session=False)
+    volume = session.query(File.bin_id, func.sum(File.length).label('data_volume')).\
+        group_by(File.bin_id).subquery()
+    q = session.query(Bin.ts_label, Bin.sample_time, Bin.triggers, Bin.duration,
+                      Bin.temperature, Bin.humidity, volume.c.data_volume).\
+        outerjoin(volume, volume.c.bin_id==Bin.id).\
+        filter(and_(Bin.ts_label==ts_label, ~Bin.skip)).\
+        order_by(Bin.sample_time)
+    # sum everything first, so that each rollup is written once
+    deltas = rollup_deltas(row._asdict() for row in q.yield_per(batch_size))
+    n = sum(d['bin_count'] for (_,resolution,_),d in deltas.items() if resolution==DAY)
+    table = MetricRollup.__table__
+    rows = [dict(ts_label=t, resolution=r, bucket=b, **d) for (t,r,b),d in deltas.items()]
+    for i in range(0, len(rows), batch_size):
+        session.execute(table.insert(), rows[i:i+batch_size])
+    session.commit()
+    logging.warn('ROLLUPS rebuilt for %s: %d bins, %d rollups' % (ts_label, n, len(rows)))
+    return n
+
+def metric_rollups(session, ts_label, metric, resolution, start_time, end_time):
+    """average of a metric (see METRIC_SUMS) per hour or day over a time
+    range, over the bins that have a value for it. returns (bucket,
+    value, count) rows in time order"""
+    total, count = [getattr(MetricRollup, c) for c in METRIC_SUMS[metric]]
+    # SQLite stores whole-number sums as integers, which would truncate
+    average = cast(total, Float) / count
+    return session.query(MetricRollup.bucket, average, count).\
+        filter(and_(MetricRollup.ts_label==ts_label,
+                    MetricRollup.resolution==resolution,
+                    MetricRollup.bucket >= bucket_start(start_time, resolution),
+                    MetricRollup.bucket <= end_time,
+                    count > 0)).\
+        order_by(MetricRollup.bucket)
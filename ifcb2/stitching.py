@@ -30,24 +30,70 @@ def stitched_box(targets):
     h = max([target[BOTTOM] + target[HEIGHT] for target in targets]) - y
     return (x,y,w,h)
 
+def find_stitched_pairs(columns):
+    """given target columns (a structured array as returned by
+    oii.ifcb2.formats.adc.read_adc_columns, or a dict of arrays), return
+    the indexes of the first target of each stitched pair. the second
+    target of each pair is the one that follows it"""
+    trigger, left, bottom = columns[TRIGGER], columns[LEFT], columns[BOTTOM]
+    right, top = left + columns[WIDTH], bottom + columns[HEIGHT]
+    # consecutive targets with the same trigger whose boxes overlap
+    pairs = trigger[:-1] == trigger[1:]
+    pairs &= (left[:-1] < right[1:]) & (right[:-1] > left[1:])
+    pairs &= (bottom[:-1] < top[1:]) & (top[:-1] > bottom[1:])
+    return np.flatnonzero(pairs)
+
+def stitch_columns(columns):
+    """compute stitching for target columns (see find_stitched_pairs).
+    returns (keep, firsts, boxes) where
+    keep - indexes of the targets remaining after stitching, in order
+    firsts - indexes of the first target of each stitched pair
+    boxes - (left, bottom, width, height) of each pair, one row per pair"""
+    n = len(columns[TRIGGER])
+    if n < 2:
+        return np.arange(n), np.zeros(0, dtype=np.int64), np.zeros((0,4), dtype=np.int64)
+    firsts = find_stitched_pairs(columns)
+    seconds = firsts + 1
+    left, bottom = columns[LEFT], columns[BOTTOM]
+    right, top = left + columns[WIDTH], bottom + columns[HEIGHT]
+    x = np.minimum(left[firsts], left[seconds])
+    y = np.minimum(bottom[firsts], bottom[seconds])
+    w = np.maximum(right[firsts], right[seconds]) - x
+    h = np.maximum(top[firsts], top[seconds]) - y
+    # the second of each pair is excluded, even if it begins another pair
+    excluded = np.zeros(n, dtype=bool)
+    excluded[seconds] = True
+    return np.flatnonzero(~excluded), firsts, np.column_stack((x,y,w,h))
+
+def target_columns(targets):
+    """columns needed for stitching, from a list of target dicts"""
+    return dict((k, np.array([t[k] for t in targets], dtype=np.int64))
+                for k in [TRIGGER, LEFT, BOTTOM, WIDTH, HEIGHT])
+
+def apply_stitching(targets, keep, firsts, boxes):
+    """given a list of target dicts and the result of stitch_columns,
+    return copies of the targets remaining after stitching, with
+    stitched targets' boxes merged and their pair in PAIR"""
+    stitched = dict((i, box) for i, box in zip(firsts.tolist(), boxes.tolist()))
+    result = []
+    for i in keep.tolist():
+        target = targets[i].copy()
+        if i in stitched:
+            b = targets[i+1].copy()
+            b[STITCHED] = 0
+            target[PAIR] = (targets[i].copy(), b)
+            (target[LEFT], target[BOTTOM], target[WIDTH], target[HEIGHT]) = stitched[i]
+            target[STITCHED] = 1
+        elif not STITCHED in target:
+            target[STITCHED] = 0
+        result.append(target)
+    return result
+
 def list_stitched_targets(targets):
     """Adjust a list of targets for stitching"""
-    # in the stitching case we need to compute "stitched" flags based on pairs
-    # correct image metrics
-    targets = [t.copy() for t in targets] # consume iterator non-destructively
-    Bs = []
-    for a,b in find_pairs(targets):
-        a[PAIR] = (a.copy(), b)
-        (a[LEFT], a[BOTTOM], a[WIDTH], a[HEIGHT]) = stitched_box([a,b])
-        a[STITCHED] = 1
-        b[STITCHED] = 0
-        Bs.append(b)
-    # exclude the second of each pair from the list of targets
-    targets = filter(lambda target: target not in Bs, targets)
-    for target in targets:
-        if not STITCHED in target:
-            target[STITCHED] = 0
-    return targets
+    targets = list(targets) # consume iterator non-destructively
+    keep, firsts, boxes = stitch_columns(target_columns(targets))
+    return apply_stitching(targets, keep, firsts, boxes)
 
 # stitch with no noise fill
 def stitch_raw(targets,images,box=None,background=0):
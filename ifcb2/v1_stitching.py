@@ -2,107 +2,93 @@ import numpy as np
 from numpy import convolve, median
 from scipy import interpolate
 from math import sqrt
-from PIL import Image, ImageChops, ImageDraw
 from oii.ifcb2.formats.adc import TRIGGER, LEFT, BOTTOM, WIDTH, HEIGHT
-from oii.ifcb2.formats.roi import as_pil
 
-from oii.ifcb2.stitching import STITCHED, stitched_box, stitch_raw
+from oii.ifcb2.stitching import STITCHED, PAIR, stitched_box, stitch_raw
+
+# how many gap pixels to evaluate the background RBF at, at a time.
+# bounds the size of the pixel x node distance matrix
+RBF_BATCH_SIZE=16384
 
 def normz(a):
-    m = max(a) + 0.000001 # dividing by zero is bad
-    return [float(x) / float(m) for x in a]
+    a = np.asarray(a, dtype=np.float64)
+    return a / (a.max() + 0.000001) # dividing by zero is bad
 
 def avg(l):
     return sum(l) / len(l)
-    
+
 def mv(eh):
-    n = 0.000001 # no dividing by zero
-    sum = 0
-    counts = zip(range(256), eh)
-    for color,count in counts:
-        n += count
-        sum += count * color
-    mean = sum / n
-    sum2 = 0
-    for color,count in counts:
-        sum2 += ((color - mean) ** 2) * count
-    variance = sum2 / n
+    """mean and variance of a 256-bin histogram"""
+    eh = np.asarray(eh, dtype=np.float64)
+    colors = np.arange(256)
+    n = 0.000001 + eh.sum() # no dividing by zero
+    mean = np.dot(colors, eh) / n
+    variance = np.dot((colors - mean) ** 2, eh) / n
     return (mean, variance)
 
+def hist(samples):
+    """256-bin histogram of 8-bit samples"""
+    return np.bincount(np.asarray(samples, dtype=np.uint8).ravel(), minlength=256)
+
 # FIXME this is still too sensitive to lower modes
 def bright_mv(image,mask=None):
-    mask = as_pil(mask)
-    eh = image.histogram(mask)
+    if mask is not None:
+        image = image[np.asarray(mask) > 0]
+    eh = hist(image)
     # toast extrema
     return bright_mv_hist(eh)
 
 def bright_mv_hist(histogram,exclude=[0,255]):
-    for x in exclude:
-        histogram[x] = 0 
+    histogram = np.array(histogram, dtype=np.float64)
+    histogram[exclude] = 0
     # smooth the filter, preferring peaks with sharp declines on the higher luminance end
     peak = convolve(histogram,[2,2,2,2,2,4,8,2,1,1,1,1,1],'same')
     # now smooth that to eliminate noise
     peak = convolve(peak,[1,1,1,1,1,1,1,1,1],'same')
     # scale original signal to the normalized smoothed signal;
     # that will tend to deattenuate secondary peaks, and reduce variance of bimodal distros
-    scaled = [(x**20)*y for x,y in zip(normz(peak),histogram)] # FIXME magic number
+    scaled = (normz(peak)**20) * histogram # FIXME magic number
     # now compute mean and variance of the scaled signal
     return mv(scaled)
 
 def extract_background(image,estimated_background):
-    bg_mask = ImageChops.difference(image,estimated_background)
+    """return the image with everything that differs from the estimated
+    background by more than most pixels do set to white"""
+    diff = np.abs(image.astype(np.int16) - np.asarray(estimated_background, dtype=np.int16))
     # now compute threshold from histogram
-    h = bg_mask.histogram()
     # reject dark part with threshold
-    total = sum(h)
-    running = 0
-    for t in range(256):
-        running += h[t]
-        if running > total * 0.95:
-            threshold = t
-            break
-    table = range(256)
-    for t in range(256):
-        if t < threshold:
-            table[t] = 0
-        else:
-            table[t] = 255;
-    bg_mask = bg_mask.point(table)
-    bg_mask = ImageChops.screen(image,bg_mask)
-    return bg_mask
+    h = hist(diff)
+    threshold = np.flatnonzero(np.cumsum(h) > h.sum() * 0.95)[0]
+    return np.where(diff >= threshold, 255, image).astype(np.uint8)
 
 def mask(targets):
+    """a boolean mask of the non-missing region of the stitched box"""
     (x,y,w,h) = stitched_box(targets)
     # now we swap width and height to rotate the image 90 degrees
-    mask = Image.new('L',(h,w), 0) # a mask of the non-missing region
+    mask = np.zeros((w,h), dtype=bool)
     for target in targets:
         rx = target[LEFT] - x
         ry = target[BOTTOM] - y
-        mask.paste(255, (ry, rx, ry + target[HEIGHT], rx + target[WIDTH]))
-    return np.array(mask)
+        mask[rx:rx + target[WIDTH], ry:ry + target[HEIGHT]] = True
+    return mask
 
-def edges_mask(targets,images):
+def edges_mask(targets,images=None):
+    """a boolean mask of the pixels along the edges of the ROIs"""
     # compute bounds relative to the camera field
     (x,y,w,h) = stitched_box(targets)
-    # now we swap width and height to rotate the image 90 degrees
-    edges = Image.new('L',(h,w), 0) # just the edges of the missing region
-    draw = ImageDraw.Draw(edges)
-    for (roi,image) in zip(targets,images):
-        rx = roi[LEFT] - x
-        ry = roi[BOTTOM] - y
-        edges.paste(255, (ry, rx, ry + roi[HEIGHT], rx + roi[WIDTH]))
+    edges = mask(targets)
     # blank out a rectangle in the middle of the rois
     inset_factor = 25
     insets = []
     for roi in targets:
-        rx = roi[LEFT] - x
-        ry = roi[BOTTOM] - y
         insets += [roi[WIDTH] / inset_factor, roi[HEIGHT] / inset_factor]
     inset = avg(insets)
     for roi in targets:
         rx = roi[LEFT] - x
         ry = roi[BOTTOM] - y
-        draw.rectangle((ry + inset, rx + inset, ry + roi[HEIGHT] - inset - 1, rx + roi[WIDTH] - inset - 1), fill=0)
+        # a rectangle with no interior is not drawn
+        x_end, y_end = max(0, rx + roi[WIDTH] - inset), max(0, ry + roi[HEIGHT] - inset)
+        edges[rx + inset:x_end, ry + inset:y_end] = False
     return edges
 
 def euclidian(x1,y1,x2,y2):
@@ -116,72 +102,78 @@ def concentric(l):
         yield one
         yield two
 
-def hist(samples):
-    h = [0 for ignore in range(256)]
-    for s in samples:
-        h[s] += 1
-    return h
+def sample_background(bg, rad):
+    """sample the probable background image on a grid with spacing rad.
+    at each grid node, use the smallest neighborhood whose brightest
+    mode is not an outlier. returns (nodes, means): the nodes' column
+    and row coordinates as an n x 2 array, and the mode means"""
+    (w,h) = bg.shape
+    nodes = []
+    means = []
+    for x in range(0,h+rad,rad):
+        for y in range(0,w+rad,rad):
+            for r in range(rad,max(h,w),int(rad/3)+1):
+                region = bg[max(0,y-r):min(w-1,y+r), max(0,x-r):min(h-1,x+r)]
+                (m,v) = bright_mv_hist(hist(region))
+                if m > 0 and m < 255: # reject outliers
+                    nodes.append((x,y))
+                    means.append(m)
+                    break
+    return np.array(nodes).reshape((len(nodes),2)), np.array(means)
+
+def evaluate_rbf(rbf, xs, ys, batch_size=RBF_BATCH_SIZE):
+    """evaluate an Rbf at many points, a batch at a time"""
+    values = np.empty(len(xs))
+    for i in range(0, len(xs), batch_size):
+        values[i:i+batch_size] = rbf(xs[i:i+batch_size], ys[i:i+batch_size])
+    return values
 
 def stitch(targets,images):
     # compute bounds relative to the camera field
     (x,y,w,h) = stitched_box(targets)
     # note that w and h are switched from here on out to rotate 90 degrees.
     # step 1: compute masks
-    s = as_pil(stitch_raw(targets,images,(x,y,w,h))) # stitched ROI's with black gaps
-    rois_mask = as_pil(mask(targets)) # a mask of where the ROI's are
-    gaps_mask = ImageChops.invert(rois_mask) # its inverse is where the gaps are
-    edges = edges_mask(targets,images) # edges are pixels along the ROI edges
+    s = stitch_raw(targets,images,(x,y,w,h)) # stitched ROI's with black gaps
+    rois_mask = mask(targets) # a mask of where the ROI's are
+    gaps_mask = ~rois_mask # its inverse is where the gaps are
+    edges = edges_mask(targets) # edges are pixels along the ROI edges
     # step 2: estimate background from edges
     # compute the mean and variance of the edges
     (mean,variance) = bright_mv(s,edges)
     # now use that as an estimated background
-    flat_bg = Image.new('L',(h,w),mean) # FIXME
-    s.paste(mean,None,gaps_mask)
+    mean = int(mean)
+    s[gaps_mask] = mean
     # step 3: compute "probable background": low luminance delta from estimated bg
-    bg = extract_background(s,flat_bg)
+    bg = extract_background(s,mean)
     # also mask out the gaps, which are not "probable background"
-    bg.paste(255,None,gaps_mask)
+    bg[gaps_mask] = 255
     # step 3a: improve mean/variance estimate
     (mean,variance) = bright_mv(bg)
     std_dev = sqrt(variance)
     # step 4: sample probable background to compute RBF for illumination gradient
-    # grid
     div = 6
-    means = []
-    nodes = []
     rad = avg([h,w]) / div
-    rad_step = int(rad/2)+1
-    for x in range(0,h+rad,rad):
-        for y in range(0,w+rad,rad):
-            for r in range(rad,max(h,w),int(rad/3)+1):
-                box = (max(0,x-r),max(0,y-r),min(h-1,x+r),min(w-1,y+r))
-                region = bg.crop(box)
-                nabe = region.histogram()
-                (m,v) = bright_mv_hist(nabe)
-                if m > 0 and m < 255: # reject outliers
-                    nodes.append((x,y))
-                    means.append(m)
-                    break
+    nodes, means = sample_background(bg, rad)
     # now construct radial basis functions for mean, based on the samples
-    mean_rbf = interpolate.Rbf([x for x,y in nodes], [y for x,y in nodes], means, epsilon=rad)
+    mean_rbf = interpolate.Rbf(nodes[:,0], nodes[:,1], means, epsilon=rad)
     # step 5: fill gaps with mean based on RBF and variance from bright_mv(edges)
-    mask_pix = gaps_mask.load()
-    noise = Image.new('L',(h,w),mean)
-    noise_pix = noise.load()
-    np.random.seed(0)
-    gaussian = np.random.normal(0, 1.0, size=(h,w)) # it's normal
+    gaussian = np.random.RandomState(0).normal(0, 1.0, size=(h,w)).T # it's normal
     std_dev *= 0.66 # err on the side of smoother rather than noisier
-    mask_x = []
-    mask_y = []
-    for x in xrange(h):
-        for y in xrange(w):
-            if mask_pix[x,y] == 255: # only for pixels in the mask
-                mask_x.append(x)
-                mask_y.append(y)
-    rbf_fill = mean_rbf(np.array(mask_x), np.array(mask_y))
-    for x,y,r in zip(mask_x, mask_y, rbf_fill):
-        # fill is illumination gradient + noise
-        noise_pix[x,y] = r + (gaussian[x,y] * std_dev)
+    gap_rows, gap_cols = np.nonzero(gaps_mask)
+    rbf_fill = evaluate_rbf(mean_rbf, gap_cols, gap_rows)
+    # fill is illumination gradient + noise
+    noise = rbf_fill + (gaussian[gap_rows, gap_cols] * std_dev)
     # step 6: final composite
-    s.paste(noise,None,gaps_mask)
-    return (np.array(s),rois_mask)
+    s[gap_rows, gap_cols] = np.clip(noise, 0, 255).astype(np.uint8)
+    return (s,rois_mask)
+
+def stitch_targets(targets, roi_file):
+    """generate an image for each of a list of targets, in order,
+    stitching pairs (see oii.ifcb2.stitching.list_stitched_targets).
+    roi_file is a RoiFile"""
+    for target in targets:
+        if target.get(STITCHED):
+            im,_ = stitch(target[PAIR], roi_file.get_images(target[PAIR]))
+        else:
+            im = roi_file[target]
+        yield im
@@ -7,6 +7,7 @@ from oii.ifcb2.acquisition import do_copy
 from oii.ifcb2.orm import Instrument
 
 from oii.workflow import FOREVER, AVAILABLE, COMPLETED, ERROR
+from oii.workflow import UPSTREAM, ROLE
 from oii.workflow.client import WorkflowClient
 from oii.workflow.async import async, wakeup_task
 
@@ -32,29 +33,35 @@ from oii.ifcb2.session import session
 
 client = WorkflowClient(WORKFLOW_URL)
 
-def schedule_products(pid, client):
+def product_dependencies(pid):
     """dependencies:
-    features <- blobs <- binzip <- raw"""
+    features <- blobs <- binzip <- raw
+    returned as a list of dicts, for WorkflowClient.depend_all"""
     raw_pid = as_product(pid, RAW_PRODUCT)
     binzip_pid = as_product(pid, BINZIP_PRODUCT)
-    client.depend(binzip_pid, raw_pid, RAW2BINZIP)
     webcache_pid = as_product(pid, WEBCACHE_PRODUCT)
-    client.depend(webcache_pid, binzip_pid, BINZIP2WEBCACHE)
     blobs_pid = as_product(pid, BLOBS_PRODUCT)
-    client.depend(blobs_pid, binzip_pid, BINZIP2BLOBS)
     features_pid = as_product(pid, FEATURES_PRODUCT)
-    client.depend(features_pid, blobs_pid, BLOBS2FEATURES)
+    return [
+        { PID: binzip_pid, UPSTREAM: raw_pid, ROLE: RAW2BINZIP },
+        { PID: webcache_pid, UPSTREAM: binzip_pid, ROLE: BINZIP2WEBCACHE },
+        { PID: blobs_pid, UPSTREAM: binzip_pid, ROLE: BINZIP2BLOBS },
+        { PID: features_pid, UPSTREAM: blobs_pid, ROLE: BLOBS2FEATURES }
+    ]
+
+def schedule_products(pid, client):
+    """schedule the products of a bin in one request"""
+    client.depend_all(product_dependencies(pid))
 
 def do_acc(pid, job):
     parsed = parse_pid(pid)
     lid = parsed[LID]
     ts_label = parsed[TS_LABEL]
     roots = get_data_roots(session, ts_label) # get raw data roots
-    fileset = parsed_pid2fileset(parsed, roots)
+    fileset = parsed_pid2fileset(parsed, roots, session)
     fileset[LID] = lid
     session.expire_all() # don't be stale!
-    acc = Accession(session,ts_label)#,fast=True)
-    # FIXME fast=True disables checksumming
+    acc = Accession(session,ts_label) # fast=True would disable checksumming
     client.update(pid,ttl=3600) # allow 1hr for accession
     ret = acc.add_fileset(fileset)
     if ret=='ADDED':
@@ -64,12 +71,16 @@ def do_acc(pid, job):
     elif ret=='FAILED':
         raise Exception('accession failed')
 
+# the work this worker does, for do_all_work or for consuming
+# dispatched products (see oii.ifcb2.workflow.dispatch_worker)
+WORK = dict(
+    roles=[WILD2RAW],
+    callback=do_acc,
+    ttl=3600, # 1hr
+    message='accession complete')
+
 @wakeup_task
 def acc_wakeup(ignore):
     """- wake up and expire the session
     """
-    client.do_all_work(
-        roles=[WILD2RAW],
-        callback=do_acc,
-        ttl=3600, # 1hr
-        message='accession complete')
+    client.do_all_work(**WORK)
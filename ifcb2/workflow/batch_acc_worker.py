@@ -5,7 +5,7 @@ from oii.ifcb2.identifiers import as_product, canonicalize
 from oii.ifcb2.acquisition import do_copy
 from oii.ifcb2.orm import Instrument
 from oii.ifcb2.accession import Accession
-from oii.ifcb2 import LID
+from oii.ifcb2.workflow.acc_worker import product_dependencies
 
 from oii.workflow.client import WorkflowClient, Mutex, Busy
 from oii.workflow.async import async, wakeup_task
@@ -23,6 +23,9 @@ URL_PREFIX=DASHBOARD_BASE_URL
 
 ### end FIXME
 
+# how many bins' products to schedule per request
+SCHEDULE_BATCH_SIZE=250
+
 def is_acc_key(key):
     return key is not None and key.startswith('ifcb:acc:')
 
@@ -47,9 +50,9 @@ def acc_wakeup(wakeup_key):
     """- wake up and expire the session
     - acquire a mutex on the acquisition key
     - query for the instrument
-    - run the copy job
-    - schedule the accession job
-    - wakeup accession workers"""
+    - accession all new bins, indexing their filesets
+    - schedule their products
+    - wakeup workers"""
     # figure out if this wakeup matters to us
     if not is_acc_key(wakeup_key):
         return
@@ -57,27 +60,27 @@ def acc_wakeup(wakeup_key):
     # attempt to acquire mutex. if fails, that's fine,
     # that means batch accession is already underway
     try:
-        then = time.time()
         count = 0
         with Mutex(wakeup_key,ttl=45) as mutex:
             session.expire_all() # don't be stale!
             accession = Accession(session, time_series)
             logging.warn('START BATCH %s' % time_series)
-            for fs in accession.list_filesets(): # FIXME debug, do all
-                lid = fs[LID]
-                if accession.bin_exists(lid):
-                    continue # don't schedule accession if bin exists
-                pid = canonicalize(URL_PREFIX, time_series, fs[LID])
-                count += 1
-                if count % 100 == 0:
-                    logging.warn('batch %s: scheduled %d bins' % (time_series, count))
-                schedule_accession(client,pid)
-                elapsed = time.time() - then
-                if elapsed > 25: # don't send heartbeats too often
+            state = dict(then=time.time())
+            def keep_mutex(*ignore):
+                if time.time() - state['then'] > 25: # don't send heartbeats too often
                     mutex.heartbeat() # retain mutex
-                    then = time.time()
-                client.wakeup() # wakeup workers
-            logging.warn('END BATCH %s: %d bins scheduled' % (time_series,count))
+                    state['then'] = time.time()
+            # accession all new bins here rather than scheduling a job for each
+            added = accession.bulk_add_filesets(progress_callback=keep_mutex)
+            for i in range(0, len(added), SCHEDULE_BATCH_SIZE):
+                deps = []
+                for lid in added[i:i+SCHEDULE_BATCH_SIZE]:
+                    deps += product_dependencies(canonicalize(URL_PREFIX, time_series, lid))
+                    count += 1
+                client.depend_all(deps)
+                logging.warn('batch %s: scheduled products for %d bins' % (time_series, count))
+                keep_mutex()
+            logging.warn('END BATCH %s: %d bins added' % (time_series,count))
             client.wakeup()
     except Busy:
         logging.warn('BATCH not waking up')
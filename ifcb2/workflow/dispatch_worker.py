@@ -0,0 +1,31 @@
+"""consume the products the workflow service dispatches to one IFCB
+worker's role queue (see oii.workflow.dispatch). when the workflow
+service has DISPATCH_AMQP_HOST set, it no longer wakes up workers to
+poll for work, so run one or more of these per worker instead of the
+worker's Celery wakeup task, like this:
+
+python -m oii.ifcb2.workflow.dispatch_worker [amqp host] [worker]
+
+where worker is one of the names in WORKERS. the Celery acquisition
+and batch accession workers are still woken up with their keys"""
+import sys
+from importlib import import_module
+
+from oii.workflow.dispatch import RabbitBroker, consume
+
+# worker names and the modules that define their client and WORK
+WORKERS = {
+    'acc': 'oii.ifcb2.workflow.acc_worker',
+    'binzip': 'oii.ifcb2.workflow.zip_worker',
+    'blobs': 'oii.ifcb2.workflow.blob_worker',
+    'features': 'oii.ifcb2.workflow.features_worker',
+    'webcache': 'oii.ifcb2.workflow.webcache_worker'
+}
+
+def consume_dispatched(amqp_host, worker):
+    """work on a worker's dispatched products as they arrive. does not return"""
+    module = import_module(WORKERS[worker])
+    consume(RabbitBroker(amqp_host), client=module.client, **module.WORK)
+
+if __name__=='__main__':
+    consume_dispatched(*sys.argv[1:3])
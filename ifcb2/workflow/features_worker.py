@@ -1,44 +1,32 @@
 import os
-import re
 import logging
 
-import requests
-
 from oii.utils import safe_tempdir
-from oii.ioutils import download, upload, exists
-from oii.matlab import Matlab
+from oii.ioutils import exists
 
-from oii.workflow import FOREVER, AVAILABLE, COMPLETED, ERROR
 from oii.workflow.client import WorkflowClient
 from oii.workflow.async import async, wakeup_task
 
-from oii.ifcb2 import PID, LID, TS_LABEL, NAMESPACE
-from oii.ifcb2.workflow import BLOBS2FEATURES
+from oii.ifcb2 import LID, TS_LABEL, NAMESPACE
+from oii.ifcb2.workflow import BLOBS2FEATURES, BLOBS_PRODUCT
 from oii.ifcb2.identifiers import parse_pid
+from oii.ifcb2.files import parsed_pid2fileset, parsed_pid2product_file, get_data_roots, NotFound
+from oii.ifcb2.features.extract import extract_bin, features_csv_name, multiblob_csv_name
 from oii.rbac.utils import secure_upload
 
-from worker_config import WORKFLOW_URL, MATLAB_BASE, MATLAB_EXEC_PATH, API_KEY
-
-client = WorkflowClient(WORKFLOW_URL)
-
-MATLAB_DIRS = [
-'webservice_tools',
-'feature_extraction',
-'feature_extraction/blob_extraction',
-'feature_extraction/batch_features_bins',
-'feature_extraction/biovolume',
-'dipum_toolbox_2.0.1'
-]
-MATLAB_PATH = [os.path.join(MATLAB_BASE, md) for md in MATLAB_DIRS]
+from oii.ifcb2.session import session
 
-def csvname(url):
-    return re.sub(r'.*/([^.]+).*',r'\1_fea_v2.csv',url)
+from worker_config import WORKFLOW_URL, API_KEY
 
-def multiblobname(url):
-    return re.sub(r'.*/([^.]+).*',r'\1_multiblob_v2.csv',url)
+client = WorkflowClient(WORKFLOW_URL)
 
-def binzipname(url):
-    return re.sub(r'.*/([^.]+).*',r'\1.zip',url)
+def find_blob_zip(parsed_pid):
+    """return the path of a local blob zip for the bin, or None"""
+    roots = get_data_roots(session, parsed_pid[TS_LABEL], product_type=BLOBS_PRODUCT)
+    try:
+        return parsed_pid2product_file(parsed_pid, BLOBS_PRODUCT, roots, session)
+    except NotFound:
+        return None
 
 def extract_features(pid,job):
     def log_callback(msg):
@@ -47,53 +35,41 @@ def extract_features(pid,job):
     parsed_pid = parse_pid(pid)
     bin_lid = parsed_pid[LID]
     bin_pid = ''.join([parsed_pid[NAMESPACE], parsed_pid[LID]]) 
-    binzip_url = ''.join([bin_pid,'_binzip.zip'])
-    blob_url = ''.join([bin_pid,'_blob.zip'])
     features_url = ''.join([bin_pid,'_features.csv'])
     multiblob_url = ''.join([bin_pid,'_multiblob.csv'])
     if exists(features_url):
         log_callback('skipping %s - features exist' % pid)
         return
     log_callback('computing features for %s' % pid)
-    with safe_tempdir() as binzip_dir:
-        # download bin zip
-        binzip_path = os.path.join(binzip_dir, '%s.zip' % bin_lid)
-        log_callback('downloading %s to %s' % (binzip_url, binzip_path))
-        download(binzip_url, binzip_path)
-        # download blob zip
-        blob_path = os.path.join(binzip_dir, '%s_blob.zip' % bin_lid)
-        log_callback('downloading %s to %s' % (blob_url, blob_path))
-        download(blob_url, blob_path)
-        # compute features
-        with safe_tempdir() as job_dir:
-            # output of matlab job
-            feature_csv = os.path.join(job_dir, csvname(bin_pid))
-            multiblob_csv = os.path.join(job_dir, 'multiblob', multiblobname(bin_pid))
-            # params for matlab job
-            namespace = os.path.dirname(binzip_path) + '/'
-            lid = os.path.basename(binzip_path)
-            matlab = Matlab(MATLAB_EXEC_PATH, MATLAB_PATH, output_callback=log_callback)
-            cmd = 'bin_features(\'%s\',\'%s\',\'%s\',\'chatty\')' % (namespace, lid, job_dir + '/')
-            log_callback('running %s' % cmd)
-            matlab.run(cmd)
-            log_callback('matlab exited')
-            if os.path.exists(feature_csv):
-                log_callback('features found at %s' % feature_csv)
-            else:
-                raise Exception('no features found')
-            log_callback('uploading %s' % features_url)
-            secure_upload(feature_csv, features_url, API_KEY)
-            if os.path.exists(multiblob_csv):
-                log_callback('multiblob found at %s' % multiblob_csv)
-                log_callback('uploading %s' % multiblob_url)
-                upload(multiblob_csv, multiblob_url)
-                log_callback('complete')
-            client.wakeup()
+    session.expire_all() # don't be stale!
+    roots = get_data_roots(session, parsed_pid[TS_LABEL])
+    fileset = parsed_pid2fileset(parsed_pid, roots, session)
+    # reuse the blobs if we can find them, otherwise segment again
+    blob_zip_path = find_blob_zip(parsed_pid)
+    if blob_zip_path is None:
+        log_callback('no blobs found for %s, segmenting' % pid)
+    with safe_tempdir() as job_dir:
+        feature_csv = os.path.join(job_dir, features_csv_name(bin_lid))
+        multiblob_csv = os.path.join(job_dir, multiblob_csv_name(bin_lid))
+        n = extract_bin(parsed_pid, bin_pid, fileset,
+                        features_csv=feature_csv, multiblob_csv=multiblob_csv,
+                        blob_zip_path=blob_zip_path, log_callback=log_callback)
+        log_callback('computed features for %d ROIs' % n)
+        log_callback('uploading %s' % features_url)
+        secure_upload(feature_csv, features_url, API_KEY)
+        log_callback('uploading %s' % multiblob_url)
+        secure_upload(multiblob_csv, multiblob_url, API_KEY)
+        log_callback('complete')
+    client.wakeup()
+
+# the work this worker does, for do_all_work or for consuming
+# dispatched products (see oii.ifcb2.workflow.dispatch_worker)
+WORK = dict(
+    roles=[BLOBS2FEATURES],
+    callback=extract_features,
+    ttl=310,
+    message='features/multiblob CSVs deposited')
 
 @wakeup_task
 def features_wakeup(wakeup_key):
-    client.do_all_work(
-        roles=[BLOBS2FEATURES],
-        callback=extract_features,
-        ttl=310,
-        message='features/multiblob CSVs deposited')
+    client.do_all_work(**WORK)
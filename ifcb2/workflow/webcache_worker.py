@@ -1,15 +1,16 @@
+import os
 import logging
-from StringIO import StringIO
-import shutil
-
-import tempfile
-import requests
 
 from oii.ifcb2 import get_resolver
-from oii.ifcb2 import PID, LID, TS_LABEL, NAMESPACE, BIN_LID
+from oii.ifcb2 import PID, LID, TS_LABEL, NAMESPACE, BIN_LID, SCHEMA_VERSION
 from oii.ifcb2.workflow import WEBCACHE_PRODUCT, BINZIP2WEBCACHE
 from oii.ifcb2.identifiers import as_product, parse_pid
-from oii.ifcb2.represent import binpid2zip
+from oii.ifcb2.files import parsed_pid2fileset, get_data_roots, get_product_destination
+from oii.ifcb2.formats.adc import SCHEMA_VERSION_1
+from oii.ifcb2.bincache import BinCache
+from oii.ifcb2.mosaics import render_pyramid
+
+from oii.ifcb2.session import session
 
 from oii.workflow import COMPLETED, AVAILABLE, ERROR
 from oii.workflow.client import WorkflowClient
@@ -18,24 +19,41 @@ from oii.workflow.async import async, wakeup_task
 ### FIXME config this right
 client = WorkflowClient()
 
+bin_cache = BinCache()
+
 def do_webcache(pid,job):
+    """pre-render all mosaic pages of a bin where the dashboard
+    will find them (see oii.ifcb2.mosaics)"""
     parsed = parse_pid(pid)
     bin_pid = ''.join([parsed[NAMESPACE], parsed[BIN_LID]])
-    mosaic_base_url = '%sapi/mosaic/size/800x600/scale/0.33/page/1' % parsed[NAMESPACE]
-    mosaic_json = '%s/%s.json' % (mosaic_base_url, bin_pid)
-    mosaic_jpg = '%s/%s.jpg' % (mosaic_base_url, bin_pid)
-    logging.warn('WEBCACHE hitting %s' % mosaic_json)
-    r1 = requests.get(mosaic_json)
-    json = r1.json() # read it, and throw it away
-    logging.warn('WEBCACHE hitting %s' % mosaic_jpg)
-    r2 = requests.get(mosaic_jpg)
-    img_data = StringIO(r2.content) # read it, and throw it away
-    logging.warn('WEBCACHE done for %s' % pid)
+    schema_version = parsed[SCHEMA_VERSION]
+    stitch = schema_version == SCHEMA_VERSION_1
+    session.expire_all() # don't be stale!
+    roots = get_data_roots(session, parsed[TS_LABEL])
+    fileset = parsed_pid2fileset(parsed, roots, session)
+    mosaic_path = get_product_destination(session, as_product(bin_pid, 'mosaic'))
+    pyramid_dir = os.path.splitext(mosaic_path)[0]
+    logging.warn('WEBCACHE rendering mosaic pages for %s in %s' % (pid, pyramid_dir))
+    def layout_fn(size):
+        return bin_cache.get_layout(fileset, schema_version, stitch, size)
+    def targets_fn(indexes):
+        return bin_cache.get(fileset, schema_version).get_targets(bin_pid, stitch, indexes)
+    def progress_callback(n):
+        # rendering a large bin takes much longer than the job's TTL
+        client.heartbeat(pid, message='rendered %d mosaic pages' % n)
+    n = render_pyramid(layout_fn, targets_fn, fileset['roi_path'], pyramid_dir,
+                       progress_callback=progress_callback)
+    bin_cache.cache_clear()
+    logging.warn('WEBCACHE rendered %d mosaic pages for %s' % (n, pid))
+
+# the work this worker does, for do_all_work or for consuming
+# dispatched products (see oii.ifcb2.workflow.dispatch_worker)
+WORK = dict(
+    roles=[BINZIP2WEBCACHE],
+    callback=do_webcache,
+    ttl=37,
+    message='hit webcache URLs')
 
 @wakeup_task
 def webcache_wakeup(wakeup_key):
-    client.do_all_work(
-        roles=[BINZIP2WEBCACHE],
-        callback=do_webcache,
-        ttl=37,
-        message='hit webcache URLs')
+    client.do_all_work(**WORK)
@@ -39,10 +39,14 @@ def do_binzip(pid, job):
     log_callback('deposited %s' % binzip_url)
     client.wakeup()
 
+# the work this worker does, for do_all_work or for consuming
+# dispatched products (see oii.ifcb2.workflow.dispatch_worker)
+WORK = dict(
+    roles=[RAW2BINZIP],
+    callback=do_binzip,
+    ttl=217,
+    message='deposited bin zip')
+
 @wakeup_task
 def binzip_wakeup(wakeup_key):
-    client.do_all_work(
-        roles=[RAW2BINZIP],
-        callback=do_binzip,
-        ttl=217,
-        message='deposited bin zip')
+    client.do_all_work(**WORK)
@@ -1,7 +1,8 @@
 #!/usr/bin/python
 # create a mosaic image 
+import numpy as np
 from PIL import Image
-from oii.image.mosaic.binpacking import JimScottRectanglePacker
+from oii.image.mosaic.binpacking import pack_pages
 
 X=0
 Y=1
@@ -16,7 +17,32 @@ class Tile(object):
         self.size = (w,h)
         self.position = position
 
-def layout(tiles, (width, height), page=1, threshold=1.0):
+def layout_pages(tiles, (width, height), open_pages=None):
+    """Lay out tiles on as many pages as it takes. Each tile goes on the
+    first page it fits on (see binpacking.pack_pages). Returns a list of
+    pages, each a list of positioned Tiles in tile order. Tiles too large
+    for a page are left out, with a position of None.
+
+    Parameters:
+    tiles - iterable of things with a "size" = (w,h) property.
+    (width, height) - the pixel dimensions of each page.
+    open_pages - if not None, how many of the most recent pages to try
+    fitting each tile on before starting another page. Lower values
+    mean sparser pages but better performance. The default is all
+    pages."""
+    tiles = list(tiles)
+    sizes = np.array([tile.size for tile in tiles], dtype=np.int64).reshape((len(tiles),2))
+    pages, xs, ys = pack_pages(sizes[:,X], sizes[:,Y], (width, height), open_pages)
+    result = [[] for _ in range(pages.max() if len(tiles) else 0)]
+    for tile, page, x, y in zip(tiles, pages.tolist(), xs.tolist(), ys.tolist()):
+        if page > 0:
+            tile.position = (x, y)
+            result[page-1].append(tile)
+        else:
+            tile.position = None
+    return result
+
+def layout(tiles, (width, height), page=1, threshold=None, open_pages=None):
     """Fit tiles into a rectangle using a bin packing algorithm. Returns Tiles
     describing the layout.
     
@@ -25,36 +51,16 @@ def layout(tiles, (width, height), page=1, threshold=1.0):
     If you need some construct them with Tile, but you can use PIL images without
     wrapping them in Tile.
     (width, height) - the pixel dimensions of the desired mosaic.
-    threshold -
-    Because multi-page layouts are expensive, after enough failures to pack,
-    the rest of the tiles are skipped, according to a threshold expressed
-    as a fraction of the tiles attempted. the default is 1.0, or no skipping.
-    Lower thresholds may mean more, sparser pages, but will greatly increase
-    performance."""
-    while page > 0: # for each page
-        # initialize a packer, and run tracking
-        packer = JimScottRectanglePacker(width, height)
-        (run, max_run) = (0, 0)
-        for tile in tiles: # for each tile
-            (w,h) = tile.size
-            tile.position = packer.TryPack(w,h) # attempt to fit
-            if tile.position is None: # if not
-                run += 1 # track run length of misses
-                if run > len(tiles) * threshold:
-                    break
-            else: # this tile has been positioned, reset miss run
-                if run > 0 and run > max_run:
-                    max_run = run
-                run = 0
-        if page == 1: # on the desired page?
-            # return the tiles that were positioned
-            tiles[:] = [tile for tile in tiles if tile.position is not None]
-            return tiles
-        else:
-            # remove the positioned tiles and recur
-            tiles[:] = [tile for tile in tiles if tile.position is None]
-            page -= 1
-    
+    page - which page of a multi-page layout to return, starting at 1
+    threshold - no longer used; see open_pages
+    open_pages - see layout_pages"""
+    pages = layout_pages(tiles, (width, height), open_pages)
+    if page <= len(pages):
+        tiles[:] = pages[page-1]
+    else:
+        tiles[:] = []
+    return tiles
+
 def composite(layout, size=None, mode='RGB', bgcolor=0):
     """Construct a composite image from a layout
     
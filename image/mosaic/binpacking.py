@@ -14,6 +14,8 @@ License along with this library
 """
 from bisect import bisect_left
 from collections import namedtuple
+
+import numpy as np
  
 class OutOfSpaceError(Exception): pass
 
@@ -319,3 +321,80 @@ class JimScottRectanglePacker(RectanglePacker):
         node =  self.tree.insert(w, h)
         if node is not None:
             return Point(node.left, node.top)
+
+# the following packer keeps its state in flat arrays and packs many
+# rectangles onto many pages in one call
+
+def window_max(a, w):
+    """the maximum of each run of w consecutive elements of an array"""
+    m, k = a, 1
+    # after each step m[i] = max(a[i:i+k])
+    while k * 2 <= w:
+        m = np.maximum(m[:-k], m[k:])
+        k *= 2
+    n = len(a) - w + 1
+    return np.maximum(m[:n], m[w-k:w-k+n])
+
+class SkylineRectanglePacker(RectanglePacker):
+    """Packer that places each rectangle as low as possible, and then as
+    far left as possible, on the skyline formed by the rectangles already
+    placed. The skyline is an array of the occupied height of each column
+    of the packing area, so each placement is a few array operations"""
+    def __init__(self, packingAreaWidth, packingAreaHeight):
+        RectanglePacker.__init__(self, packingAreaWidth, packingAreaHeight)
+        self.skyline = np.zeros(packingAreaWidth, dtype=np.int64)
+        self.lowest = 0 # lowest point of the skyline
+
+    def TryPack(self, rectangleWidth, rectangleHeight):
+        if rectangleWidth > self.packingAreaWidth or rectangleWidth < 1:
+            return None
+        if self.lowest + rectangleHeight > self.packingAreaHeight:
+            return None
+        tops = window_max(self.skyline, rectangleWidth)
+        x = int(np.argmin(tops))
+        y = int(tops[x])
+        if y + rectangleHeight > self.packingAreaHeight:
+            return None
+        self.skyline[x:x+rectangleWidth] = y + rectangleHeight
+        self.lowest = int(self.skyline.min())
+        return Point(x, y)
+
+def pack_pages(widths, heights, (pageWidth, pageHeight), open_pages=None):
+    """Pack rectangles, in order, onto as many pages as needed. Each
+    rectangle goes on the first open page it fits on; with all pages
+    open, the result is the same as packing the first page with as many
+    rectangles as will fit, then the second page with the rest, and so
+    on.
+
+    widths, heights: sizes of the rectangles, typically largest first
+    open_pages: if not None, only try this many of the most recently
+    started pages before starting a new one. fewer is faster, but
+    leaves pages sparser
+
+    Returns arrays of the page (starting at 1, or 0 if the rectangle is
+    larger than a page) and x and y position of each rectangle"""
+    widths = np.asarray(widths, dtype=np.int64)
+    heights = np.asarray(heights, dtype=np.int64)
+    n = len(widths)
+    pages = np.zeros(n, dtype=np.int64)
+    xs = np.zeros(n, dtype=np.int64)
+    ys = np.zeros(n, dtype=np.int64)
+    packers = [] # open pages, oldest first
+    first_page = 1 # page number of packers[0]
+    fits = (widths <= pageWidth) & (heights <= pageHeight) & (widths > 0)
+    for i in np.flatnonzero(fits).tolist():
+        w, h = widths[i], heights[i]
+        for j, packer in enumerate(packers):
+            point = packer.TryPack(w, h)
+            if point is not None:
+                break
+        else:
+            if open_pages is not None and len(packers) >= open_pages:
+                packers.pop(0)
+                first_page += 1
+            packers.append(SkylineRectanglePacker(pageWidth, pageHeight))
+            j = len(packers) - 1
+            point = packers[j].TryPack(w, h)
+        pages[i] = first_page + j
+        xs[i], ys[i] = point
+    return pages, xs, ys
@@ -1,6 +1,8 @@
 import sys
 import operator
 import os
+import stat
+import glob
 from urllib2 import urlopen
 from StringIO import StringIO
 from lxml import etree
@@ -674,6 +676,512 @@ def invoke(name,bindings={},global_namespace={}):
     else:
         logging.warn('invoke: %s is not a rule' % name)
 
+## compiled evaluation
+# a namespace can be compiled ahead of time into closures that produce the
+# same solutions as evaluate_block/invoke. attribute templates and regexes
+# are parsed once per expression rather than on every evaluation, and
+# bindings are held in chained Scope objects instead of being copied at
+# every step.
+
+class Scope(object):
+    """A chain of binding dicts. Lookups search the innermost dict first.
+    The dicts in the chain are never modified"""
+    __slots__ = ('local','parent')
+    def __init__(self,local={},parent=None):
+        self.local = local
+        self.parent = parent
+    def child(self,local):
+        if not local:
+            return self
+        return Scope(local,self)
+    def __getitem__(self,key):
+        scope = self
+        while scope is not None:
+            try:
+                return scope.local[key]
+            except KeyError:
+                scope = scope.parent
+        raise KeyError(key)
+    def __contains__(self,key):
+        try:
+            self[key]
+            return True
+        except KeyError:
+            return False
+    def flatten(self,include=None):
+        locals_ = []
+        scope = self
+        while scope is not None:
+            locals_.append(scope.local)
+            scope = scope.parent
+        result = {}
+        for local in reversed(locals_):
+            result.update(local)
+        if include is not None:
+            return flatten(result,include)
+        return result
+    def keys(self):
+        return self.flatten().keys()
+
+def _constant(value):
+    fn = lambda scope: value
+    fn.constant = True
+    return fn
+
+def compile_template(template):
+    """compile an interpolation template (see interpolate) into a function
+    of a scope. templates with no variable references compile to constants"""
+    if not '$' in coalesce(template,''):
+        return _constant(template)
+    parts = []
+    end = 0
+    for m in re.finditer(LDR_INTERP_PATTERN,template):
+        end = m.end()
+        (plain, expr, key) = m.groups()
+        parts.append((plain, key))
+    tail = template[end:]
+    def _interpolate(scope):
+        s = []
+        for plain, key in parts:
+            s.append(plain)
+            try:
+                value = scope[key]
+            except KeyError:
+                raise UnboundVariable(key)
+            if not isinstance(value,basestring):
+                value = str(value)
+            s.append(value)
+        s.append(tail)
+        return ''.join(s)
+    return _interpolate
+
+def _is_constant(template_fn):
+    return getattr(template_fn,'constant',False)
+
+def _vars_arg(template_fn,scope):
+    # compiled equivalent of parse_vars_arg
+    var_name_list = template_fn(scope)
+    if var_name_list:
+        return [var for var in re.split(LDR_WS_SEP_PATTERN,var_name_list) if var != '']
+    return None
+
+def _try_compile_regex(pattern):
+    # compile constant patterns up front; leave bad ones to fail at evaluation time
+    try:
+        return compile_regex(pattern)
+    except re.error:
+        return None
+
+_BLOCK_MODIFIERS = ['include','exclude','rename','as','distinct','count','nth']
+
+def _compile_modifiers(elt,interpolated=True):
+    """compile block-level modifiers (see with_pre_block and with_post_block)
+    into a function that wraps a solution generator. rule-level modifiers
+    are not interpolated. returns None if the element has no modifiers"""
+    if not [m for m in _BLOCK_MODIFIERS if elt.get(m) is not None]:
+        return None
+    if interpolated:
+        t = dict((m, compile_template(elt.get(m))) for m in _BLOCK_MODIFIERS)
+    else:
+        t = dict((m, _constant(elt.get(m))) for m in _BLOCK_MODIFIERS)
+    def with_modifiers(S,scope):
+        # pre-block
+        include = _vars_arg(t['include'],scope)
+        exclude = _vars_arg(t['exclude'],scope)
+        if include is not None or exclude is not None:
+            S = with_inc_exc(S,include,exclude)
+        rename = _vars_arg(t['rename'],scope)
+        rename_as = _vars_arg(t['as'],scope)
+        if rename is not None and rename_as is not None:
+            S = with_aliases(S,dict(zip(rename,rename_as)))
+        # post-block
+        distinct = _vars_arg(t['distinct'],scope)
+        if distinct is not None:
+            S = with_distinct(S,distinct)
+        count = t['count'](scope)
+        nth = t['nth'](scope)
+        if nth is not None:
+            nth = int(nth)
+        if count is not None or nth is not None:
+            S = with_count(S,count,nth)
+        return S
+    return with_modifiers
+
+def _compile_block(elts,namespace):
+    """compile a sequence of expressions into a function that takes a Scope
+    and returns a solution generator"""
+    if len(elts)==0:
+        # terminal case
+        return lambda scope: (scope.flatten(),)
+    return _compile_expr(elts[0],_compile_block(elts[1:],namespace),namespace)
+
+def _compile_expr(elt,next_block,namespace):
+    """compile one expression, given the compiled remainder of its block.
+    each case corresponds to a case in evaluate_block"""
+    tag = elt.tag
+    attr = lambda name: compile_template(elt.get(name))
+    # rest (see evaluate_block)
+    retain_t = attr('retain')
+    if _is_constant(retain_t) and not retain_t(None):
+        def rest(scope,inner={}):
+            return next_block(scope.child(inner))
+    else:
+        def rest(scope,inner={}):
+            retain = retain_t(scope)
+            S = next_block(scope.child(inner))
+            if not retain:
+                return S
+            discard = set(scope.keys()).difference(set(_vars_arg(retain_t,scope)))
+            return (flatten(ss,exclude=discard) for ss in S)
+    # inner_block (see evaluate_block)
+    children = list(elt)
+    modifiers = _compile_modifiers(elt)
+    if len(children)==0 and modifiers is None:
+        # with no inner block, each solution simply recurs
+        def inner_block(scope,inner_bindings={},solution_generator=None):
+            if solution_generator is None:
+                return rest(scope,inner_bindings)
+            return (ss for s in solution_generator for ss in rest(scope,s))
+    else:
+        child_block = _compile_block(children,namespace)
+        def inner_block(scope,inner_bindings={},solution_generator=None):
+            if solution_generator is None:
+                S = child_block(scope.child(inner_bindings))
+            else:
+                S = (ss for s in solution_generator for ss in child_block(scope.child(s)))
+            if modifiers is not None:
+                S = modifiers(S,scope)
+            return (ss for s in S for ss in rest(scope,s))
+    # match and split arguments (see parse_match_args)
+    value_t, var_t = attr('value'), attr('var')
+    timestamp_t, pattern_t = attr('timestamp'), attr('pattern')
+    def match_args(scope,default_pattern):
+        value = value_t(scope)
+        if not value:
+            var_arg = coalesce(var_t(scope),'_')
+            try:
+                value = str(scope[var_arg])
+            except KeyError:
+                raise UnboundVariable(var_arg)
+        timestamp = timestamp_t(scope)
+        if timestamp is not None:
+            pattern = timestamp2regex(timestamp)
+        else:
+            pattern = coalesce(pattern_t(scope),default_pattern)
+        return pattern, value
+    def constant_pattern(default_pattern):
+        # the compiled pattern, if it does not depend on bindings
+        if _is_constant(timestamp_t) and _is_constant(pattern_t):
+            timestamp = timestamp_t(None)
+            if timestamp is not None:
+                return _try_compile_regex(timestamp2regex(timestamp))
+            return _try_compile_regex(coalesce(pattern_t(None),default_pattern))
+    if tag=='miss':
+        return lambda scope: ()
+    elif tag=='hit':
+        child_block = _compile_block(children,namespace)
+        def _hit(scope):
+            S = child_block(scope)
+            if modifiers is not None:
+                S = modifiers(S,scope)
+            for s in S:
+                yield s
+                for ss in rest(scope,s):
+                    yield ss
+        return _hit
+    elif tag=='invoke':
+        rule_t, using_t = attr('rule'), attr('using')
+        def _invoke(scope):
+            rule_name = rule_t(scope)
+            using = _vars_arg(using_t,scope)
+            args = scope.flatten(using)
+            return inner_block(scope,solution_generator=namespace.invoke(rule_name,args))
+        return _invoke
+    elif tag=='var':
+        name_t, text_t = attr('name'), compile_template(elt.text)
+        val_ts = [compile_template(v.text) for v in elt.findall('val')]
+        def _var(scope):
+            var_name = coalesce(name_t(scope),'_')
+            try:
+                if len(val_ts) == 0:
+                    for s in rest(scope,{var_name:text_t(scope)}):
+                        yield s
+                else:
+                    for val_t in val_ts:
+                        for s in rest(scope,{var_name:val_t(scope)}):
+                            yield s
+            except UnboundVariable, uv:
+                logging.warn('var %s: unbound variable in template "%s": %s' % (var_name, elt.text, uv))
+                return # miss
+        return _var
+    elif tag=='vars':
+        names_t, delim_t = attr('names'), attr('delim')
+        raw_texts = [elt.text] + [v.text for v in elt.findall('vals')]
+        if _is_constant(delim_t) and None not in raw_texts:
+            # split and compile each value template once
+            delim = coalesce(delim_t(None),LDR_WS_SEP_PATTERN)
+            val_ts = [[compile_template(t) for t in re.split(delim,raw_text)] for raw_text in raw_texts]
+            split_vals = lambda scope, i: [t(scope) for t in val_ts[i]]
+        else:
+            def split_vals(scope,i):
+                delim = coalesce(delim_t(scope),LDR_WS_SEP_PATTERN)
+                return map(lambda t: interpolate(t,scope), re.split(delim,raw_texts[i]))
+        def _vars(scope):
+            try:
+                var_names = re.split(LDR_WS_SEP_PATTERN,names_t(scope))
+                if len(raw_texts) == 1:
+                    for s in rest(scope,dict(zip(var_names,split_vals(scope,0)))):
+                        yield s
+                else:
+                    for i in range(1,len(raw_texts)):
+                        for s in rest(scope,dict(zip(var_names,split_vals(scope,i)))):
+                            yield s
+            except UnboundVariable, uv:
+                logging.warn('vars: unbound variable %s' % uv)
+                return # miss
+        return _vars
+    elif tag=='all':
+        return inner_block
+    elif tag in ('any','first'):
+        sub_blocks = [_compile_block([sub_elt],namespace) for sub_elt in children]
+        first = tag=='first'
+        def _any(scope):
+            for sub_block in sub_blocks:
+                done = False
+                for s in sub_block(scope):
+                    for ss in rest(scope,s):
+                        done = True
+                        yield ss
+                if done and first:
+                    return
+        return _any
+    elif tag=='none':
+        def _none(scope):
+            for s in inner_block(scope):
+                return # miss
+            for s in rest(scope):
+                yield s
+        return _none
+    elif tag=='log':
+        text_t = compile_template(elt.text)
+        def _log(scope):
+            print text_t(scope)
+            for s in rest(scope):
+                yield s
+        return _log
+    elif tag=='match':
+        optional_t, groups_t = attr('optional'), attr('groups')
+        p_const = constant_pattern('.*')
+        def _match(scope):
+            optional = optional_t(scope)
+            optional = optional is not None and optional in ['true', 'True', 'yes', 'Yes']
+            m = False
+            try:
+                if p_const is not None:
+                    _, value = match_args(scope,'.*')
+                    p = p_const
+                else:
+                    pattern, value = match_args(scope,'.*')
+                    p = compile_regex(pattern)
+                group_name_list, group_names = groups_t(scope), []
+                if group_name_list:
+                    group_names = re.split(LDR_WS_SEP_PATTERN,group_name_list)
+                m = p.match(value)
+            except UnboundVariable, uv:
+                if not optional:
+                    logging.warn('match: unbound variable %s' % uv)
+                    return # miss
+            if m:
+                groups = m.groups()
+                named_ixs = p.groupindex.values()
+                groups_minus_named = [n for n in range(len(groups)) if n+1 not in named_ixs]
+                inner_bindings = {}
+                # bind user-specified groups to group names
+                for name,n in zip(group_names, groups_minus_named):
+                    if groups[n] is not None:
+                        inner_bindings[name] = groups[n]
+                # bind pattern-specified groups to group names
+                for name,group in m.groupdict().items():
+                    if group is not None:
+                        inner_bindings[name] = group
+                for s in inner_block(scope,inner_bindings):
+                    yield s
+            elif optional:
+                for s in rest(scope):
+                    yield s
+        return _match
+    elif tag=='test':
+        ops = [(op, attr(op)) for op in ['eq','gt','lt','ge','le','ne'] if elt.get(op) is not None]
+        def _test(scope):
+            try:
+                var = var_t(scope)
+                value = value_t(scope)
+                if value is None:
+                    value = scope[var]
+            except KeyError:
+                logging.warn('test: unbound variable %s' % var)
+                return # miss
+            except UnboundVariable, uv:
+                logging.warn('test: unbound variable %s' % uv)
+                return # miss
+            op, tv = None, None
+            for o, o_t in ops:
+                tv = o_t(scope)
+                if tv:
+                    op = o
+                    break
+            if op is None:
+                tv = elt.get(op)
+            if eval_test(value,op,tv): # hit
+                for s in inner_block(scope):
+                    yield s
+        return _test
+    elif tag=='split':
+        vars_t, group_t = attr('vars'), attr('group')
+        p_const = constant_pattern(LDR_WS_SEP_REGEX)
+        def _split(scope):
+            try:
+                pattern, value = match_args(scope,LDR_WS_SEP_REGEX)
+            except UnboundVariable, uv:
+                logging.warn('split: unbound variable %s' % uv)
+                return # miss
+            if p_const is not None:
+                vals = p_const.split(value)
+            else:
+                vals = re.split(pattern,value)
+            var_names = _vars_arg(vars_t,scope)
+            group = group_t(scope)
+            if group:
+                for s in inner_block(scope,solution_generator=({group: val} for val in vals)):
+                    yield s
+            elif var_names:
+                for s in inner_block(scope,dict(zip(var_names, vals))):
+                    yield s
+        return _split
+    elif tag=='path':
+        match_t = attr('match')
+        def _path(scope):
+            try:
+                match_expr = coalesce(match_t(scope),'')
+            except UnboundVariable, uv:
+                logging.warn('path: unbound variable %s' % uv)
+                return # pass
+            var_name = coalesce(var_t(scope),'_')
+            # one stat answers both exists and isfile
+            try:
+                st = os.stat(match_expr)
+            except OSError:
+                st = None
+            if st is not None and stat.S_ISREG(st.st_mode):
+                # hit; recur on inner block
+                for s in inner_block(scope,{var_name: match_expr}):
+                    yield s
+                return
+            if glob.has_magic(match_expr):
+                glob_hits = sorted(iglob(match_expr))
+            elif st is not None:
+                glob_hits = [match_expr] # a literal path that exists, e.g., a directory
+            elif os.path.basename(match_expr) and os.path.lexists(match_expr):
+                glob_hits = [match_expr] # e.g., a broken symlink
+            else:
+                glob_hits = []
+            S = ({var_name: glob_hit} for glob_hit in glob_hits)
+            for s in inner_block(scope,solution_generator=S):
+                yield s
+        return _path
+    elif tag=='lines':
+        url_t, file_t = attr('url'), attr('file')
+        def _lines(scope):
+            var_name = coalesce(var_t(scope),'_')
+            url, file_path = url_t(scope), coalesce(file_t(scope),'-')
+            if url is not None:
+                iterable = urlopen(url)
+            else:
+                iterable = fileinput.input(file_path)
+            S = ({var_name: raw_line.rstrip()} for raw_line in iterable)
+            return inner_block(scope,solution_generator=S)
+        return _lines
+    elif tag=='csv':
+        vars_t, url_t, file_t = attr('vars'), attr('url'), attr('file')
+        def _csv(scope):
+            vars = _vars_arg(vars_t,scope)
+            url, file_path = url_t(scope), coalesce(file_t(scope),'-')
+            reader = csv.DictReader(open_source_arg(url, file_path),vars)
+            S = (flatten(s,vars) for s in reader)
+            return inner_block(scope,solution_generator=S)
+        return _csv
+    elif tag=='json':
+        url_t, file_t = attr('url'), attr('file')
+        select_t, from_t = attr('select'), attr('from')
+        def _json(scope):
+            url, file_path = url_t(scope), coalesce(file_t(scope),'-')
+            select = select_t(scope)
+            from_arg = from_t(scope)
+            var = var_t(scope) # don't default to _
+            if from_arg is not None:
+                parsed = scope[from_arg]
+            else:
+                parsed = json.load(open_source_arg(url, file_path))
+            if select is None and var is not None:
+                return inner_block(scope,{var:parsed})
+            if var is None:
+                S = jsonquery(parsed, select)
+            else:
+                S = ({var: result} for result in jsonquery(parsed, select))
+            return inner_block(scope,solution_generator=S)
+        return _json
+    else:
+        return rest
+
+class CompiledNamespace(object):
+    """Compiled rules of a parsed namespace (see parse). rules that
+    have not been compiled yet are compiled on first invocation"""
+    def __init__(self,namespace):
+        self.namespace = namespace
+        self.rules = {}
+    def _compile_rule(self,name,expr):
+        if expr.tag != 'rule':
+            def _not_a_rule(bindings):
+                logging.warn('invoke: %s is not a rule' % name)
+                return ()
+            return _not_a_rule
+        uses = parse_vars_arg(expr,'uses')
+        block = _compile_block(list(expr),self)
+        modifiers = _compile_modifiers(expr,interpolated=False)
+        def _rule(bindings):
+            # enforce required variables
+            if uses is not None:
+                for u in uses:
+                    if u not in bindings:
+                        logging.warn('invoke: missing variable in uses: %s' % u)
+                        return ()
+            scope = Scope(bindings)
+            S = block(scope)
+            if modifiers is not None:
+                S = modifiers(S,scope)
+            return S
+        return _rule
+    def invoke(self,name,bindings={}):
+        """invoke a named rule; equivalent to invoke(name,bindings,namespace)"""
+        try:
+            rule = self.rules[name]
+        except KeyError:
+            try:
+                expr = self.namespace[name]
+            except KeyError:
+                logging.warn('invoke: no such rule %s' % name)
+                return ()
+            rule = self.rules[name] = self._compile_rule(name,expr)
+        return rule(bindings)
+
+def compile_namespace(namespace):
+    """compile a parsed namespace (see parse) ahead of time, so that
+    rules can be invoked with CompiledNamespace.invoke"""
+    compiled = CompiledNamespace(namespace)
+    for name, expr in namespace.items():
+        compiled.rules[name] = compiled._compile_rule(name,expr)
+    return compiled
+
 def parse(*ldr_streams):
     namespace = {}
     for ldr_stream in ldr_streams:
@@ -691,11 +1199,20 @@ def parse(*ldr_streams):
     return namespace
 
 class Resolver(object):
-    def __init__(self,*files):
+    def __init__(self,*files,**kw):
+        """pass compiled=True to evaluate rules with compiled closures
+        (see compile_namespace) rather than the interpreter"""
         self.namespace = parse(*files)
+        self.compiled = None
+        if kw.get('compiled',False):
+            self.compiled = compile_namespace(self.namespace)
         self._add_positional_functions()
     def invoke(self,name,**bindings):
-        for s in invoke(name,bindings,self.namespace):
+        if self.compiled is not None:
+            S = self.compiled.invoke(name,bindings)
+        else:
+            S = invoke(name,bindings,self.namespace)
+        for s in S:
             yield s
     def as_function(self,name):
         def _fn(**bindings):
@@ -730,8 +1247,8 @@ class Resolver(object):
 def locate_resolver(relative_path):
     return search_path(relative_path)
     
-def get_resolver(relative_path):
-    return Resolver(locate_resolver(relative_path))
+def get_resolver(relative_path,compiled=False):
+    return Resolver(locate_resolver(relative_path),compiled=compiled)
 
 if __name__=='__main__':
     """usage example
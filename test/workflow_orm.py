@@ -0,0 +1,139 @@
+"""tests of oii.workflow.orm on SQLite. run like this:
+
+python test/workflow_orm.py"""
+import os
+import shutil
+import tempfile
+import unittest
+
+import sqlalchemy as sqla
+from sqlalchemy.orm import sessionmaker
+
+from oii.workflow import WAITING, RUNNING, AVAILABLE
+from oii.workflow.orm import Base, Product, Dependency, Products
+
+class ProductsTest(unittest.TestCase):
+    def setUp(self):
+        # a file, so that more than one session can use the database
+        self.dir = tempfile.mkdtemp()
+        engine = sqla.create_engine('sqlite:///%s' % os.path.join(self.dir, 'workflow.db'))
+        Base.metadata.create_all(engine)
+        self.Session = sessionmaker(bind=engine)
+        self.session = self.Session()
+    def tearDown(self):
+        self.session.close()
+        shutil.rmtree(self.dir)
+    def add(self, pid, state=AVAILABLE, priority=100):
+        p = Product(pid=pid, state=state, priority=priority)
+        self.session.add(p)
+        return p
+    def depend(self, deps, role='r'):
+        """deps is a list of (downstream pid, upstream pid)"""
+        ps = Products(self.session)
+        for down, up in deps:
+            ps.add_dep(ps.get(down), ps.get(up), role)
+        self.session.commit()
+    def pids(self, products):
+        return sorted(p.pid for p in products)
+
+class ClaimNextTest(ProductsTest):
+    def setUp(self):
+        super(ClaimNextTest, self).setUp()
+        self.add('up')
+        self.add('up_waiting', state=WAITING)
+        for i, priority in enumerate([30, 10, 20, 40]):
+            self.add('p%d' % i, state=WAITING, priority=priority)
+        self.add('blocked', state=WAITING, priority=1)
+        self.session.commit()
+        self.depend([('p%d' % i, 'up') for i in range(4)] + [('blocked', 'up_waiting')])
+    def test_claim_n_in_priority_order(self):
+        claimed = Products(self.session).claim_next(['r'], n=3)
+        self.assertEqual([p.pid for p in claimed], ['p1', 'p2', 'p0'])
+        for p in claimed:
+            self.assertEqual(p.state, RUNNING)
+            self.assertEqual(p.event, 'start_next')
+    def test_claim_fewer_than_n(self):
+        claimed = Products(self.session).claim_next(['r'], n=10)
+        self.assertEqual(self.pids(claimed), ['p0', 'p1', 'p2', 'p3'])
+        self.assertEqual(Products(self.session).claim_next(['r'], n=10), [])
+    def test_blocked_not_claimed(self):
+        claimed = Products(self.session).claim_next(['r'], n=10)
+        self.assertTrue('blocked' not in self.pids(claimed))
+        self.assertEqual(Products(self.session).get('blocked').state, WAITING)
+    def test_no_double_claim(self):
+        other = self.Session()
+        try:
+            a = self.pids(Products(self.session).claim_next(['r'], n=2))
+            b = self.pids(Products(other).claim_next(['r'], n=2))
+            c = self.pids(Products(other).claim_next(['r'], n=2))
+        finally:
+            other.close()
+        self.assertEqual(len(a), 2)
+        self.assertEqual(len(b), 2)
+        self.assertEqual(c, [])
+        self.assertEqual(sorted(a + b), ['p0', 'p1', 'p2', 'p3'])
+    def test_start_next(self):
+        p = Products(self.session).start_next(['r'])
+        self.assertEqual(p.pid, 'p1')
+        self.assertEqual(p.state, RUNNING)
+
+class GraphTest(ProductsTest):
+    # a <- b <- c <- e <- f <- g
+    #        <- d <-
+    def setUp(self):
+        super(GraphTest, self).setUp()
+        for pid in 'abcdefg':
+            self.add(pid)
+        self.add('lone')
+        self.session.commit()
+        self.depend([('b','a'), ('c','b'), ('d','b'), ('e','c'), ('e','d'), ('f','e'), ('g','f')])
+    def test_ancestors_and_descendants(self):
+        e = Products(self.session).get('e')
+        self.assertEqual(self.pids(e.ancestors), ['a', 'b', 'c', 'd'])
+        self.assertEqual(self.pids(e.descendants), ['f', 'g'])
+    def test_no_dependencies(self):
+        ps = Products(self.session)
+        lone = ps.get('lone')
+        self.assertEqual(lone.ancestors.all(), [])
+        self.assertEqual(lone.descendants.all(), [])
+        self.assertEqual(ps.get_graph('lone'), [])
+        self.assertEqual(ps.get('a').ancestors.all(), [])
+    def test_get_graph(self):
+        # the dependencies of c, its ancestors, and its descendants
+        edges = Products(self.session).get_graph('c')
+        self.assertEqual(sorted((d, u) for d, _, u, _ in edges),
+                         [('b','a'), ('c','b'), ('e','c'), ('e','d'), ('f','e'), ('g','f')])
+        self.assertEqual(Products(self.session).get_graph('nonexistent'), None)
+    def test_get_graph_leaves_out_other_graphs(self):
+        self.add('x')
+        self.add('y')
+        self.session.commit()
+        self.depend([('y','x')])
+        edges = Products(self.session).get_graph('y')
+        self.assertEqual([(d, u) for d, _, u, _ in edges], [('y','x')])
+    def test_delete_tree(self):
+        Products(self.session).delete_tree('e').commit()
+        self.assertEqual(self.pids(self.session.query(Product)), ['f', 'g', 'lone'])
+        self.assertEqual(self.session.query(Dependency).count(), 1)
+    def test_delete_tree_no_dependencies(self):
+        Products(self.session).delete_tree('lone').commit()
+        self.assertEqual(Products(self.session).get('lone'), None)
+    def test_delete_intermediate(self):
+        ps = Products(self.session)
+        ps.get('g').state = WAITING
+        self.session.commit()
+        ps.delete_intermediate()
+        # a is a root, f has a waiting dependent, g is a leaf
+        self.assertEqual(self.pids(self.session.query(Product)), ['a', 'f', 'g', 'lone'])
+        self.assertEqual(self.session.query(Dependency).count(), 1)
+    def test_deep_chain(self):
+        ps = Products(self.session)
+        for i in range(1000):
+            self.add('n%d' % i)
+        self.session.commit()
+        self.depend([('n%d' % i, 'n%d' % (i-1)) for i in range(1, 1000)])
+        self.assertEqual(ps.get('n999').ancestors.count(), 999)
+        self.assertEqual(ps.get('n0').descendants.count(), 999)
+
+if __name__=='__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+"""tests of the bulk endpoints of oii.workflow.webapi on SQLite. run
+like this:
+
+python test/workflow_webapi.py"""
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+from flask import Flask
+
+from oii.webapi.utils import UrlConverter
+from oii.workflow import PID, STATE, EVENT, MESSAGE, UPSTREAM, ROLE, PRIORITY, TTL, FOREVER
+from oii.workflow import WAITING, RUNNING, AVAILABLE, HEARTBEAT
+from oii.workflow.client import API_PREFIX
+from oii.workflow import webapi
+from oii.workflow.webapi import workflow_blueprint, DATABASE_URL
+
+class BulkEndpointsTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        app = Flask(__name__)
+        app.url_map.converters['url'] = UrlConverter
+        app.register_blueprint(workflow_blueprint, url_prefix=API_PREFIX)
+        app.config[DATABASE_URL] = 'sqlite:///%s' % os.path.join(self.dir, 'workflow.db')
+        self.client = app.test_client()
+    def tearDown(self):
+        webapi.ScopedSession.remove()
+        shutil.rmtree(self.dir)
+    def bulk(self, method, url, items):
+        r = self.client.open(API_PREFIX + url, method=method, data=json.dumps(items),
+                             content_type='application/json')
+        return r.status_code, json.loads(r.data)
+    def get(self, pid):
+        r = self.client.get(API_PREFIX + '/get/%s' % pid)
+        if r.status_code != 200:
+            return None
+        return json.loads(r.data)
+    def graph(self, pid):
+        r = self.client.get(API_PREFIX + '/get_graph/%s' % pid)
+        return sorted((e['downstream'], e['upstream'], e['role']) for e in json.loads(r.data))
+
+    def test_create_all(self):
+        status, created = self.bulk('PUT', '/create_all', [
+            { PID: 'a' },
+            { PID: 'b', STATE: WAITING, PRIORITY: 5 }
+        ])
+        self.assertEqual(status, 201)
+        self.assertEqual([p[PID] for p in created], ['a', 'b'])
+        self.assertEqual(self.get('a')[STATE], AVAILABLE)
+        self.assertEqual(self.get('b')[STATE], WAITING)
+    def test_create_all_leaves_existing_alone(self):
+        self.bulk('PUT', '/create_all', [{ PID: 'a', STATE: RUNNING }])
+        status, created = self.bulk('PUT', '/create_all', [
+            { PID: 'a', STATE: WAITING },
+            { PID: 'b' },
+            { PID: 'b' }
+        ])
+        self.assertEqual([p[PID] for p in created], ['b'])
+        self.assertEqual(self.get('a')[STATE], RUNNING)
+    def test_create_all_requires_pid(self):
+        r = self.client.put(API_PREFIX + '/create_all', data=json.dumps([{ STATE: WAITING }]),
+                            content_type='application/json')
+        self.assertEqual(r.status_code, 400)
+        self.assertEqual(self.client.put(API_PREFIX + '/create_all', data='{}').status_code, 400)
+
+    def test_depend_all(self):
+        status, dps = self.bulk('PUT', '/depend_all', [
+            { PID: 'binzip', UPSTREAM: 'raw', ROLE: 'raw2binzip' },
+            { PID: 'blobs', UPSTREAM: 'binzip', ROLE: 'binzip2blobs' },
+            { PID: 'features', UPSTREAM: 'blobs', ROLE: 'blobs2features', PRIORITY: 1 }
+        ])
+        self.assertEqual(status, 200)
+        self.assertEqual([p[PID] for p in dps], ['binzip', 'blobs', 'features'])
+        # upstream products are created as available, downstream as waiting
+        self.assertEqual(self.get('raw')[STATE], AVAILABLE)
+        self.assertEqual(self.get('blobs')[STATE], WAITING)
+        self.assertEqual(self.graph('blobs'), [
+            ('binzip', 'raw', 'raw2binzip'),
+            ('blobs', 'binzip', 'binzip2blobs'),
+            ('features', 'blobs', 'blobs2features')
+        ])
+    def test_depend_all_several_upstream(self):
+        status, dps = self.bulk('PUT', '/depend_all', [
+            { PID: 'merged', UPSTREAM: 'left', ROLE: 'l', PRIORITY: 7 },
+            { PID: 'merged', UPSTREAM: 'right', ROLE: 'r', PRIORITY: 7 }
+        ])
+        self.assertEqual([p[PID] for p in dps], ['merged'])
+        self.assertEqual(self.graph('merged'), [('merged', 'left', 'l'), ('merged', 'right', 'r')])
+    def test_depend_all_requires_upstream(self):
+        r = self.client.put(API_PREFIX + '/depend_all', data=json.dumps([{ PID: 'a' }]),
+                            content_type='application/json')
+        self.assertEqual(r.status_code, 400)
+        self.assertEqual(self.get('a'), None)
+
+    def test_update_all(self):
+        self.bulk('PUT', '/create_all', [{ PID: 'a', STATE: RUNNING }, { PID: 'b', STATE: RUNNING }])
+        status, updated = self.bulk('PATCH', '/update_all', [
+            { PID: 'a', MESSAGE: 'still going' },
+            { PID: 'b', STATE: AVAILABLE, EVENT: 'completed', TTL: FOREVER }
+        ])
+        self.assertEqual(status, 200)
+        self.assertEqual([p[PID] for p in updated], ['a', 'b'])
+        a, b = self.get('a'), self.get('b')
+        self.assertEqual((a[STATE], a[EVENT], a[MESSAGE]), (RUNNING, HEARTBEAT, 'still going'))
+        self.assertEqual((b[STATE], b[EVENT], b['expires']), (AVAILABLE, 'completed', None))
+    def test_update_all_in_order(self):
+        status, updated = self.bulk('PATCH', '/update_all', [
+            { PID: 'new', MESSAGE: 'first' },
+            { PID: 'new', STATE: AVAILABLE, MESSAGE: 'second' }
+        ])
+        self.assertEqual([p[PID] for p in updated], ['new'])
+        p = self.get('new')
+        self.assertEqual((p[STATE], p[MESSAGE]), (AVAILABLE, 'second'))
+
+if __name__=='__main__':
+    unittest.main()
@@ -1,5 +1,6 @@
 # utilities for oii
-from threading import Lock
+from threading import Lock, Event
+from collections import OrderedDict
 import os
 import re
 from hashlib import sha1
@@ -58,40 +59,80 @@ def doublewrap(f):
             return lambda realf: f(realf, *args, **kwargs)
     return new_dec
 
+# default maximum number of entries kept by a memoized function
+MEMOIZE_MAXSIZE=1024
+
 @doublewrap
-def memoize(fn,ttl=31557600,ignore_exceptions=False,key=None):
+def memoize(fn,ttl=31557600,ignore_exceptions=False,key=None,maxsize=MEMOIZE_MAXSIZE):
     """decorator to memoize a function by its args,
     with an expiration time. use this to wrap an idempotent
     or otherwise cacheable getter or transformation function.
     the function args must be hashable.
+    at most maxsize entries are kept (None for no limit); the least
+    recently used entry is evicted first.
     ignore exceptions means not to expire values in the case
     that the function to generate them raises an exception.
+    concurrent calls with the same args wait for a single call
+    to the function rather than each calling it.
     if a generator is received, silently applies list() to it.
     be very careful about memoizing generator functions as this
-    may not be desired"""
-    cache = {}
-    exp = {}
+    may not be desired.
+    the decorated function has cache_info() and cache_clear()"""
+    cache = OrderedDict() # args key -> (expiration time, value)
+    pending = {} # args key -> Event, for calls in progress
+    lock = Lock()
+    stats = dict(hits=0, misses=0, evictions=0)
     @wraps(fn)
     def inner(*args,**kw):
-        now = time.time()
         if key is not None:
             args_key = key(args)
         else:
             args_key = args
-        if args_key not in exp or now > exp[args_key] or args_key not in cache:
+        while True:
+            with lock:
+                entry = cache.get(args_key)
+                if entry is not None and time.time() <= entry[0]:
+                    stats['hits'] += 1
+                    cache[args_key] = cache.pop(args_key) # now most recently used
+                    return entry[1]
+                event = pending.get(args_key)
+                if event is None:
+                    stats['misses'] += 1
+                    event = pending[args_key] = Event()
+                    break
+            # another thread is computing this value; wait for it
+            event.wait()
+        try:
             try:
                 new_value = fn(*args,**kw)
             except:
-                if ignore_exceptions and args_key in cache:
-                    new_value = cache[args_key]
+                if ignore_exceptions and entry is not None:
+                    new_value = entry[1]
                 else:
                     raise
             # we've got a value to cache, but it's a generator; freeze it
             if isinstance(new_value, GeneratorType):
                 new_value = list(new_value)
-            cache[args_key] = new_value
-            exp[args_key] = now + ttl
-        return cache[args_key]
+            with lock:
+                cache.pop(args_key, None)
+                cache[args_key] = (time.time() + ttl, new_value)
+                while maxsize is not None and len(cache) > maxsize:
+                    cache.popitem(last=False)
+                    stats['evictions'] += 1
+            return new_value
+        finally:
+            with lock:
+                del pending[args_key]
+            event.set()
+    def cache_info():
+        """hit, miss, and eviction counts and current size"""
+        with lock:
+            return dict(stats, size=len(cache), maxsize=maxsize)
+    def cache_clear():
+        with lock:
+            cache.clear()
+    inner.cache_info = cache_info
+    inner.cache_clear = cache_clear
     return inner
 
 class imemoize(object):
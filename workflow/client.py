@@ -1,4 +1,6 @@
+import json
 import traceback
+from threading import Lock, Timer
 
 import requests
 
@@ -17,6 +19,14 @@ API_PREFIX='/workflow/api/v1'
 DEFAULT_PORT=9270
 DEFAULT_BASE_URL='http://localhost:%d' % DEFAULT_PORT
 
+# connections kept open to the workflow service, per client
+POOL_SIZE=10
+# heartbeats for a product are sent at most this often, in seconds.
+# must be well under the TTLs jobs are started with
+HEARTBEAT_INTERVAL=10
+# how many dependencies, creates, or updates to send per bulk request
+BULK_SIZE=1000
+
 class Busy(Exception):
     """A mutex is busy"""
     pass
@@ -26,106 +36,210 @@ class InconsistentState(Exception):
     pass
 
 class WorkflowClient(object):
-    def __init__(self, base_url=None):
+    def __init__(self, base_url=None, pool_size=POOL_SIZE, heartbeat_interval=HEARTBEAT_INTERVAL):
+        """heartbeat_interval - heartbeats sent more often than this are
+        held and sent together by a timer; 0 sends each one right away"""
         if base_url is None:
             base_url = DEFAULT_BASE_URL
         self.base_url = base_url
+        # a requests session reuses connections between calls
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.heartbeat_interval = heartbeat_interval
+        self._heartbeats = {} # pid -> latest heartbeat params not yet sent
+        self._heartbeat_timer = None
+        self._heartbeat_lock = Lock()
     def api(self, url):
         return self.base_url + API_PREFIX + url
+    def _bulk(self, method, url, items, bulk_size=BULK_SIZE):
+        """send a list of dicts to a bulk endpoint in chunks, and return
+        the concatenated JSON responses"""
+        result = []
+        for i in range(0, len(items), bulk_size):
+            r = self.session.request(method, self.api(url), data=json.dumps(items[i:i+bulk_size]),
+                                     headers={'Content-type': 'application/json'})
+            r.raise_for_status()
+            result += r.json()
+        return result
     def wakeup(self, pid=None):
         if pid is None:
-            return requests.get(self.api('/wakeup'))
+            return self.session.get(self.api('/wakeup'))
         else:
-            return requests.get(self.api('/wakeup/%s' % pid))
+            return self.session.get(self.api('/wakeup/%s' % pid))
     def start_next(self,roles,state=WAITING,ttl=None):
         if isinstance(roles,basestring):
             roles = [roles]
         url = self.api('/start_next/%s' % '/'.join(roles))
-        return requests.post(url, data={
+        return self.session.post(url, data={
             STATE: state,
             TTL: ttl
         })
-    def start_all(self,roles,expire=False,state=WAITING,ttl=None):
+    def claim(self,roles,n=1,state=WAITING,ttl=None):
+        """start up to n jobs at once. returns a list of jobs, which is
+        empty if there are none to start"""
+        if isinstance(roles,basestring):
+            roles = [roles]
+        r = self.session.post(self.api('/claim/%d/%s' % (n, '/'.join(roles))), data={
+            STATE: state,
+            TTL: ttl
+        })
+        if not isok(r):
+            return []
+        return r.json()
+    def start_all(self,roles,expire=False,state=WAITING,ttl=None,batch_size=1):
+        """generate jobs until there are none left to start, claiming
+        up to batch_size at a time. claimed jobs waiting their turn get a
+        heartbeat as each one before them starts, so batch_size > 1 is
+        for jobs that take much less than ttl"""
         while True:
             if expire:
                 self.expire()
-            r = self.start_next(roles,state=state,ttl=ttl)
-            if not isok(r):
+            jobs = self.claim(roles,batch_size,state=state,ttl=ttl)
+            if not jobs:
                 return
-            job = r.json()
-            yield job
+            for i, job in enumerate(jobs):
+                for queued in jobs[i+1:]:
+                    self.heartbeat(queued[PID],message='claimed')
+                yield job
     def create(self,pid,**d):
-        return requests.put(self.api('/create/%s' % pid), data=d)
+        return self.session.put(self.api('/create/%s' % pid), data=d)
+    def create_all(self,products):
+        """create many products. products is a list of dicts, each with
+        a PID and optionally STATE, EVENT, MESSAGE, PRIORITY, TTL. those
+        that exist are left alone. returns the products created"""
+        return self._bulk('PUT', '/create_all', products)
     def update_if(self,pid, **d):
         """d must contain STATE and NEW_STATE,
         d can also contain EVENT, MESSAGE"""
-        return requests.patch(self.api('/update_if/%s' % pid), data=d)
+        self._drop_heartbeat(pid)
+        return self.session.patch(self.api('/update_if/%s' % pid), data=d)
     def delete(self,pid):
-        return requests.delete(self.api('/delete/%s' % pid))
+        self._drop_heartbeat(pid)
+        return self.session.delete(self.api('/delete/%s' % pid))
     def delete_tree(self,pid):
-        return requests.delete(self.api('/delete_tree/%s' % pid))
+        return self.session.delete(self.api('/delete_tree/%s' % pid))
     def update(self,pid, **d):
         """d can contain STATE, EVENT, MESSAGE, TTL"""
-        return requests.patch(self.api('/update/%s' % pid), data=d)
+        # a held heartbeat sent later would undo this update
+        with self._heartbeat_lock:
+            self._heartbeats.pop(pid, None)
+            return self.session.patch(self.api('/update/%s' % pid), data=d)
+    def update_all(self,updates):
+        """update many products. updates is a list of dicts, each with a
+        PID and the same parameters as update. returns the products"""
+        with self._heartbeat_lock:
+            for d in updates:
+                self._heartbeats.pop(d[PID], None)
+            return self._bulk('PATCH', '/update_all', updates)
     def complete(self,pid,**d):
         """like update but sets TTL to FOREVER.
         d can contain STATE, EVENT, MESSAGE"""
         self.update(pid,**dict(d.items(),ttl=FOREVER))
+    def complete_all(self,pids,**d):
+        """complete many products with the same STATE, EVENT, MESSAGE"""
+        return self.update_all([dict(d.items(),pid=pid,ttl=FOREVER) for pid in pids])
     def heartbeat(self,pid,**d):
+        """record that a job is still running. heartbeats are held and
+        sent together, at most one per product per heartbeat_interval,
+        with the latest message"""
         d[EVENT] = HEARTBEAT
-        return requests.patch(self.api('/update/%s' % pid), data=d)
+        if not self.heartbeat_interval:
+            return self.session.patch(self.api('/update/%s' % pid), data=d)
+        with self._heartbeat_lock:
+            self._heartbeats[pid] = d
+            if self._heartbeat_timer is None:
+                self._heartbeat_timer = Timer(self.heartbeat_interval, self.flush_heartbeats)
+                self._heartbeat_timer.daemon = True
+                self._heartbeat_timer.start()
+    def flush_heartbeats(self):
+        """send all held heartbeats now"""
+        with self._heartbeat_lock:
+            if self._heartbeat_timer is not None:
+                self._heartbeat_timer.cancel()
+                self._heartbeat_timer = None
+            heartbeats = [dict(d, pid=pid) for pid, d in self._heartbeats.items()]
+            self._heartbeats = {}
+            if heartbeats:
+                try:
+                    self._bulk('PATCH', '/update_all', heartbeats)
+                except requests.RequestException:
+                    pass # heartbeats are advisory; the next one may get through
+    def _drop_heartbeat(self, pid):
+        with self._heartbeat_lock:
+            self._heartbeats.pop(pid, None)
     def depend(self,pid, upstream, role, priority=None):
-        return requests.put(self.api('/depend/%s' % pid), data={
+        return self.session.put(self.api('/depend/%s' % pid), data={
             UPSTREAM: upstream,
             ROLE: role,
             PRIORITY: priority
         })
+    def depend_all(self,deps):
+        """assert many dependencies, in order. deps is a list of dicts,
+        each with the downstream PID, UPSTREAM, ROLE, and optionally
+        PRIORITY. returns the downstream products"""
+        return self._bulk('PUT', '/depend_all', deps)
     def expire(self):
-        r = requests.delete(self.api('/expire'))
+        r = self.session.delete(self.api('/expire'))
         if not isok(r):
             return 0
         return r.json()['expired']
     def most_recent(self,n=None):
         if n is None:
             n = 25
-        r = requests.get(self.api('/most_recent/%d' % n))
+        r = self.session.get(self.api('/most_recent/%d' % n))
         return r.json()
     def downstream(self,roles=[],state=None,upstream_state=None):
         if roles:
             role_frag = '/%s' % '/'.join(roles)
         else:
             role_frag = ''
-        r = requests.post(self.api('/downstream%s' % role_frag), data={
+        r = self.session.post(self.api('/downstream%s' % role_frag), data={
             STATE: state,
             UPSTREAM_STATE: upstream_state
         })
         return r.json()
     def get_graph(self,pid):
-        r = requests.get(self.api('/get_graph/%s' % pid))
+        r = self.session.get(self.api('/get_graph/%s' % pid))
         return r.json()
     def search(self,frag):
-        r = requests.get(self.api('/search/%s' % frag))
+        r = self.session.get(self.api('/search/%s' % frag))
         return r.json()
     def get(self,pid):
-        r = requests.get(self.api('/get/%s' % pid))
+        r = self.session.get(self.api('/get/%s' % pid))
         return r.json()
-    def do_all_work(self,roles=[ANY],callback=None,message=None,ttl=None):
+    def reconcile(self):
+        """dispatch runnable products that have not been started, or
+        if the service does not dispatch, wake up all workers"""
+        return self.session.post(self.api('/reconcile'))
+    def _do_job(self,job,callback=None,message=None):
+        pid = job[PID]
+        try:
+            if callback is not None:
+                callback(pid,job)
+            self.complete(pid,
+                          state=AVAILABLE,
+                          event=COMPLETED,
+                          message=message)
+        except Exception as e:
+            self.update(pid,
+                        state=ERROR,
+                        event='exception',
+                        message=traceback.format_exc())
+    def work_on(self,pid,callback=None,message=None,ttl=None):
+        """start a specific job, unless it has already been started, and
+        do it like do_all_work. returns False if it was not started"""
+        r = self.update_if(pid, state=WAITING, new_state=RUNNING, event='start', ttl=ttl)
+        if r.status_code != http.OK:
+            return False
+        self._do_job(r.json(),callback,message)
+        return True
+    def do_all_work(self,roles=[ANY],callback=None,message=None,ttl=None,batch_size=1):
         # FIXME this would be a better decorator
-        for job in self.start_all(roles,ttl=ttl):
-            pid = job[PID]
-            try:
-                if callback is not None:
-                    callback(pid,job)
-                self.complete(pid,
-                              state=AVAILABLE,
-                              event=COMPLETED,
-                              message=message)
-            except Exception as e:
-                self.update(pid,
-                            state=ERROR,
-                            event='exception',
-                            message=traceback.format_exc())
-                
+        for job in self.start_all(roles,ttl=ttl,batch_size=batch_size):
+            self._do_job(job,callback,message)
+
 class Mutex(object):
     """Use a specific workflow product as a mutex. Requires cooperation
     between clients. Use with the "with" statement, like this:
@@ -168,6 +282,7 @@ class Mutex(object):
     def heartbeat(self):
         """acquire ttl additional seconds of life, to avoid expiration"""
         self.client.heartbeat(self.mutex_pid)
+        self.client.flush_heartbeats() # don't hold it
     def __exit__(self, exc_type, exc_value, traceback):
         # attempt to release the mutex into the WAITING state
         r = self.client.update_if(
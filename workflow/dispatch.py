@@ -0,0 +1,164 @@
+"""push dispatch of runnable workflow products.
+
+when a product becomes runnable (it is waiting, and its upstream
+dependencies are all available) the workflow service publishes its
+pid to a queue for the roles of those dependencies, so that one worker
+for those roles receives it, rather than waking up every worker to poll
+for work. workers consume their queue with consume() (see, e.g.,
+oii.ifcb2.workflow.dispatch_worker), which starts each product with
+update_if, so a product dispatched twice is only done once.
+
+products that were dispatched but not started (e.g., because a message
+was lost or a worker died before starting it) are dispatched again by
+Dispatcher.reconcile, which should be run periodically by hitting the
+workflow service's /reconcile endpoint.
+
+brokers have publish(key, pid) and consume(key, handler) methods, where
+key is a role key (see role_key). LocalBroker is an in-process stand-in
+for tests and single-process deployments; RabbitBroker uses durable
+RabbitMQ work queues (see oii.workflow.rabbit)"""
+import logging
+from datetime import timedelta
+from threading import Lock
+from Queue import Queue, Empty
+
+from sqlalchemy import and_, or_, exists, select, update
+from sqlalchemy.orm import aliased
+
+from oii.times import utcdtnow
+from oii.workflow import WAITING, AVAILABLE
+from oii.workflow.orm import Product, Dependency
+
+# event recorded on products when they are dispatched
+DISPATCHED='dispatched'
+
+# RabbitMQ queue names are this followed by the role key
+QUEUE_PREFIX='workflow_dispatch_'
+
+# products dispatched longer ago than this and not yet started are
+# dispatched again by reconcile, at most this many at a time
+RECONCILE_AGE=timedelta(minutes=10)
+RECONCILE_LIMIT=10000
+
+# how many product ids to put in one IN clause
+CHUNK_SIZE=500
+
+def role_key(roles):
+    """the queue key for a set of roles"""
+    return '/'.join(sorted(set(roles)))
+
+def queue_name(key):
+    return QUEUE_PREFIX + key.replace('/', '.')
+
+def _chunks(l, n=CHUNK_SIZE):
+    for i in range(0, len(l), n):
+        yield l[i:i+n]
+
+def runnable(session, ids=None, older_than=None, limit=None):
+    """find waiting products whose upstream dependencies are all available.
+    ids - if not None, only consider these products and their dependents
+    older_than - if not None, only consider products whose most recent
+    event is older than this timedelta
+    returns (id, pid, role key) tuples in priority order"""
+    upstream = aliased(Product)
+    q = session.query(Product.id, Product.pid).\
+        filter(Product.state==WAITING).\
+        filter(exists().where(Dependency.downstream_id==Product.id)).\
+        filter(~exists().where(and_(Dependency.downstream_id==Product.id,
+                                    Dependency.upstream_id==upstream.id,
+                                    upstream.state!=AVAILABLE)))
+    if ids is not None:
+        ids = list(ids)
+        if not ids:
+            return []
+        dependents = select([Dependency.downstream_id]).where(Dependency.upstream_id.in_(ids))
+        q = q.filter(or_(Product.id.in_(ids), Product.id.in_(dependents)))
+    if older_than is not None:
+        q = q.filter(Product.ts < utcdtnow() - older_than)
+    q = q.order_by(Product.priority)
+    if limit is not None:
+        q = q.limit(limit)
+    products = q.all()
+    roles = {}
+    for chunk in _chunks([id for id, _ in products]):
+        for id, role in session.query(Dependency.downstream_id, Dependency.role).\
+            filter(Dependency.downstream_id.in_(chunk)):
+            roles.setdefault(id, []).append(role)
+    return [(id, pid, role_key(roles[id])) for id, pid in products]
+
+class Dispatcher(object):
+    def __init__(self, broker):
+        self.broker = broker
+    def dispatch(self, session, ids=None, older_than=None, limit=None):
+        """publish runnable products (see runnable) to their role
+        queues, recording the dispatch on each one. commits. returns
+        the number of products dispatched"""
+        products = runnable(session, ids, older_than, limit)
+        if not products:
+            return 0
+        # record the dispatch, so that reconcile leaves these alone for a while
+        now = utcdtnow()
+        for chunk in _chunks([id for id, _, _ in products]):
+            session.execute(update(Product.__table__).\
+                            where(and_(Product.id.in_(chunk), Product.state==WAITING)).\
+                            values(event=DISPATCHED, ts=now))
+        session.commit()
+        # publish after committing; if publishing fails, reconcile will retry
+        for _, pid, key in products:
+            self.broker.publish(key, pid)
+        return len(products)
+    def reconcile(self, session, older_than=RECONCILE_AGE, limit=RECONCILE_LIMIT):
+        """dispatch again runnable products that have not been started"""
+        n = self.dispatch(session, older_than=older_than, limit=limit)
+        if n:
+            logging.warn('RECONCILE dispatched %d products' % n)
+        return n
+
+class LocalBroker(object):
+    """in-process message broker, with a queue per role key"""
+    def __init__(self):
+        self._queues = {}
+        self._lock = Lock()
+    def _queue(self, key):
+        with self._lock:
+            return self._queues.setdefault(key, Queue())
+    def publish(self, key, pid):
+        self._queue(key).put(pid)
+    def consume(self, key, handler, timeout=None):
+        """call handler with each pid published for key. returns when no
+        pid is published for timeout seconds, or never if timeout is None"""
+        q = self._queue(key)
+        while True:
+            try:
+                pid = q.get(timeout=timeout)
+            except Empty:
+                return
+            handler(pid)
+
+class RabbitBroker(object):
+    """message broker using a durable RabbitMQ work queue per role key"""
+    def __init__(self, host='localhost'):
+        self.host = host
+        self._lock = Lock()
+    def publish(self, key, pid):
+        # imported here so that pika is only needed if RabbitMQ is used
+        from oii.workflow.rabbit import channel_pool
+        # the pool reuses one connection, and reconnects if it is lost
+        with self._lock:
+            channel_pool(self.host).enqueue(pid, queue_name(key))
+    def consume(self, key, handler):
+        """call handler with each pid published for key. does not return"""
+        from oii.workflow.rabbit import Job, SKIP
+        class DispatchJob(Job):
+            def run_callback(self, pid):
+                handler(pid)
+                return SKIP # the workflow service records the outcome
+        DispatchJob(queue_name(key), self.host).work()
+
+def consume(broker, roles, client, callback=None, message=None, ttl=None):
+    """work on products dispatched for the given roles as they arrive.
+    like WorkflowClient.do_all_work, but for one product at a time,
+    as it becomes runnable"""
+    def handler(pid):
+        client.work_on(pid, callback=callback, message=message, ttl=ttl)
+    return broker.consume(role_key(roles), handler)
@@ -1,8 +1,9 @@
 from datetime import timedelta
 
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Table, MetaData, Column, ForeignKey, Integer, String, BigInteger, DateTime, func, distinct, UniqueConstraint, and_, or_, desc
-from sqlalchemy.orm import relationship, backref
+from sqlalchemy import Table, MetaData, Column, ForeignKey, Integer, String, BigInteger, DateTime, func, distinct, UniqueConstraint, Index, and_, or_, desc
+from sqlalchemy import select, update, exists, union
+from sqlalchemy.orm import relationship, backref, aliased, object_session
 from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.exc import IntegrityError
 
@@ -40,6 +41,11 @@ class Product(Base):
     expires = Column('expires', DateTime(timezone=True), default=None) # expiration time derived from ttl
     priority = Column('priority', Integer, default=100) # priority
 
+    # for finding the next products to start
+    __table_args__ = (
+        Index('ix_products_state_priority', 'state', 'priority'),
+    )
+
     depends_on = association_proxy('upstream_dependencies', 'upstream')
     dependents = association_proxy('downstream_dependencies', 'downstream')
 
@@ -81,17 +87,17 @@ class Product(Base):
 
     @property
     def ancestors(self):
-        for parent in self.depends_on:
-            yield parent
-            for anc in parent.ancestors:
-                yield anc
+        """all products this one depends on, directly or indirectly"""
+        session = object_session(self)
+        return session.query(Product).\
+            filter(Product.id.in_(ancestor_ids(session, self.id)))
 
     @property
     def descendants(self):
-        for child in self.dependents:
-            yield child
-            for desc in child.descendants:
-                yield desc
+        """all products that depend on this one, directly or indirectly"""
+        session = object_session(self)
+        return session.query(Product).\
+            filter(Product.id.in_(descendant_ids(session, self.id)))
 
     def __repr__(self):
         return '<Product %s (%s) @ %s>' % (self.pid, self.state, self.ts)
@@ -119,6 +125,13 @@ class Dependency(Base):
 
     UniqueConstraint('upstream_id','downstream_id','role')
 
+    # for matching a product's dependencies by role, and for finding
+    # the dependents of a product
+    __table_args__ = (
+        Index('ix_dependencies_downstream_role', 'downstream_id', 'role'),
+        Index('ix_dependencies_upstream', 'upstream_id'),
+    )
+
     # proxy for upstream product's state
     state = association_proxy('upstream', 'state')
 
@@ -128,6 +141,38 @@ class Dependency(Base):
         else:
             return '<%s depends on %s (as %s)>' % (self.downstream, self.role, self.upstream)
 
+# dependency graph traversal, as recursive queries. UNION rather than
+# UNION ALL, so that each product is visited once
+
+def _closure(session, product_id, name, from_col, to_col, chunk_size=500):
+    if session.bind.dialect.name == 'sqlite':
+        # Python 2's sqlite3 can't read an empty result of a WITH query,
+        # so walk the graph a level at a time and return a list of ids
+        ids, level = set(), [product_id]
+        while level:
+            found = set()
+            for i in range(0, len(level), chunk_size):
+                for id, in session.query(to_col).filter(from_col.in_(level[i:i+chunk_size])):
+                    found.add(id)
+            level = list(found - ids)
+            ids |= found
+        return list(ids)
+    cte = select([to_col.label('id')]).\
+        where(from_col==product_id).\
+        cte(name, recursive=True)
+    cte = cte.union(select([to_col]).where(from_col==cte.c.id))
+    return select([cte.c.id])
+
+def ancestor_ids(session, product_id):
+    """select the ids of all products a product depends on. on SQLite,
+    returns a list of them instead"""
+    return _closure(session, product_id, 'ancestors', Dependency.downstream_id, Dependency.upstream_id)
+
+def descendant_ids(session, product_id):
+    """select the ids of all products that depend on a product. on
+    SQLite, returns a list of them instead"""
+    return _closure(session, product_id, 'descendants', Dependency.upstream_id, Dependency.downstream_id)
+
 # queries that range across entire product dependency hierarchies
 # requires that an SQLA session be passed into each call
 
@@ -148,6 +193,15 @@ class Products(object):
             return create
         else:
             return p
+    def get_all(self, pids, chunk_size=500):
+        """return a dict from pid to product for those of the given pids
+        that exist"""
+        pids = list(set(pids))
+        products = {}
+        for i in range(0, len(pids), chunk_size):
+            for p in self.session.query(Product).filter(Product.pid.in_(pids[i:i+chunk_size])):
+                products[p.pid] = p
+        return products
     def count(self):
         return self.session.query(Product).count()
     def add_dep(self, downstream, upstream, role=None):
@@ -215,17 +269,76 @@ class Products(object):
         return q
     def get_next(self, roles=[ANY], state=WAITING, upstream_state=AVAILABLE):
         """find any product that is in state state and whose upstream dependencies are all in
-        upstream_state and satisfy all the specified roles, and lock it for update"""
-#            with_lockmode('update').
+        upstream_state and satisfy all the specified roles. does not lock it; see claim_next"""
         return self.downstream(roles, state, upstream_state).\
             first()
+    def _downstream_ids(self, roles=None, upstream_state=None):
+        """query for the ids of products whose upstream deps are all in
+        upstream_state and satisfy all the specified roles"""
+        upstream = aliased(Product)
+        q = self.session.query(Dependency.downstream_id).\
+            join(upstream, Dependency.upstream_id==upstream.id)
+        if upstream_state is not None:
+            q = q.filter(upstream.state==upstream_state)
+        if roles is not None and roles:
+            q = q.filter(Dependency.role.in_(roles)).\
+                group_by(Dependency.downstream_id).\
+                having(func.count(Dependency.role)==len(roles)).\
+                having(func.count(distinct(Dependency.role))==len(set(roles)))
+        else:
+            q = q.group_by(Dependency.downstream_id)
+        return q
+    def _skip_locked(self):
+        return self.session.bind.dialect.name == 'postgresql'
+    def claim_next(self, roles=[ANY], n=1, state=WAITING, upstream_state=AVAILABLE, ttl=None, new_state=RUNNING, event='start_next', message=None):
+        """like start_next, but start up to n products at once. returns
+        the products started, in priority order, which may be fewer than
+        n or none. on PostgreSQL, products are claimed with a single
+        UPDATE whose candidates are selected FOR UPDATE SKIP LOCKED, so
+        concurrent callers never wait on or claim the same product.
+        elsewhere (e.g., SQLite) each candidate is claimed by an UPDATE
+        that only succeeds if it is still in state"""
+        eligible = self._downstream_ids(roles, upstream_state).subquery()
+        candidates = select([Product.id]).\
+            where(and_(Product.state==state, Product.id.in_(select([eligible.c.downstream_id])))).\
+            order_by(Product.priority).\
+            limit(n)
+        if self._skip_locked():
+            claim = update(Product.__table__).\
+                where(Product.id.in_(candidates.with_for_update(skip_locked=True))).\
+                values(state=new_state).\
+                returning(Product.id)
+            ids = [id for id, in self.session.execute(claim)]
+        else:
+            ids = []
+            for id, in self.session.execute(candidates).fetchall():
+                claim = update(Product.__table__).\
+                    where(and_(Product.id==id, Product.state==state)).\
+                    values(state=new_state)
+                if self.session.execute(claim).rowcount:
+                    ids.append(id)
+        if not ids:
+            self.session.rollback()
+            return []
+        # now record the event on the claimed products, which this
+        # transaction already holds
+        products = self.session.query(Product).\
+            filter(Product.id.in_(ids)).\
+            order_by(Product.priority).\
+            populate_existing().\
+            all()
+        for p in products:
+            p.changed(event, new_state, message, ttl=ttl)
+        self.commit()
+        return products
     def start_next(self, roles=[ANY], state=WAITING, upstream_state=AVAILABLE, ttl=None, new_state=RUNNING, event='start_next', message=None):
         """find any product that is in state state and whose upstream dependencies are all in
         upstream_state and satisfy all the specified roles, atomically set it to the new state with
         the given event and message values. If no product is in the state queried, will return
         None instead"""
-        p = self.get_next(roles, state, upstream_state)
-        return self._update_commit(p, event, new_state, message, ttl=ttl)
+        for p in self.claim_next(roles, 1, state, upstream_state, ttl, new_state, event, message):
+            return p
+        return None
     def update_if(self, pid, state=WAITING, new_state=RUNNING, event='update_if', message=None, ttl=None):
         """atomically change the state of the given product, but only if it's
         in the specified current state"""
@@ -234,13 +347,47 @@ class Products(object):
             with_lockmode('update').\
             first()
         return self._update_commit(p, event, new_state, message, ttl)
+    def get_graph(self, pid):
+        """return the dependencies among a product, its ancestors, and its
+        descendants, as (downstream pid, downstream state, upstream pid, role)
+        rows, or None if there is no such product"""
+        p = self.get(pid)
+        if p is None:
+            return None
+        ancestors = ancestor_ids(self.session, p.id)
+        descendants = descendant_ids(self.session, p.id)
+        if isinstance(ancestors, list):
+            graph_ids = [p.id] + ancestors + descendants
+        else:
+            graph_ids = union(select([Product.id]).where(Product.id==p.id), ancestors, descendants)
+        upstream = aliased(Product)
+        downstream = aliased(Product)
+        return self.session.query(downstream.pid, downstream.state, upstream.pid, Dependency.role).\
+            join(Dependency, Dependency.downstream_id==downstream.id).\
+            join(upstream, Dependency.upstream_id==upstream.id).\
+            filter(downstream.id.in_(graph_ids)).\
+            all()
+    def _delete_ids(self, ids, chunk_size=500):
+        """delete products by id, along with all their dependencies"""
+        for i in range(0, len(ids), chunk_size):
+            chunk = ids[i:i+chunk_size]
+            self.session.query(Dependency).\
+                filter(or_(Dependency.upstream_id.in_(chunk), Dependency.downstream_id.in_(chunk))).\
+                delete(synchronize_session=False)
+            self.session.query(Product).\
+                filter(Product.id.in_(chunk)).\
+                delete(synchronize_session=False)
+        self.session.expire_all()
     def delete_tree(self,pid):
-        p = self.get_product(pid)
+        """delete a product and all its ancestors. does not commit"""
+        p = self.get(pid)
         if p is None:
             return self
-        td = [p] + list(p.ancestors)
-        for d in td:
-            self.session.delete(d)
+        ancestors = ancestor_ids(self.session, p.id)
+        if not isinstance(ancestors, list):
+            ancestors = [id for id, in self.session.execute(ancestors)]
+        ids = [p.id] + ancestors
+        self._delete_ids(ids)
         return self
     def delete_intermediate(self, state=AVAILABLE, upstream_state=AVAILABLE):
         """delete all products that
@@ -248,26 +395,32 @@ class Products(object):
         - have any dependencies (in other words, not "root" products")
         - have any dependents, all of which are in 'upstream_state'
         default is to find available products that no unavailable products depend on"""
-        for product in self.session.query(Product).\
+        child = aliased(Product)
+        q = self.session.query(Product.id).\
             filter(Product.state==state).\
-            filter(Product.depends_on.any()).\
-            filter(Product.dependents.any()).\
-            filter(~Product.dependents.any(Product.state!=upstream_state)).\
-            with_lockmode('update'):
-            self.session.delete(product)
+            filter(exists().where(Dependency.downstream_id==Product.id)).\
+            filter(exists().where(Dependency.upstream_id==Product.id)).\
+            filter(~exists().where(and_(Dependency.upstream_id==Product.id,
+                                        Dependency.downstream_id==child.id,
+                                        child.state!=upstream_state))).\
+            with_for_update(of=Product)
+        self._delete_ids([id for id, in q])
         self.session.commit()
+    def expired(self):
+        """find products in any state whose most recent event is older
+        than their TTL allows"""
+        now = utcdtnow()
+        return self.session.query(Product).\
+            filter(and_(Product.ttl.isnot(None),Product.ttl!=FOREVER)).\
+            filter(Product.expires.isnot(None)).\
+            filter(now > Product.expires)
     def expire(self, state=RUNNING, new_state=WAITING, event='expired', message=None, **kw):
         """allow products to expire whose most recent event is older
         than their TTL allows"""
         if state == new_state:
             raise ValueError('state and new_state are both %s' % state)
-        now = utcdtnow()
         n = 0
-        for p in self.session.query(Product).\
-            filter(and_(Product.ttl.isnot(None),Product.ttl!=FOREVER)).\
-            filter(Product.expires.isnot(None)).\
-            filter(now > Product.expires).\
-            with_lockmode('update'):
+        for p in self.expired().with_lockmode('update'):
             p.changed('expired', new_state)
             n += 1
         self.session.commit()
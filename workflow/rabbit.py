@@ -4,6 +4,7 @@ import sys
 import re
 import os
 import traceback
+from collections import OrderedDict
 
 from oii.utils import gen_id
 from oii.times import iso8601
@@ -19,19 +20,26 @@ DIE='die' # worker cannot work, should requeue and terminate
 # handy properties
 PERSISTENT=pika.BasicProperties(delivery_mode=2)
 
+# default prefetch count of work queue consumers. cheap jobs can use
+# a higher one, so workers don't wait for each message
+PREFETCH_COUNT=1
+
 DEBUG=True
 
 def debug(message):
     if debug:
         print message
 
-def declare_work_queue(qname,host='localhost',durable=True):
+class PublishError(Exception):
+    pass
+
+def declare_work_queue(qname,host='localhost',durable=True,prefetch_count=PREFETCH_COUNT):
     """Declare a "work queue"
-    A work queue is a durable queue with a prefetch_count of 1"""
+    A work queue is a durable queue with a prefetch_count of 1 by default"""
     connection = pika.BlockingConnection(pika.ConnectionParameters(host=host))
     channel = connection.channel()
     channel.queue_declare(queue=qname, durable=durable)
-    channel.basic_qos(prefetch_count=1)
+    channel.basic_qos(prefetch_count=prefetch_count)
     return channel, connection
 
 def declare_log_exchange(ename,host='localhost'):
@@ -42,31 +50,113 @@ def declare_log_exchange(ename,host='localhost'):
     channel.exchange_declare(exchange=ename,type='fanout')
     return channel, connection
 
+class ChannelPool(object):
+    """Long-lived channels on one connection to a RabbitMQ host, so that
+    publishing doesn't open a connection per message. Work queues and
+    log exchanges are declared once each. If confirm is true, the work
+    queue channel is transactional, and publishing a message, or a list
+    of messages, returns once the broker has committed all of them, after
+    one round trip. A pool belongs to the process that created it; after
+    a fork, the child opens its own connection"""
+    def __init__(self,host='localhost',confirm=True):
+        self.host = host
+        self.confirm = confirm
+        self.connection = None
+        self._pid = None
+    def _connect(self):
+        if self.connection is None or self._pid != os.getpid() or not self.connection.is_open:
+            self.connection = pika.BlockingConnection(pika.ConnectionParameters(host=self.host))
+            self._pid = os.getpid()
+            self._work_channel = None
+            self._log_channel = None
+            self._declared = set()
+        return self.connection
+    def work_channel(self,qname):
+        """A channel for publishing to the given work queue"""
+        self._connect()
+        if self._work_channel is None:
+            self._work_channel = self.connection.channel()
+            if self.confirm:
+                # a blocking channel in confirm mode waits for each message,
+                # so confirm a whole batch at once by committing it
+                self._work_channel.tx_select()
+        if qname not in self._declared:
+            self._work_channel.queue_declare(queue=qname, durable=True)
+            self._declared.add(qname)
+        return self._work_channel
+    def log_channel(self,ename):
+        """A channel for publishing to the given log exchange. Log
+        messages are not confirmed"""
+        self._connect()
+        if self._log_channel is None:
+            self._log_channel = self.connection.channel()
+        if ename not in self._declared:
+            self._log_channel.exchange_declare(exchange=ename,type='fanout')
+            self._declared.add(ename)
+        return self._log_channel
+    def _retry(self,fn):
+        # if the connection has been lost, or the broker has closed a
+        # channel (e.g., after a channel error), start over on a new
+        # connection, once. never keep a closed channel in the pool
+        for attempt in range(2):
+            try:
+                return fn()
+            except (pika.exceptions.AMQPConnectionError, pika.exceptions.ChannelClosed):
+                self.close()
+                if attempt:
+                    raise
+    def enqueue(self,message,qname):
+        """Push a message, or a list of messages, into a work queue"""
+        def _enqueue():
+            channel = self.work_channel(qname)
+            publish(qname,message,channel)
+            if self.confirm:
+                channel.tx_commit()
+        self._retry(_enqueue)
+    def log(self,message,ename):
+        self._retry(lambda: log(message,ename,channel=self.log_channel(ename)))
+    def close(self):
+        if self.connection is not None and self._pid == os.getpid():
+            try:
+                self.connection.close()
+            except:
+                pass
+        self.connection = None
+
+# per-process pools used when no channel is given, by host
+pools = {}
+
+def channel_pool(host='localhost'):
+    if host not in pools:
+        pools[host] = ChannelPool(host)
+    return pools[host]
+
 def log(message,ename,host='localhost',channel=None):
     """Log a message to a log exchange"""
     if channel is None:
-        ch, cn = declare_log_exchange(ename,host)
-        ch.basic_publish(exchange=ename,routing_key='',body=message)
-        cn.close()
+        channel_pool(host).log(message,ename)
     else:
         channel.basic_publish(exchange=ename,routing_key='',body=message)
 
 def publish(qname,message,channel):
+    """Publish a message, or a list of messages, to a work queue. If the
+    channel is in confirm mode, raises PublishError for any message the
+    broker does not confirm"""
     try:
-        channel.basic_publish(exchange='', routing_key=qname, body=message.strip(), properties=PERSISTENT)
+        messages = [message.strip()]
     except AttributeError:
-        for m in message:
-            channel.basic_publish(exchange='', routing_key=qname, body=m, properties=PERSISTENT)
+        messages = message
+    for m in messages:
+        if channel.basic_publish(exchange='', routing_key=qname, body=m, properties=PERSISTENT) is False:
+            raise PublishError('%s not confirmed for %s' % (m, qname))
 
 def enqueue(message,qname,host='localhost',channel=None):
     """Push a message into a work queue"""
-    connection = None
     if channel is None:
-        channel, connection = declare_work_queue(qname,host)
-    publish(qname,message,channel)
-    if connection is not None:
-        connection.close()
-        
+        channel_pool(host).enqueue(message,qname)
+    else:
+        publish(qname,message,channel)
+
 # channel operations
 
 def ack(channel,method):
@@ -94,12 +184,13 @@ class JobExit(Exception):
 
 class Job(object):
     """A RabbitMQ worker class
-    Implement run_callback to return a status message such as WIN, FAIL, or PASS"""
-    def __init__(self,qname,host='localhost'):
+    Implement run_callback to return a status message such as WIN, FAIL, or PASS
+    prefetch_count - how many messages a worker may hold unacknowledged"""
+    def __init__(self,qname,host='localhost',prefetch_count=PREFETCH_COUNT):
         self.host = host
         self.qname = qname
-        self.log_channel = None
-        self.work_channels = {}
+        self.prefetch_count = prefetch_count
+        self.channels = ChannelPool(host)
         self.workerid = ('%s_%s' % (gen_id()[:4], platform.node()))
     def run_callback(self,message):
         """Override this method to do some work. Message is the queue entry received.
@@ -117,25 +208,16 @@ class Job(object):
         """Call this in run_callback to send messages to the log exchange"""
         debug('log %s' % message)
         ename = self.qname+'_log'
-        if self.log_channel is None:
-            self.log_channel, self.log_connection = declare_log_exchange(ename,self.host)
         prefix = '%s %s ' % (iso8601(), self.workerid)
-        log(prefix + message,ename,channel=self.log_channel)
+        self.channels.log(prefix + message,ename)
     def release_log_channel(self):
-        if self.log_channel is not None:
-            try:
-                self.log_connection.close()
-            except:
-                pass
-            self.log_channel = None
+        self.channels.close()
     def enqueue(self,message,qname=None):
-        """Put a message in this worker's queue"""
+        """Put a message, or a list of messages, in this worker's queue"""
         if qname is None:
             qname = self.qname
-        if qname not in self.work_channels:
-            self.work_channels[qname], _ = declare_work_queue(qname, self.host)
         debug('enqueue %s to %s' % (message,qname))
-        enqueue(message,qname,self.host,self.work_channels[qname])
+        self.channels.enqueue(message,qname)
     def work(self,fork=False):
         debug('work called')
         """Start doing work. Will not return as it blocks for messages.
@@ -195,7 +277,7 @@ class Job(object):
             if fork and pid is None:
                 pid = os.fork()
             if not fork or pid == 0:
-                ch,_ = declare_work_queue(self.qname, self.host)
+                ch,_ = declare_work_queue(self.qname, self.host, prefetch_count=self.prefetch_count)
                 ch.basic_consume(amqp_run_callback, queue=self.qname)
                 ch.start_consuming()
             elif fork and pid != 0:
@@ -206,6 +288,12 @@ class Job(object):
                 except:
                     print 'WARNING exception while waiting for subprocess to terminate'
                 pid = None
+    def work_async(self):
+        """Like work, but consume on a SelectConnection (see AsyncConsumer),
+        so that with a prefetch_count above 1 the worker does not wait on
+        the broker between messages. Will not return until the connection
+        is closed, e.g. by DIE"""
+        AsyncConsumer(self).run()
     def retry_failed(self, filter=lambda x: True):
         """Push failed tasks back into the work queue"""
         def requeue_callback(channel, method, properties, message):
@@ -235,12 +323,93 @@ class Job(object):
         FIXME: do this right, with exchanges"""
         def trigger_callback(channel, method, properties, message):
             if filter(message):
-                enqueue(message,other_queue,self.host)
+                self.enqueue(message,other_queue)
             ack(channel,method)
         ch,_ = declare_work_queue(self.qname, self.host)
         ch.basic_consume(trigger_callback, queue=self.qname+'_win')
         ch.start_consuming()
      
+class AsyncConsumer(object):
+    """Consumes a Job's work queue on a SelectConnection. WIN, FAIL, and
+    PASS outcomes are published to the win, fail, and work queues on the
+    consuming channel in publisher confirm mode, and each message is
+    acked or rejected when the broker confirms its outcome, rather than
+    waiting for each confirm. The broker confirms outcomes in batches"""
+    def __init__(self,job):
+        self.job = job
+        self.connection = None
+        self.channel = None
+        self.published = 0 # publish sequence number of the last outcome
+        self.unconfirmed = OrderedDict() # sequence number -> (delivery tag, settle function)
+    def run(self):
+        params = pika.ConnectionParameters(host=self.job.host)
+        self.connection = SelectConnection(params, self.on_open)
+        self.connection.ioloop.start()
+    def on_open(self,connection):
+        connection.channel(on_open_callback=self.on_channel_open)
+    def on_channel_open(self,channel):
+        self.channel = channel
+        channel.confirm_delivery(self.on_confirm)
+        qname = self.job.qname
+        qnames = [qname, qname+'_win', qname+'_fail']
+        def declare(frame=None):
+            if qnames:
+                channel.queue_declare(declare, queue=qnames.pop(0), durable=True)
+            else:
+                channel.basic_qos(self.on_qos, prefetch_count=self.job.prefetch_count)
+        declare()
+    def on_qos(self,frame):
+        debug('waiting for jobs from %s' % self.job.qname)
+        self.channel.basic_consume(self.on_message, queue=self.job.qname)
+    def ack(self,delivery_tag):
+        self.channel.basic_ack(delivery_tag=delivery_tag)
+    def reject(self,delivery_tag,requeue=False):
+        self.channel.basic_reject(delivery_tag=delivery_tag, requeue=requeue)
+    def publish(self,qname,message,delivery_tag,settle):
+        """publish an outcome, and settle the delivery it is the outcome
+        of when the broker confirms it"""
+        self.channel.basic_publish(exchange='', routing_key=qname, body=message, properties=PERSISTENT)
+        self.published += 1
+        self.unconfirmed[self.published] = (delivery_tag, settle)
+    def on_confirm(self,frame):
+        confirm = frame.method
+        if confirm.multiple:
+            seqs = [n for n in self.unconfirmed if n <= confirm.delivery_tag]
+        else:
+            seqs = [confirm.delivery_tag]
+        for n in seqs:
+            delivery_tag, settle = self.unconfirmed.pop(n)
+            if confirm.NAME == 'Basic.Ack':
+                settle(delivery_tag)
+            else: # outcome was not recorded, so let a worker try again
+                self.reject(delivery_tag, requeue=True)
+    def on_message(self,channel,method,properties,message):
+        debug('callback %s' % message)
+        job = self.job
+        try:
+            job.log('START %s' % message)
+            ret = job.run_callback(message)
+            job.log('CALLBACK %s returned %s' % (message,ret))
+        except JobExit as e:
+            message = e.message
+            ret = e.ret
+        except Exception:
+            job.log('EXCEPTION on %s - %s' % (message, traceback.format_exc()))
+            ret = FAIL
+        tag = method.delivery_tag
+        if ret == PASS:
+            self.publish(job.qname, message, tag, self.ack)
+        elif ret == WIN or ret is None:
+            self.publish(job.qname+'_win', message, tag, self.ack)
+        elif ret == SKIP:
+            self.ack(tag)
+        elif ret == DIE:
+            job.log('DIE on %s - exiting' % message)
+            self.reject(tag, requeue=True)
+            self.connection.close()
+        elif ret == FAIL:
+            self.publish(job.qname+'_fail', message, tag, self.reject)
+
 # this class passes on messages that contain a certain string
 class PassTest(Job):
     def __init__(self,qname,verboten='a',host='localhost'):
@@ -1,5 +1,6 @@
 from threading import Lock
 import os
+import logging
 import mimetypes
 import json
 import re
@@ -8,6 +9,7 @@ from datetime import timedelta
 import httplib as http
 
 from flask import Flask, Blueprint, Response, abort, request, render_template, render_template_string, redirect, current_app
+from werkzeug.datastructures import MultiDict
 
 from sqlalchemy import create_engine, event
 from sqlalchemy.exc import IntegrityError, InvalidRequestError
@@ -19,7 +21,8 @@ from oii.workflow.orm import Base, Product, Dependency, Products
 from oii.workflow.orm import STATE, NEW_STATE, EVENT, MESSAGE, TTL, UPSTREAM_STATE
 from oii.workflow.orm import WAITING, AVAILABLE, ROLE, ANY, HEARTBEAT, UPSTREAM, RUNNING
 from oii.workflow.async import async_config, async_wakeup
-from oii.workflow import PRIORITY
+from oii.workflow.dispatch import Dispatcher, LocalBroker, RabbitBroker
+from oii.workflow import PID, PRIORITY
 
 from oii.workflow.client import DEFAULT_PORT, API_PREFIX
 
@@ -29,6 +32,10 @@ MIME_JSON='application/json'
 # configuration parameters
 ASYNC_CONFIG_MODULE='ASYNC_CONFIG_MODULE'
 DATABASE_URL='DATABASE_URL'
+# push runnable products to per-role RabbitMQ queues on this host
+DISPATCH_AMQP_HOST='DISPATCH_AMQP_HOST'
+# push runnable products to in-process queues (single process only)
+DISPATCH_LOCAL='DISPATCH_LOCAL'
 
 # this is a Flask blueprint
 workflow_blueprint = Blueprint('workflow_blueprint',__name__)
@@ -36,6 +43,9 @@ workflow_blueprint = Blueprint('workflow_blueprint',__name__)
 # global ORM session object
 session = None
 
+# global dispatcher, if push dispatch is configured (see oii.workflow.dispatch)
+dispatcher = None
+
 @workflow_blueprint.before_app_first_request
 def config():
     # get async config module from Flask config (i.e., WSGI config)
@@ -49,6 +59,13 @@ def config():
     global ScopedSession
     ScopedSession = scoped_session(sessionmaker(bind=dbengine))
     session = ScopedSession()
+    # get dispatch configuration from Flask config
+    global dispatcher
+    amqp_host = current_app.config.get(DISPATCH_AMQP_HOST)
+    if amqp_host:
+        dispatcher = Dispatcher(RabbitBroker(amqp_host))
+    elif current_app.config.get(DISPATCH_LOCAL):
+        dispatcher = Dispatcher(LocalBroker())
 
 @workflow_blueprint.teardown_request
 def teardown_request(exception):
@@ -108,6 +125,14 @@ def product_params(form,defaults):
         params[k] = form.get(k,default=defaults.get(k,None))
     return params
 
+def request_items():
+    """parse the JSON list of dicts posted to a bulk endpoint. each dict
+    is returned as a MultiDict, so it can be used like a form"""
+    items = request.get_json(force=True, silent=True)
+    if not isinstance(items, list) or not all(isinstance(i, dict) for i in items):
+        abort(http.BAD_REQUEST)
+    return [MultiDict(i) for i in items]
+
 def params2product(pid,params):
     return Product(pid=pid,
                    state=params.get(STATE,None),
@@ -147,6 +172,23 @@ def products_response(ps,error_code=http.NOT_FOUND,success_code=http.OK):
         abort(error_code)
     return Response(json.dumps([product2dict(p) for p in ps]), mimetype=MIME_JSON, status=success_code)
 
+# after a change is committed, dispatch any of the given products,
+# or their dependents, that are now runnable. failure to dispatch
+# does not fail the request; reconcile will dispatch them later
+def do_dispatch(ids):
+    if dispatcher is None or not ids:
+        return
+    try:
+        dispatcher.dispatch(session, ids)
+    except Exception, e:
+        session.rollback()
+        logging.warn('DISPATCH failed: %s' % e)
+
+# the ids of updated products that can make a product runnable. products
+# that are still running (e.g., after a heartbeat) can't
+def dispatchable(ps):
+    return [p.id for p in ps if p.state in (WAITING, AVAILABLE)]
+
 ############# ENDPOINTS ##################
 
 # create an product in a given initial state
@@ -159,7 +201,34 @@ def create(pid):
     })
     p = do_create(pid, params)
     do_commit(error_code=http.CONFLICT) # commit error indicates object already exists
-    return product_response(p, success_code=http.CREATED)
+    r = product_response(p, success_code=http.CREATED)
+    do_dispatch([p.id])
+    return r
+
+# bulk form of create. accepts a JSON list of dicts, each with a "pid"
+# and the same parameters as create. products that already exist are
+# left alone. commits once. returns a JSON list of the products created
+@workflow_blueprint.route('/create_all',methods=['POST','PUT'])
+def create_all():
+    items = request_items()
+    ps = Products(session)
+    existing = ps.get_all([i.get(PID) for i in items])
+    created = []
+    for item in items:
+        pid = item.get(PID)
+        if pid is None:
+            abort(http.BAD_REQUEST)
+        if pid in existing:
+            continue
+        params = product_params(item, defaults={
+            STATE: AVAILABLE
+        })
+        existing[pid] = do_create(pid, params)
+        created.append(existing[pid])
+    do_commit(error_code=http.CONFLICT)
+    r = Response(json.dumps([product2dict(p) for p in created]), mimetype=MIME_JSON, status=http.CREATED)
+    do_dispatch([p.id for p in created])
+    return r
 
 # delete a product regardless of its state or dependencies
 @workflow_blueprint.route('/delete/<url:pid>',methods=['GET','POST','DELETE'])
@@ -197,7 +266,42 @@ def update(pid):
     p = Products(session).get(pid, create=new_p)
     do_update(p, params)
     do_commit()
-    return product_response(p)
+    r = product_response(p)
+    do_dispatch(dispatchable([p]))
+    return r
+
+# bulk form of update, which can also be used to complete products
+# or send heartbeats. accepts a JSON list of dicts, each with a "pid"
+# and the same parameters as update, applied in order. commits once.
+# returns a JSON list of the products updated
+@workflow_blueprint.route('/update_all',methods=['POST','PATCH'])
+def update_all():
+    items = request_items()
+    ps = Products(session)
+    products = ps.get_all([i.get(PID) for i in items])
+    updated, seen = [], set()
+    for item in items:
+        pid = item.get(PID)
+        if pid is None:
+            abort(http.BAD_REQUEST)
+        params = product_params(item, defaults={
+            EVENT: HEARTBEAT,
+            STATE: RUNNING,
+            MESSAGE: None,
+            PRIORITY: None,
+            TTL: None
+        })
+        p = products.get(pid)
+        if p is None:
+            p = products[pid] = do_create(pid, params)
+        do_update(p, params)
+        if pid not in seen:
+            seen.add(pid)
+            updated.append(p)
+    do_commit()
+    r = products_response(updated)
+    do_dispatch(dispatchable(updated))
+    return r
 
 # assert a dependency between a downstream product and an upstream product,
 # where that dependency is associated with a role that the upstream product
@@ -217,17 +321,55 @@ def depend(down_pid):
         STATE: WAITING
     })
     ps = Products(session)
-    up = ps.session.query(Product).filter(Product.pid==up_pid).first()
-    up = ps.get(up_pid, create=params2product(up_pid, {
-        STATE: AVAILABLE,
-        EVENT: 'implicit_create',
-        PRIORITY: priority
-    }))
-    dp = ps.get(down_pid, create=params2product(down_pid, params))
+    dp = do_depend(ps, ps.get_all([down_pid, up_pid]), down_pid, up_pid, role, priority, params)
+    do_commit()
+    r = product_response(dp)
+    do_dispatch([dp.id])
+    return r
+
+def do_depend(ps, products, down_pid, up_pid, role, priority, params):
+    """products is a dict from pid to existing products, to which
+    any products implicitly created are added"""
+    up = products.get(up_pid)
+    if up is None:
+        up = products[up_pid] = do_create(up_pid, {
+            STATE: AVAILABLE,
+            EVENT: 'implicit_create',
+            PRIORITY: priority
+        })
+    dp = products.get(down_pid)
+    if dp is None:
+        dp = products[down_pid] = do_create(down_pid, params)
     dp.priority = up.priority
     ps.add_dep(dp, up, role)
+    return dp
+
+# bulk form of depend. accepts a JSON list of dicts, each with the
+# downstream pid as "pid", and the same parameters as depend.
+# dependencies are asserted in order, so a product can depend on one
+# implicitly created earlier in the list. commits once.
+# returns a JSON list of the downstream products
+@workflow_blueprint.route('/depend_all',methods=['POST','PUT'])
+def depend_all():
+    items = request_items()
+    ps = Products(session)
+    products = ps.get_all([i.get(PID) for i in items] + [i.get(UPSTREAM) for i in items])
+    dps, seen = [], set()
+    for item in items:
+        down_pid, up_pid = item.get(PID), item.get(UPSTREAM)
+        if down_pid is None or up_pid is None:
+            abort(http.BAD_REQUEST)
+        params = product_params(item, defaults={
+            STATE: WAITING
+        })
+        dp = do_depend(ps, products, down_pid, up_pid, item.get(ROLE,default=ANY), item.get(PRIORITY,default=None), params)
+        if down_pid not in seen:
+            seen.add(down_pid)
+            dps.append(dp)
     do_commit()
-    return product_response(dp)
+    r = products_response(dps)
+    do_dispatch([dp.id for dp in dps])
+    return r
 
 # find all products whose upstream dependencies are all in the given state
 # (default "available") for the given roles
@@ -261,6 +403,20 @@ def start_next(role_list):
     # note that start_next commits and handles errors
     return product_response(p)
 
+# like start_next, but start up to n products at once.
+# returns a JSON list of the products started
+@workflow_blueprint.route('/claim/<int:n>/<path:role_list>',methods=['GET','POST'])
+def claim(n, role_list):
+    kw = product_params(request.form, defaults={
+        STATE: WAITING,
+        UPSTREAM_STATE: AVAILABLE,
+        TTL: None
+    })
+    roles = role_list.split('/')
+    ps = Products(session).claim_next(roles, n, kw[STATE], kw[UPSTREAM_STATE], kw[TTL])
+    # note that claim_next commits and handles errors
+    return products_response(ps)
+
 @workflow_blueprint.route('/update_if/<url:pid>',methods=['POST','PATCH'])
 def update_if(pid):
     kw = product_params(request.form, defaults={
@@ -271,7 +427,9 @@ def update_if(pid):
         update_if(pid, state=kw[STATE], new_state=kw[NEW_STATE],
                   event=kw[EVENT], message=kw[MESSAGE], ttl=kw[TTL])
     # FIXME could the above expression be simplified with **?
-    return product_response(p, error_code=http.CONFLICT)
+    r = product_response(p, error_code=http.CONFLICT)
+    do_dispatch([p.id])
+    return r
 
 @workflow_blueprint.route('/expire',methods=['GET','POST','DELETE'])
 def expire():
@@ -280,9 +438,14 @@ def expire():
         NEW_STATE: WAITING,
         EVENT: 'expired'
     })
-    n = Products(session).expire(**kw)
+    ps = Products(session)
+    if dispatcher is not None:
+        ids = [id for id, in ps.expired().with_entities(Product.id)]
+    n = ps.expire(**kw)
     if n == 0:
         abort(404)
+    if dispatcher is not None:
+        do_dispatch(ids)
     return Response(json.dumps(dict(expired=n)),mimetype=MIME_JSON)
 
 @workflow_blueprint.route('/most_recent')
@@ -302,24 +465,32 @@ def get(pid):
 
 @workflow_blueprint.route('/get_graph/<url:pid>')
 def get_graph(pid):
-    # FIXME move impl to ORM?
-    p = Products(session).get(pid)
-    ps = [p]
-    for a in p.ancestors:
-        ps.append(a)
-    for d in p.descendants:
-        ps.append(d)
-    r = []
-    for p in ps:
-        for ud in p.upstream_dependencies:
-            r.append(dict(downstream=p.pid, state=p.state, upstream=ud.upstream.pid, role=ud.role))
+    edges = Products(session).get_graph(pid)
+    if edges is None:
+        abort(http.NOT_FOUND)
+    r = [dict(downstream=d, state=state, upstream=u, role=role) for d, state, u, role in edges]
     return Response(json.dumps(r), mimetype=MIME_JSON)
 
 # asynchronous notification support
 
-# wake up workers optionally with a pid payload
+# wake up workers optionally with a pid payload. if products are
+# dispatched, workers consume them from their role queues (see
+# oii.ifcb2.workflow.dispatch_worker) instead of being woken up to poll
+# for work, but a pid payload is still delivered
 @workflow_blueprint.route('/wakeup')
 @workflow_blueprint.route('/wakeup/<url:pid>')
 def wakeup(pid=None):
-    async_wakeup(pid)
+    if dispatcher is None or pid is not None:
+        async_wakeup(pid)
     return Response(json.dumps(dict(status='success')),mimetype=MIME_JSON)
+
+# dispatch runnable products that were dispatched a while ago but not
+# started, or, if products are not dispatched, wake up workers to poll
+# for work. should be hit periodically (e.g., by cron)
+@workflow_blueprint.route('/reconcile',methods=['GET','POST'])
+def reconcile():
+    if dispatcher is None:
+        async_wakeup()
+        return Response(json.dumps(dict(dispatched=None)),mimetype=MIME_JSON)
+    n = dispatcher.reconcile(session)
+    return Response(json.dumps(dict(dispatched=n)),mimetype=MIME_JSON)